@@ -0,0 +1,520 @@
+"""
+Measure smalltest's own overhead on generated test trees
+
+Trees of trivial tests are generated in a temporary folder and each stage
+(discovery, the serial and parallel runners and the text reporter) is timed
+in a fresh interpreter so the peak memory of one stage doesn't hide another.
+
+    python benchmarks/run_benchmarks.py --tests 1000 10000 --output results.json
+    python benchmarks/run_benchmarks.py --compare old.json --output new.json
+
+The results are written as JSON so two versions of smalltest can be compared
+with --compare.
+
+    python benchmarks/run_benchmarks.py --worker-startup
+
+measures the time each parallel worker spends importing a test module's
+dependencies, with and without preloading them, for each start method.
+
+    python benchmarks/run_benchmarks.py --capture-overhead
+
+measures the time run_test adds to each test with each output capture mode.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Optional
+
+RESULTS_VERSION = 1
+
+MIXES = ["passing", "failing", "output"]
+STAGES = [
+    "discover_cold",
+    "discover_warm",
+    "run_serial",
+    "run_parallel",
+    "report",
+]
+
+START_METHODS = ["fork", "forkserver", "spawn"]
+
+# Standard library modules with a noticeable import cost, standing in for
+# the heavy dependencies of a real project
+HEAVY_MODULES = [
+    "asyncio",
+    "decimal",
+    "email.mime.multipart",
+    "http.server",
+    "unittest",
+    "xml.dom.minidom",
+]
+
+# Test modules run by each worker in the worker startup measurement
+MODULES_PER_WORKER = 4
+
+# Tests run for each capture mode in the capture overhead measurement
+CAPTURE_TESTS = 20000
+
+# One in FAILURE_RATE tests fails in the failing mix
+FAILURE_RATE = 10
+# Characters printed by every test in the output mix
+OUTPUT_SIZE = 1000
+
+
+def write_test_module(pth: Path, module_index: int, test_count: int, mix: str) -> None:
+    lines = ['"""Generated smalltest benchmark module"""', ""]
+    for i in range(test_count):
+        lines.append(f"def test_{module_index}_{i}():")
+        if mix == "failing" and i % FAILURE_RATE == 0:
+            lines.append(f"    value = {i}")
+            lines.append(f"    assert value == {i + 1}")
+        elif mix == "output":
+            lines.append(f"    print({'x' * OUTPUT_SIZE!r})")
+        else:
+            lines.append("    pass")
+        lines.append("")
+    pth.write_text("\n".join(lines))
+
+
+def generate_tree(base: Path, test_count: int, tests_per_module: int, mix: str) -> None:
+    """
+    Write a tree of test modules for a benchmark case.
+
+    :param base: folder to write the tests folder into
+    :param test_count: total number of tests
+    :param tests_per_module: tests in each module, the last may have fewer
+    :param mix: one of MIXES
+    """
+    tests_folder = base / "tests"
+    tests_folder.mkdir(parents=True)
+    module_index = 0
+    remaining = test_count
+    while remaining > 0:
+        count = min(tests_per_module, remaining)
+        write_test_module(
+            tests_folder / f"test_bench_{module_index}.py",
+            module_index,
+            count,
+            mix,
+        )
+        remaining -= count
+        module_index += 1
+
+
+def peak_rss_kb() -> int:
+    """Peak resident memory of this process and any finished children"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    scale = 1024 if sys.platform == "darwin" else 1
+    return max(usage, children) // scale
+
+
+def run_stage(stage: str, base: Path, processes: Optional[int]) -> dict:
+    """
+    Time a single stage against a generated tree, in this process.
+
+    :param stage: one of STAGES
+    :param base: generated tree
+    :param processes: worker processes for the parallel runner
+    :return: {"wall_ns": ..., "tests": ..., "test_time_ns": ..., "peak_rss_kb": ...}
+    """
+    from smalltest.internals import set_cache_folder, REWRITE_FOLDER_NAME
+    from smalltest.suite import (
+        discover_tests,
+        run_tests_parallel,
+        run_tests_serial,
+        text_reporter,
+    )
+    from smalltest.util import get_cache_folder
+
+    set_cache_folder(get_cache_folder(base) / REWRITE_FOLDER_NAME)
+    sys.path.insert(0, str(base))
+    devnull = open(os.devnull, "w")
+
+    test_time_ns = 0
+    if stage in ("discover_cold", "discover_warm"):
+        use_index = stage == "discover_warm"
+        start = time.perf_counter_ns()
+        tests = discover_tests(base, use_index=use_index)
+        wall_ns = time.perf_counter_ns() - start
+        test_total = sum(len(names) for names in tests.values())
+    else:
+        tests = discover_tests(base)
+        test_total = sum(len(names) for names in tests.values())
+        if stage == "run_parallel":
+            results = run_tests_parallel(tests, stream=devnull, processes=processes)
+        else:
+            results = run_tests_serial(tests, stream=devnull)
+
+        if stage == "report":
+            # Time the reporter alone against results that already exist
+            results = list(results)
+            start = time.perf_counter_ns()
+            text_reporter(results, stream=devnull)
+            wall_ns = time.perf_counter_ns() - start
+        else:
+            start = time.perf_counter_ns()
+            for _, result in results:
+                test_time_ns += result.wall_time_ns
+            wall_ns = time.perf_counter_ns() - start
+
+    return {
+        "wall_ns": wall_ns,
+        "tests": test_total,
+        "test_time_ns": test_time_ns,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def run_worker_startup(
+        base: Path,
+        processes: int,
+        start_method: str,
+        preload: list[str],
+) -> dict:
+    """
+    Run a tree whose modules import HEAVY_MODULES with the parallel runner,
+    in this process.
+
+    The import time of a module is recorded on the first result a worker
+    runs from it, so the total over every result is the time the workers
+    spent importing. Preloaded dependencies are already imported and don't
+    count towards it.
+    """
+    from smalltest.suite import discover_tests, run_tests_parallel
+
+    sys.path.insert(0, str(base))
+    devnull = open(os.devnull, "w")
+    tests = discover_tests(base)
+
+    import_ns = 0
+    start = time.perf_counter_ns()
+    results = run_tests_parallel(
+        tests,
+        stream=devnull,
+        processes=processes,
+        start_method=start_method,
+        preload=preload,
+    )
+    for _, result in results:
+        import_ns += result.import_time_ns
+    wall_ns = time.perf_counter_ns() - start
+
+    return {
+        "start_method": start_method,
+        "preload": preload,
+        "wall_ns": wall_ns,
+        "import_ns_per_worker": import_ns // processes,
+    }
+
+
+def measure_worker_startup(processes: int) -> list[dict]:
+    """Worker import time for each start method with and without preloading"""
+    measured = []
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        tests_folder = base / "tests"
+        tests_folder.mkdir()
+        imports = "\n".join(f"import {module}" for module in HEAVY_MODULES)
+        for i in range(processes * MODULES_PER_WORKER):
+            (tests_folder / f"test_startup_{i}.py").write_text(
+                f"{imports}\n\n\ndef test_imported():\n    pass\n"
+            )
+
+        for start_method in START_METHODS:
+            for preload in ([], HEAVY_MODULES):
+                command = [
+                    sys.executable, __file__,
+                    "--stage", "worker_startup",
+                    "--tree", str(base),
+                    "--processes", str(processes),
+                    "--start-method", start_method,
+                    "--preload", *preload,
+                ]
+                output = subprocess.run(
+                    command, capture_output=True, text=True, check=True, cwd=base
+                ).stdout
+                measured.append(json.loads(output.splitlines()[-1]))
+    return measured
+
+
+def write_worker_startup(measured: list[dict], stream) -> None:
+    stream.write("Worker startup, dependency import time per worker\n")
+    baseline = {}
+    for result in measured:
+        method = result["start_method"]
+        label = "preloaded" if result["preload"] else "cold"
+        line = (
+            f"    {method:<11} {label:<10} "
+            f"{result['import_ns_per_worker'] / 1e6:8.1f}ms/worker "
+            f"{result['wall_ns'] / 1e9:8.3f}s wall"
+        )
+        if result["preload"] and method in baseline:
+            saved = baseline[method] - result["import_ns_per_worker"]
+            line += f"  saved {saved / 1e6:.1f}ms/worker"
+            if method == "spawn":
+                # Nothing is shared, each worker still imports them itself
+                line += " (moved to worker start)"
+        else:
+            baseline[method] = result["import_ns_per_worker"]
+        stream.write(line + "\n")
+
+
+def measure_capture_overhead(test_count: int = CAPTURE_TESTS) -> list[dict]:
+    """
+    Time run_test with each capture mode against calling the test directly,
+    for a test that prints nothing and one that prints OUTPUT_SIZE characters.
+
+    File descriptors 1 and 2 point at os.devnull while measuring so output
+    that isn't captured costs as little as possible.
+    """
+    from smalltest.suite.capture import CAPTURE_MODES, CaptureOptions
+    from smalltest.suite.run import run_test
+
+    def quiet():
+        pass
+
+    def printing():
+        print("x" * OUTPUT_SIZE)
+
+    measured = []
+    saved_fds = [os.dup(1), os.dup(2)]
+    saved_streams = sys.stdout, sys.stderr
+    devnull = open(os.devnull, "w")
+    try:
+        for fd in (1, 2):
+            os.dup2(devnull.fileno(), fd)
+        sys.stdout = sys.stderr = devnull
+
+        for label, test in [("quiet", quiet), ("output", printing)]:
+            start = time.perf_counter_ns()
+            for _ in range(test_count):
+                test()
+            bare_ns = time.perf_counter_ns() - start
+
+            for mode in CAPTURE_MODES:
+                capture = CaptureOptions(mode).make()
+                start = time.perf_counter_ns()
+                for _ in range(test_count):
+                    run_test(test, capture)
+                wall_ns = time.perf_counter_ns() - start
+                capture.close()
+                measured.append({
+                    "test": label,
+                    "mode": mode,
+                    "tests": test_count,
+                    "overhead_per_test_ns": (wall_ns - bare_ns) // test_count,
+                })
+    finally:
+        sys.stdout, sys.stderr = saved_streams
+        for fd, saved in zip((1, 2), saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+        devnull.close()
+    return measured
+
+
+def write_capture_overhead(measured: list[dict], stream) -> None:
+    stream.write("Capture overhead added by run_test\n")
+    for result in measured:
+        stream.write(
+            f"    {result['test']:<7} {result['mode']:<5} "
+            f"{result['overhead_per_test_ns'] / 1000:8.2f}us/test\n"
+        )
+
+
+def run_stage_subprocess(stage: str, base: Path, processes: Optional[int]) -> dict:
+    command = [
+        sys.executable, __file__, "--stage", stage, "--tree", str(base),
+    ]
+    if processes:
+        command += ["--processes", str(processes)]
+    output = subprocess.run(
+        command, capture_output=True, text=True, check=True, cwd=base
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_case(
+        test_count: int,
+        tests_per_module: int,
+        mix: str,
+        stages: list[str],
+        processes: Optional[int],
+) -> dict:
+    """Generate a tree and time each stage against it"""
+    case = {
+        "tests": test_count,
+        "modules": -(-test_count // tests_per_module),
+        "mix": mix,
+        "stages": {},
+    }
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        generate_tree(base, test_count, tests_per_module, mix)
+
+        # Build the discovery index so discover_warm measures a repeat run
+        run_stage_subprocess("discover_warm", base, processes)
+
+        for stage in stages:
+            measured = run_stage_subprocess(stage, base, processes)
+            per_test_ns = measured["wall_ns"] // max(measured["tests"], 1)
+            measured["per_test_ns"] = per_test_ns
+            if stage == "run_serial":
+                # Time spent outside the test functions themselves
+                measured["overhead_per_test_ns"] = (
+                    (measured["wall_ns"] - measured["test_time_ns"])
+                    // max(measured["tests"], 1)
+                )
+            case["stages"][stage] = measured
+    return case
+
+
+def case_key(case: dict) -> tuple:
+    return case["tests"], case["modules"], case["mix"]
+
+
+def write_comparison(baseline: dict, current: dict, stream) -> None:
+    """Write the change in wall time and memory of each stage"""
+    old_cases = {case_key(case): case for case in baseline["cases"]}
+    stream.write(f"{'case':<36} {'stage':<14} {'wall':>10} {'change':>8} {'rss':>8}\n")
+    for case in current["cases"]:
+        old_case = old_cases.get(case_key(case))
+        name = f"{case['tests']} tests/{case['modules']} modules/{case['mix']}"
+        for stage, measured in case["stages"].items():
+            change = ""
+            if old_case is not None and stage in old_case["stages"]:
+                old = old_case["stages"][stage]
+                change = f"{measured['wall_ns'] / max(old['wall_ns'], 1):.2f}x"
+            stream.write(
+                f"{name:<36} {stage:<14} {measured['wall_ns'] / 1e9:>9.3f}s "
+                f"{change:>8} {measured['peak_rss_kb'] // 1024:>6}MB\n"
+            )
+
+
+def write_summary(results: dict, stream) -> None:
+    for case in results["cases"]:
+        stream.write(
+            f"{case['tests']} tests in {case['modules']} modules ({case['mix']})\n"
+        )
+        for stage, measured in case["stages"].items():
+            line = (
+                f"    {stage:<14} {measured['wall_ns'] / 1e9:9.3f}s "
+                f"{measured['per_test_ns'] / 1000:9.1f}us/test "
+                f"{measured['peak_rss_kb'] // 1024:6d}MB peak"
+            )
+            if "overhead_per_test_ns" in measured:
+                line += f"  overhead {measured['overhead_per_test_ns'] / 1000:.1f}us/test"
+            stream.write(line + "\n")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Benchmark smalltest's discovery, runners and reporter",
+    )
+    parser.add_argument(
+        "--tests", type=int, nargs="+", default=[1000, 10000, 100000],
+        help="total tests in each generated tree",
+    )
+    parser.add_argument(
+        "--per-module", type=int, nargs="+", default=[10, 100],
+        help="tests in each generated module",
+    )
+    parser.add_argument(
+        "--mix", choices=MIXES, nargs="+", default=MIXES,
+        help="kind of tests to generate",
+    )
+    parser.add_argument(
+        "--stages", choices=STAGES, nargs="+", default=STAGES,
+        help="stages to time",
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None,
+        help="worker processes for the parallel runner",
+    )
+    parser.add_argument(
+        "--worker-startup", action="store_true",
+        help="measure the worker import time saved by preloading instead",
+    )
+    parser.add_argument(
+        "--capture-overhead", action="store_true",
+        help="measure the per-test overhead of each capture mode instead",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    # Used internally to run a single stage in a fresh interpreter
+    parser.add_argument(
+        "--stage", choices=[*STAGES, "worker_startup"], help=argparse.SUPPRESS
+    )
+    parser.add_argument("--tree", help=argparse.SUPPRESS)
+    parser.add_argument("--start-method", help=argparse.SUPPRESS)
+    parser.add_argument("--preload", nargs="*", default=[], help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    args = get_parser().parse_args(argv)
+
+    if args.stage == "worker_startup":
+        measured = run_worker_startup(
+            Path(args.tree), args.processes, args.start_method, args.preload
+        )
+        print(json.dumps(measured))
+        return
+    if args.stage:
+        measured = run_stage(args.stage, Path(args.tree), args.processes)
+        print(json.dumps(measured))
+        return
+
+    results = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cases": [],
+    }
+    if args.worker_startup:
+        results["worker_startup"] = measure_worker_startup(args.processes or 4)
+        write_worker_startup(results["worker_startup"], sys.stdout)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    if args.capture_overhead:
+        results["capture_overhead"] = measure_capture_overhead()
+        write_capture_overhead(results["capture_overhead"], sys.stdout)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    for test_count in args.tests:
+        for tests_per_module in args.per_module:
+            for mix in args.mix:
+                results["cases"].append(run_case(
+                    test_count, tests_per_module, mix, args.stages, args.processes
+                ))
+
+    write_summary(results, sys.stdout)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        sys.stdout.write("\n")
+        write_comparison(baseline, results, sys.stdout)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
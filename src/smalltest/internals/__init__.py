@@ -1 +1,5 @@
-from rewrite_assert_statements import rewrite_assert
+from .assert_loader import (
+    AssertRewritingLoader,
+    set_cache_folder,
+    REWRITE_FOLDER_NAME,
+)
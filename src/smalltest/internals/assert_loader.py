@@ -0,0 +1,155 @@
+"""
+Load test modules with their assert statements rewritten.
+
+Rewriting a module costs a parse and a compile. The rewritten bytecode is
+stored in the cache folder, keyed by the source hash, the module path and
+the interpreter's cache tag, so the rewrite only happens again when the test
+file changes. Interpreters with different cache tags sharing a checkout keep
+their own bytecode side by side. Forked parallel workers read the same
+store. Nothing is stored until a cache folder is set, as discover_run_report
+does unless caching is turned off.
+
+The rewritten code calls back into this module to explain a failure, it is
+kept free of heavy imports as it is loaded on every run.
+"""
+import importlib.machinery
+import importlib.util
+import marshal
+import os
+import sys
+
+from pathlib import Path
+from types import CodeType
+from typing import Any, Optional
+
+from smalltest.util import content_hash
+
+# Bump when the rewritten output changes so old cached bytecode is ignored
+REWRITE_VERSION = 2
+REWRITE_FOLDER_NAME = "assert_rewrite"
+
+MAX_VALUE_LENGTH = 200
+
+
+class _Unset:
+    """Value of an intermediate that was never evaluated due to short circuiting"""
+    def __repr__(self):
+        return "<not evaluated>"
+
+
+UNSET = _Unset()
+
+# Folder for the rewritten bytecode, None to rewrite on every import.
+# Set before the parallel workers start so forked workers share it.
+cache_folder: Optional[Path] = None
+
+
+def set_cache_folder(folder: Optional[Path]) -> None:
+    """
+    Set where rewritten bytecode is stored.
+
+    :param folder: cache folder, None to not read or write rewritten bytecode
+    """
+    global cache_folder
+    cache_folder = folder
+
+
+def _value_repr(value: Any) -> str:
+    try:
+        text = repr(value)
+    except Exception as e:
+        text = (f"<{type(value).__qualname__} object "
+                f"- repr failed with {e.__class__.__qualname__}>")
+    if len(text) > MAX_VALUE_LENGTH:
+        text = f"{text[:MAX_VALUE_LENGTH]}..."
+    return text
+
+
+def explain(source: str, texts: tuple, values: tuple, message: Any = UNSET) -> Any:
+    """
+    Build the message for a failed assert, called by the rewritten code.
+
+    An assert with a message and nothing worth showing, such as
+    'assert False, "message"', keeps the message as it is.
+
+    :param source: source of the assert test expression
+    :param texts: source of each intermediate expression
+    :param values: value of each intermediate expression
+    :param message: the assert message if one was given
+    :return: text for the AssertionError
+    """
+    value_lines = []
+    seen = {source}
+    for text, value in zip(texts, values):
+        if text in seen or value is UNSET:
+            continue
+        seen.add(text)
+        value_lines.append(f"  {text} = {_value_repr(value)}")
+
+    if message is UNSET:
+        return "\n".join([f"assert {source}", *value_lines])
+    if not value_lines:
+        return message
+    return "\n".join([str(message), f"assert {source}", *value_lines])
+
+
+def _cache_prefix(path: str) -> str:
+    # Code objects hold their filename so the path is part of the key
+    return f"{Path(path).stem}-{content_hash(os.fsencode(path))[:8]}"
+
+
+def _cache_suffix(version: Any = REWRITE_VERSION) -> str:
+    return f".{sys.implementation.cache_tag}-v{version}.pyc"
+
+
+def _cache_path(folder: Path, source: bytes, path: str) -> Path:
+    return folder / (
+        f"{_cache_prefix(path)}.{content_hash(source)}{_cache_suffix()}"
+    )
+
+
+def get_rewritten_code(source: bytes, path: str) -> CodeType:
+    """
+    Get the rewritten code for a test module, from the cache folder if it
+    was rewritten before.
+
+    :param source: source of the test module
+    :param path: path of the test module
+    :return: compiled code with the asserts rewritten
+    """
+    if cache_folder is not None:
+        cached = _cache_path(cache_folder, source, path)
+        try:
+            data = cached.read_bytes()
+            if data[:4] == importlib.util.MAGIC_NUMBER:
+                return marshal.loads(data[4:])
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    # The AST transform is only imported when something needs rewriting
+    from .rewrite_assert_statements import compile_rewritten
+
+    code = compile_rewritten(source, path)
+    if cache_folder is None:
+        return code
+    try:
+        cache_folder.mkdir(parents=True, exist_ok=True)
+        # Drop this interpreter's bytecode for older versions of this file
+        for old in cache_folder.glob(f"{_cache_prefix(path)}.*{_cache_suffix('*')}"):
+            if old != cached:
+                old.unlink(missing_ok=True)
+        tmp_path = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(importlib.util.MAGIC_NUMBER + marshal.dumps(code))
+        os.replace(tmp_path, cached)
+    except OSError:
+        pass
+    return code
+
+
+class AssertRewritingLoader(importlib.machinery.SourceFileLoader):
+    """Loader for test modules that rewrites their assert statements"""
+    def get_code(self, fullname: str) -> CodeType:
+        if sys.flags.optimize:
+            # asserts are stripped anyway
+            return super().get_code(fullname)
+        return get_rewritten_code(self.get_data(self.path), self.path)
@@ -1,9 +1,154 @@
 """
 Inspect the inside of test functions and convert plain 'assert' statements
 into something more useful.
+
+Each 'assert' in a test module is replaced with an 'if not' check that keeps
+the value of every intermediate expression, so a failing 'assert a == b'
+reports the values of a and b rather than an AssertionError with no
+arguments.
+
+This module is only imported to rewrite a test module that isn't in the
+bytecode store, see assert_loader.
 """
 import ast
 
+from types import CodeType
+
+# Module the rewritten code calls to explain a failure
+HELPER_MODULE = "smalltest.internals.assert_loader"
+
+# Names that can't be written in python source so they never clash
+HELPER_NAME = "@smalltest_ar"
+TEMP_PREFIX = "@smalltest_"
+
+
+class AssertRewriter(ast.NodeTransformer):
+    """Replace assert statements with checks that keep intermediate values"""
+    def __init__(self):
+        self.counter = 0
+        self.captured: list[tuple[str, str]] = []
+
+    def _capture(self, node: ast.expr, text: str) -> ast.expr:
+        name = f"{TEMP_PREFIX}{self.counter}"
+        self.counter += 1
+        self.captured.append((text, name))
+        return ast.NamedExpr(target=ast.Name(name, ast.Store()), value=node)
+
+    def _expression(self, node: ast.expr) -> ast.expr:
+        """Rewrite an expression so its interesting parts are kept"""
+        text = ast.unparse(node)
+        match node:
+            case ast.Compare():
+                node.left = self._expression(node.left)
+                node.comparators = [self._expression(c) for c in node.comparators]
+            case ast.BoolOp():
+                node.values = [self._expression(v) for v in node.values]
+            case ast.UnaryOp():
+                node.operand = self._expression(node.operand)
+            case ast.BinOp():
+                node.left = self._expression(node.left)
+                node.right = self._expression(node.right)
+            case ast.Call():
+                node.args = [
+                    arg if isinstance(arg, ast.Starred) else self._expression(arg)
+                    for arg in node.args
+                ]
+                for keyword in node.keywords:
+                    keyword.value = self._expression(keyword.value)
+            case ast.Name() | ast.Attribute() | ast.Subscript():
+                pass
+            case _:
+                # Constants aren't worth showing and names bound inside
+                # lambdas and comprehensions would be out of scope.
+                return node
+        return self._capture(node, text)
+
+    def visit_Assert(self, node: ast.Assert) -> list[ast.stmt]:
+        self.captured = []
+        source = ast.unparse(node.test)
+        test = self._expression(node.test)
+
+        texts = [ast.Constant(text) for text, _ in self.captured]
+        names = [ast.Name(name, ast.Load()) for _, name in self.captured]
+        explain_args = [
+            ast.Constant(source),
+            ast.Tuple(texts, ast.Load()),
+            ast.Tuple(names, ast.Load()),
+        ]
+        if node.msg is not None:
+            explain_args.append(node.msg)
+
+        statements = []
+        if self.captured:
+            # Short circuited parts of the test are never assigned
+            statements.append(ast.Assign(
+                targets=[ast.Name(name, ast.Store()) for _, name in self.captured],
+                value=ast.Attribute(
+                    ast.Name(HELPER_NAME, ast.Load()), "UNSET", ast.Load()
+                ),
+            ))
+        statements.append(ast.If(
+            test=ast.UnaryOp(ast.Not(), test),
+            body=[ast.Raise(
+                exc=ast.Call(
+                    ast.Name("AssertionError", ast.Load()),
+                    args=[ast.Call(
+                        ast.Attribute(
+                            ast.Name(HELPER_NAME, ast.Load()), "explain", ast.Load()
+                        ),
+                        args=explain_args,
+                        keywords=[],
+                    )],
+                    keywords=[],
+                ),
+                cause=None,
+            )],
+            orelse=[],
+        ))
+        for statement in statements:
+            ast.copy_location(statement, node)
+        return statements
+
+
+def rewrite_assert(tree: ast.Module) -> ast.Module:
+    """
+    Rewrite every assert statement in a parsed module.
+
+    :param tree: parsed module, modified in place
+    :return: the same tree
+    """
+    if not any(isinstance(node, ast.Assert) for node in ast.walk(tree)):
+        return tree
+
+    AssertRewriter().visit(tree)
+
+    # The helper import goes after the docstring and any __future__ imports
+    position = 0
+    for position, statement in enumerate(tree.body):
+        is_docstring = (
+            position == 0
+            and isinstance(statement, ast.Expr)
+            and isinstance(statement.value, ast.Constant)
+            and isinstance(statement.value.value, str)
+        )
+        is_future = (
+            isinstance(statement, ast.ImportFrom)
+            and statement.module == "__future__"
+        )
+        if not (is_docstring or is_future):
+            break
+    else:
+        position = len(tree.body)
+
+    helper_import = ast.Import(
+        names=[ast.alias(HELPER_MODULE, HELPER_NAME)]
+    )
+    tree.body.insert(position, helper_import)
+    ast.fix_missing_locations(tree)
+    return tree
+
 
-def rewrite_assert(test_path):
-    pass
+def compile_rewritten(source: bytes, path: str) -> CodeType:
+    """Parse, rewrite and compile the source of a test module"""
+    tree = rewrite_assert(ast.parse(source, filename=path))
+    return compile(tree, path, "exec", dont_inherit=True)
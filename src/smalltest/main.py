@@ -1,21 +1,23 @@
 """
 Perform the various combinations of discovering and running tests
+
+Startup time matters for short runs so the runners, reporters and optional
+features are only imported once they are needed.
 """
+import argparse
 import sys
-import traceback
 
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from enum import Enum
 from io import StringIO
 from pathlib import Path
-from typing import TextIO, Optional, Union
+from typing import Callable, Iterable, TextIO, Optional, Union, TYPE_CHECKING
+
+from smalltest.util import get_cache_folder
 
-from smalltest.suite import (
-    discover_tests,
-    run_tests_serial,
-    text_reporter,
-    ResultType
-)
+if TYPE_CHECKING:
+    from smalltest.suite import TestResult
+    from smalltest.suite.capture import CaptureOptions
 
 
 class ExitCode(Enum):
@@ -29,81 +31,303 @@ class ExitCode(Enum):
     NO_TESTS_FOUND = 6
 
 
+class RunnerError(Exception):
+    """Wrap errors raised by the test runner to tell them apart from
+    errors raised by the reporter consuming the results"""
+
+
+def _runner_errors(test_results: Iterable[tuple[str, "TestResult"]]):
+    try:
+        yield from test_results
+    except Exception as e:
+        raise RunnerError() from e
+
+
+def _print_exception(e: BaseException, stream: TextIO) -> None:
+    import traceback
+    traceback.print_exception(e, file=stream)
+
+
 @contextmanager
-def coverage_if_available(omit: list[str]):
-    """Wrap the tests in coverage if the module is installed"""
+def coverage_if_available(omit: list[str], parallel: bool = False):
+    """
+    Wrap the tests in coverage if the module is installed
+
+    In parallel mode coverage isn't started in this process, instead the
+    worker options are given for each worker to write its own data file.
+    Those files are combined here once the run is finished.
+
+    :param omit: file patterns to leave out of the report
+    :param parallel: measure coverage in the worker processes
+    :return: (report output or None, worker coverage options or None)
+    """
     try:
         import coverage
     except ImportError:
-        yield None
-    else:
-        # Don't measure smalltest code unless testing smalltest
-        if 'smalltest' not in omit[0]:
-            omit.append("*/smalltest/*")
-        cov = coverage.Coverage(omit=omit)
+        yield None, None
+        return
+
+    # Don't measure smalltest code unless testing smalltest
+    if 'smalltest' not in omit[0]:
+        omit.append("*/smalltest/*")
+    cov = coverage.Coverage(omit=omit)
+    cov_output = StringIO()
+
+    if not parallel:
         cov.start()
-        cov_output = StringIO()
-        yield cov_output
+        yield cov_output, None
         cov.stop()
-        cov.save()
-        cov.report(file=cov_output, show_missing=True)
+    else:
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as data_folder:
+            worker_options = {
+                "data_file": str(Path(data_folder) / ".coverage"),
+                "omit": omit,
+            }
+            yield cov_output, worker_options
+            # Workers killed before they could save leave nothing to combine
+            if any(Path(data_folder).iterdir()):
+                cov.combine(data_paths=[data_folder])
+
+    cov.save()
+    # Tests may import modules from temporary files that are gone by now
+    cov.report(file=cov_output, show_missing=True, ignore_errors=True)
 
 
 def discover_run_report(
         base_path: Optional[Union[str, Path]] = None,
         strict_xfail: bool = False,
         stream: TextIO = sys.stdout,
-        runner=run_tests_serial,
+        runner: Optional[Callable] = None,
+        durations: int = 0,
+        timings_path: Optional[Union[str, Path]] = None,
+        use_cache: bool = True,
+        processes: Optional[int] = None,
+        threads: Optional[int] = None,
+        serve_address: Optional[str] = None,
+        authkey: Optional[str] = None,
+        async_concurrency: Optional[int] = None,
+        maxfail: Optional[int] = None,
+        timeout: Optional[float] = None,
+        changed_only: bool = False,
+        explain_selection: bool = False,
+        last_failed: bool = False,
+        failed_first: bool = False,
+        use_coverage: bool = True,
+        start_method: Optional[str] = None,
+        preload: Iterable[str] = (),
+        capture: Optional["CaptureOptions"] = None,
+        junit_xml_path: Optional[Union[str, Path]] = None,
+        json_lines_path: Optional[Union[str, Path]] = None,
 ) -> ExitCode:
     """
     Discover tests, run the tests, print a report to stream output
     :param base_path:
     :param strict_xfail: fail if tests xpass
     :param stream: file-like text stream
-    :param runner: Test runner
+    :param runner: Test runner, run_tests_serial if not given
+    :param durations: number of slowest tests and modules to report
+    :param timings_path: file to export the timings of every test to
+    :param use_cache: use and update the .smalltest_cache folder
+    :param processes: worker processes for the parallel runner
+    :param threads: threads for the threaded runner
+    :param serve_address: "host:port" or Unix socket path the distributed
+                          runner serves its workers on
+    :param authkey: key shared with the distributed workers,
+                    SMALLTEST_AUTHKEY if None
+    :param async_concurrency: most async tests running at once in the
+                              serial runner
+    :param maxfail: stop the run after this many failures or errors
+    :param timeout: per-test timeout in seconds for the parallel and
+                    distributed runners
+    :param changed_only: only run test modules affected by changes since
+                         they last passed
+    :param explain_selection: write why each test module was selected
+    :param last_failed: only run the tests that failed in the previous run,
+                        other modules are not discovered or imported
+    :param failed_first: run the tests that failed in the previous run first
+    :param use_coverage: measure coverage if the coverage module is installed
+    :param start_method: how the parallel runner starts its workers
+    :param preload: modules to import once before parallel workers start
+    :param capture: how the output of each test is captured, python level
+                    capture dropping the output of passing tests if None
+    :param junit_xml_path: file to write a JUnit XML report to
+    :param json_lines_path: file to write every result to as JSON Lines
     :return Exitcode:
     """
+    from smalltest.internals import set_cache_folder, REWRITE_FOLDER_NAME
+    from smalltest.suite.discover import discover_tests
+    from smalltest.suite.lastfailed import ResultCache, RESULTS_FILE_NAME
+    from smalltest.suite.report import (
+        JSONLinesReport,
+        JUnitXMLReport,
+        text_reporter,
+        TimingReport,
+    )
+    from smalltest.suite.run import (
+        ResultType,
+        run_tests_distributed,
+        run_tests_parallel,
+        run_tests_serial,
+        run_tests_threaded,
+    )
+    from smalltest.suite.schedule import DurationStore, DURATIONS_FILE_NAME
+
+    if runner is None:
+        runner = run_tests_serial
+
+    cache_folder = get_cache_folder(base_path)
+    set_cache_folder(cache_folder / REWRITE_FOLDER_NAME if use_cache else None)
+    result_cache = ResultCache(
+        cache_folder / RESULTS_FILE_NAME if use_cache else None
+    )
+
     # Discover Tests
+    test_imports = {} if changed_only else None
+    # Parameters of each test for its fixtures, last failed tests aren't
+    # parsed so their runner reads them from the functions
+    test_args = {}
     try:
-        tests = discover_tests(base_path)
+        tests = None
+        if last_failed:
+            tests = result_cache.last_failed_tests(imports=test_imports)
+            if tests:
+                failed_count = sum(len(test_names) for test_names in tests.values())
+                stream.write(f"Running {failed_count} tests that failed last run\n")
+            else:
+                stream.write("No failures recorded, running all tests\n")
+        if not tests:
+            tests = discover_tests(
+                base_path,
+                use_index=use_cache,
+                imports=test_imports,
+                test_args=test_args,
+            )
     except Exception as e:
-        traceback.print_exception(e)
+        _print_exception(e, stream)
         return ExitCode.ERROR_DISCOVERY
 
     if not tests:
         return ExitCode.NO_TESTS_FOUND
 
+    selector = None
+    if changed_only:
+        from smalltest.suite.depgraph import ChangeSelector, STATE_FILE_NAME
+        selector = ChangeSelector(
+            cache_folder.parent,
+            cache_folder / STATE_FILE_NAME if use_cache else None,
+        )
+        try:
+            tests = selector.select(tests, test_imports)
+        except Exception as e:
+            _print_exception(e, stream)
+            return ExitCode.ERROR_DISCOVERY
+        if explain_selection:
+            selector.write_explanation(stream)
+        if not tests:
+            stream.write("No tests affected by changes since the last run\n")
+            selector.save()
+            return ExitCode.SUCCESS
+
+    run_first = None
+    if failed_first:
+        tests = result_cache.failed_first(tests)
+        run_first = result_cache.failed_names()
+
     # Don't give coverage of the tests themselves
     omit = list(str(module) for module in tests.keys())
 
     # Setup Coverage Before Import
-    if runner is run_tests_serial:
-        with coverage_if_available(omit) as cov_output:
-            try:
-                test_results = runner(tests, stream=stream)
-            except Exception as e:
-                traceback.print_exception(e)
-                return ExitCode.ERROR_RUN
+    if not use_coverage:
+        coverage_context = nullcontext((None, None))
+    elif runner in (run_tests_serial, run_tests_threaded):
+        # Coverage also traces threads started after it
+        coverage_context = coverage_if_available(omit)
+    elif runner is run_tests_parallel:
+        coverage_context = coverage_if_available(omit, parallel=True)
     else:
-        cov_output = None
+        coverage_context = nullcontext((None, None))
+
+    duration_store = DurationStore(
+        cache_folder / DURATIONS_FILE_NAME if use_cache else None
+    )
+
+    runner_options = {}
+    if maxfail is not None:
+        runner_options["maxfail"] = maxfail
+    if runner in (
+            run_tests_serial,
+            run_tests_parallel,
+            run_tests_threaded,
+            run_tests_distributed,
+    ):
+        runner_options["test_args"] = test_args
+    if runner is run_tests_threaded:
+        runner_options["threads"] = threads
+    if runner is run_tests_serial and async_concurrency is not None:
+        runner_options["async_concurrency"] = async_concurrency
+    if runner is run_tests_parallel:
+        runner_options["processes"] = processes
+        runner_options["durations"] = duration_store
+        runner_options["timeout"] = timeout
+        runner_options["run_first"] = run_first
+        runner_options["start_method"] = start_method
+        runner_options["preload"] = list(preload)
+    if runner is run_tests_distributed:
+        from smalltest.suite.distributed import parse_address
+        if serve_address is not None:
+            runner_options["address"] = parse_address(serve_address)
+        runner_options["authkey"] = authkey
+        runner_options["timeout"] = timeout
+    if capture is not None:
+        runner_options["capture"] = capture
+
+    timing_report = TimingReport(
+        slowest=durations,
+        export_path=Path(timings_path) if timings_path else None,
+    )
+
+    file_reports = []
+    if junit_xml_path:
+        file_reports.append(JUnitXMLReport(Path(junit_xml_path), strict_xfail))
+    if json_lines_path:
+        file_reports.append(JSONLinesReport(Path(json_lines_path)))
+
+    # The runner yields results as the tests finish and the reporter
+    # consumes them as they arrive, so both happen inside the same block.
+    with coverage_context as (cov_output, worker_coverage):
+        if worker_coverage is not None:
+            runner_options["coverage_options"] = worker_coverage
         try:
-            test_results = runner(tests, stream=stream)
-        except Exception as e:
-            traceback.print_exception(e)
+            test_results = _runner_errors(
+                runner(tests, stream=stream, **runner_options)
+            )
+            test_results = duration_store.record(test_results)
+            test_results = result_cache.record(test_results, tests)
+            if selector is not None:
+                test_results = selector.record(test_results)
+            for file_report in file_reports:
+                test_results = file_report.record(test_results)
+            report = text_reporter(
+                timing_report.record(test_results),
+                stream=stream,
+                strict_xfail=strict_xfail
+            )
+            timing_report.write_report(stream)
+        except RunnerError as e:
+            _print_exception(e.__cause__, stream)
             return ExitCode.ERROR_RUN
+        except Exception as e:
+            _print_exception(e, stream)
+            return ExitCode.ERROR_REPORT
+        finally:
+            # Keep whatever durations were recorded, even for a partial run
+            duration_store.save()
+            result_cache.save()
+            if selector is not None:
+                selector.save()
 
-    # Report results of tests
-    try:
-        report = text_reporter(
-            test_results,
-            stream=stream,
-            strict_xfail=strict_xfail
-        )
-    except Exception as e:
-        traceback.print_exception(e)
-        return ExitCode.ERROR_REPORT
-
-    if report[ResultType.ERROR] > 0:
+    if report[ResultType.ERROR] > 0 or report[ResultType.TIMEOUT] > 0:
         return ExitCode.ERROR_TESTS
     if report[ResultType.FAILURE] > 0:
         return ExitCode.FAILED_TESTS
@@ -117,10 +341,292 @@ def discover_run_report(
     return ExitCode.SUCCESS
 
 
-def main():
+def get_parser() -> argparse.ArgumentParser:
+    from smalltest.suite.capture import CAPTURE_MODES, MAX_CAPTURE_LENGTH
+
+    parser = argparse.ArgumentParser(
+        prog="smalltest",
+        description="Discover and run plain test_* functions",
+    )
+    parser.add_argument(
+        "-p", "--parallel",
+        action="store_true",
+        help="run the tests across a pool of worker processes",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        metavar="N",
+        help="number of worker processes for --parallel",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        metavar="N",
+        help="run the tests on N threads in this process, for tests that "
+             "wait on I/O. Session fixtures are shared by the threads, "
+             "module fixtures are set up by each thread",
+    )
+    parser.add_argument(
+        "--serve",
+        default=None,
+        metavar="ADDRESS",
+        help="serve the tests to workers started with 'smalltest worker "
+             "ADDRESS', ADDRESS is host:port or a Unix socket path",
+    )
+    parser.add_argument(
+        "--authkey",
+        default=None,
+        help="key shared with the --serve workers, SMALLTEST_AUTHKEY if "
+             "not given",
+    )
+    parser.add_argument(
+        "--async-concurrency",
+        type=int,
+        default=None,
+        metavar="N",
+        help="run at most N async tests of a module at once, they share "
+             "one event loop",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="per-test timeout for --parallel and --serve, hung workers "
+             "are replaced",
+    )
+    parser.add_argument(
+        "--start-method",
+        choices=["fork", "forkserver", "spawn"],
+        default=None,
+        help="how --parallel starts its workers, the platform default if not given",
+    )
+    parser.add_argument(
+        "--preload",
+        action="append",
+        default=[],
+        metavar="MODULE",
+        help="import MODULE once before the --parallel workers start, "
+             "can be repeated",
+    )
+    parser.add_argument(
+        "--capture",
+        choices=CAPTURE_MODES,
+        default="sys",
+        help="capture output from python only (sys), also from C extensions "
+             "and subprocesses (fd), or not at all (none)",
+    )
+    parser.add_argument(
+        "--capture-limit",
+        type=int,
+        default=MAX_CAPTURE_LENGTH,
+        metavar="N",
+        help="characters of stdout and stderr kept from each test",
+    )
+    parser.add_argument(
+        "--keep-output",
+        action="store_true",
+        help="keep the captured output of passing tests",
+    )
+    parser.add_argument(
+        "-x", "--exitfirst",
+        action="store_const",
+        const=1,
+        dest="maxfail",
+        help="stop the run after the first failure or error",
+    )
+    parser.add_argument(
+        "--maxfail",
+        type=int,
+        default=None,
+        metavar="N",
+        help="stop the run after N failures or errors",
+    )
+    parser.add_argument(
+        "--lf", "--last-failed",
+        action="store_true",
+        dest="last_failed",
+        help="only run the tests that failed last run, or all if none failed",
+    )
+    parser.add_argument(
+        "--ff", "--failed-first",
+        action="store_true",
+        dest="failed_first",
+        help="run the tests that failed last run before the rest",
+    )
+    parser.add_argument(
+        "--changed",
+        action="store_true",
+        help="only run test modules affected by changes since they last passed",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="with --changed, show why each test module was selected",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, rerun the tests affected by each saved change",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write the .smalltest_cache folder",
+    )
+    parser.add_argument(
+        "--no-coverage",
+        action="store_true",
+        help="don't measure coverage even if the coverage module is installed",
+    )
+    parser.add_argument(
+        "--durations",
+        type=int,
+        default=0,
+        metavar="N",
+        help="report the N slowest tests and modules",
+    )
+    parser.add_argument(
+        "--timings-file",
+        default=None,
+        metavar="PATH",
+        help="export the timings of every test as JSON Lines",
+    )
+    parser.add_argument(
+        "--junit-xml",
+        default=None,
+        metavar="PATH",
+        help="also write a JUnit XML report of every test",
+    )
+    parser.add_argument(
+        "--json-lines",
+        default=None,
+        metavar="PATH",
+        help="also write every result with its output as JSON Lines",
+    )
+    return parser
+
+
+def get_worker_parser() -> argparse.ArgumentParser:
+    from smalltest.suite.distributed import WORKER_RETRY_TIME
+
+    parser = argparse.ArgumentParser(
+        prog="smalltest worker",
+        description="Run the tests served by 'smalltest --serve ADDRESS'",
+    )
+    parser.add_argument(
+        "address",
+        metavar="ADDRESS",
+        help="host:port or Unix socket path of the coordinator",
+    )
+    parser.add_argument(
+        "--authkey",
+        default=None,
+        help="key shared with the coordinator, SMALLTEST_AUTHKEY if not given",
+    )
+    parser.add_argument(
+        "--root",
+        default=None,
+        metavar="PATH",
+        help="checkout the test module paths are relative to, the current "
+             "directory if not given",
+    )
+    parser.add_argument(
+        "--retry-for",
+        type=float,
+        default=WORKER_RETRY_TIME,
+        metavar="SECONDS",
+        help="keep trying to reach the coordinator for this long",
+    )
+    return parser
+
+
+def worker_main(argv: list[str]):
+    """Entry point for `smalltest worker`"""
+    from multiprocessing import AuthenticationError
+    from smalltest.suite.distributed import parse_address, serve_worker
+
+    parser = get_worker_parser()
+    args = parser.parse_args(argv)
+    root = Path(args.root) if args.root else Path.cwd()
+    # Test modules import their neighbours as the coordinator would
+    sys.path.insert(0, str(root.absolute()))
+    try:
+        serve_worker(parse_address(args.address), args.authkey, root, args.retry_for)
+    except (AuthenticationError, ValueError, OSError) as e:
+        parser.exit(ExitCode.ERROR_RUN.value, f"smalltest worker: {e}\n")
+    except KeyboardInterrupt:
+        pass
+    sys.exit(ExitCode.SUCCESS.value)
+
+
+def main(argv: Optional[list[str]] = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["worker"]:
+        worker_main(argv[1:])
+
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if sum([args.parallel, args.threads is not None, args.serve is not None]) > 1:
+        parser.error("only one of --parallel, --threads and --serve can be used")
+
     # Include the current directory as first in sys.path
     sys.path.insert(0, str(Path.cwd()))
-    result = discover_run_report()
+
+    if args.watch:
+        from smalltest.suite.watch import watch_tests
+        try:
+            watch_tests(use_index=not args.no_cache)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(ExitCode.SUCCESS.value)
+
+    from smalltest.suite.capture import CaptureOptions
+    from smalltest.suite.run import (
+        run_tests_distributed,
+        run_tests_parallel,
+        run_tests_serial,
+        run_tests_threaded,
+    )
+    if args.serve is not None:
+        runner = run_tests_distributed
+    elif args.parallel:
+        runner = run_tests_parallel
+    elif args.threads is not None:
+        runner = run_tests_threaded
+    else:
+        runner = run_tests_serial
+    result = discover_run_report(
+        runner=runner,
+        durations=args.durations,
+        timings_path=args.timings_file,
+        junit_xml_path=args.junit_xml,
+        json_lines_path=args.json_lines,
+        use_cache=not args.no_cache,
+        processes=args.processes,
+        threads=args.threads or None,
+        serve_address=args.serve,
+        authkey=args.authkey,
+        async_concurrency=args.async_concurrency,
+        maxfail=args.maxfail,
+        timeout=args.timeout,
+        changed_only=args.changed,
+        explain_selection=args.explain,
+        last_failed=args.last_failed,
+        failed_first=args.failed_first,
+        use_coverage=not args.no_coverage,
+        start_method=args.start_method,
+        preload=args.preload,
+        capture=CaptureOptions(
+            mode=args.capture,
+            max_length=args.capture_limit,
+            keep_passing=args.keep_output,
+        ),
+    )
     sys.exit(result.value)
 
 
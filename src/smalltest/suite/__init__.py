@@ -1,3 +1,38 @@
-from .discover import discover_tests
-from .run import run_tests_serial, run_tests_parallel, ResultType
-from .report import text_reporter
+"""
+Discover, run and report on tests.
+
+Each name is imported from its submodule the first time it is used, so
+importing smalltest.suite doesn't pay for the parallel runner or the
+reporters unless they are needed.
+"""
+import importlib
+
+_LAZY_NAMES = {
+    "discover_tests": ".discover",
+    "run_tests_serial": ".run",
+    "run_tests_parallel": ".run",
+    "run_tests_threaded": ".run",
+    "run_tests_distributed": ".run",
+    "ResultType": ".run",
+    "TestResult": ".run",
+    "text_reporter": ".report",
+    "TimingReport": ".report",
+    "JUnitXMLReport": ".report",
+    "JSONLinesReport": ".report",
+}
+
+__all__ = list(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    try:
+        module_name = _LAZY_NAMES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,173 @@
+"""
+Run the async tests of a module concurrently on one event loop.
+
+The serial runner keeps a single AsyncTestRunner, and so a single event
+loop, for the whole run. Each async test, or case of a parametrized async
+test, becomes a task on that loop. At most `concurrency` tasks run at once,
+the cases of a parametrized test are only produced as earlier tasks finish.
+Tests waiting on I/O overlap, so a module of such tests takes about as long
+as its slowest test.
+
+Output and warnings are captured per task through routed_output in
+smalltest.suite.capture, asyncio gives each task its own copy of the
+context. Each task gets its own function fixtures while sharing the module
+and session fixtures of the run. Fixtures are plain functions, set up
+before the test is awaited.
+
+Results are yielded as the tasks finish. The loop only runs while the next
+result is being waited for, so nothing runs while a result is reported.
+"""
+from types import ModuleType
+from typing import Callable, Iterator, Optional, Union
+
+from .capture import CaptureOptions, record_warnings, routed_output
+from .cases import case_name, is_parametrized, iter_cases
+from .fixtures import FixtureManager
+from .run import TestResult, case_error, fixtures_for_test, run_test_async
+
+# Async tests running at once unless set otherwise
+DEFAULT_CONCURRENCY = 100
+
+# (full_test_name, async test callable), or (full_test_name, TestResult)
+# for cases that couldn't be produced
+AsyncJob = Union[tuple[str, Callable, list[str]], tuple[str, TestResult]]
+
+
+def is_async_test(test: Callable) -> bool:
+    """Check if calling the test gives a coroutine to await"""
+    import inspect
+    return inspect.iscoroutinefunction(test)
+
+
+class AsyncTestRunner:
+    """
+    Event loop shared by the async tests of a run, created on first use
+    so a run without async tests never imports asyncio.
+    """
+    def __init__(
+            self,
+            concurrency: int = DEFAULT_CONCURRENCY,
+            capture: CaptureOptions = CaptureOptions(),
+    ):
+        if concurrency < 1:
+            raise ValueError(f"Async concurrency must be at least 1, got {concurrency}")
+        self.concurrency = concurrency
+        self.capture = capture
+        self.runner = None
+
+    def _loop(self):
+        if self.runner is None:
+            import asyncio
+            self.runner = asyncio.Runner()
+        return self.runner.get_loop()
+
+    def close(self) -> None:
+        if self.runner is not None:
+            self.runner.close()
+            self.runner = None
+
+    def _jobs(
+            self,
+            module: ModuleType,
+            test_names: list[str],
+            module_args: Optional[dict[str, list[str]]],
+            fixtures: Optional[FixtureManager],
+    ) -> Iterator[AsyncJob]:
+        for test_name in test_names:
+            test = getattr(module, test_name)
+            names = []
+            if fixtures is not None:
+                names = fixtures_for_test(test, test_name, module_args)
+            if not is_parametrized(test):
+                yield test_name, test, names
+                continue
+            try:
+                for case_id, case in iter_cases(test):
+                    yield case_name(test_name, case_id), case, names
+            except Exception as e:
+                # The cases themselves couldn't be produced
+                yield test_name, case_error(e)
+
+    async def _run_one(
+            self,
+            test: Callable,
+            names: list[str],
+            fixtures: Optional[FixtureManager],
+    ) -> TestResult:
+        task_fixtures = fixtures.isolated() if names else None
+
+        async def call():
+            kwargs = task_fixtures.request(names) if names else {}
+            try:
+                await test(**kwargs)
+            finally:
+                if task_fixtures is not None:
+                    task_fixtures.teardown("function")
+
+        return await run_test_async(call, self.capture.make_concurrent(), record_warnings)
+
+    def run(
+            self,
+            module: ModuleType,
+            test_names: list[str],
+            import_time_ns: int = 0,
+            fixtures: Optional[FixtureManager] = None,
+            module_args: Optional[dict[str, list[str]]] = None,
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Run async tests from an imported module concurrently, yielding each
+        result as its task finishes.
+
+        Closing the generator early cancels the tasks still running.
+
+        :param module: imported test module
+        :param test_names: names of the async test functions to run
+        :param import_time_ns: time taken to import the module, recorded
+                               on the first result
+        :param fixtures: FixtureManager of the run, the module must already
+                         have been entered
+        :param module_args: { test_name: [parameter_name, ...] } from
+                            discovery, None to read them from each test
+        :return: iterator of (full_test_name, TestResult)
+        """
+        import asyncio
+
+        loop = self._loop()
+        module_name = module.__name__
+        jobs = self._jobs(module, test_names, module_args, fixtures)
+        # { task: full_test_name }
+        running: dict[asyncio.Task, str] = {}
+        try:
+            while True:
+                while jobs is not None and len(running) < self.concurrency:
+                    job = next(jobs, None)
+                    if job is None:
+                        jobs = None
+                    elif len(job) == 2:
+                        full_name, result = job
+                        yield f"{module_name}::{full_name}", result
+                    else:
+                        full_name, test, names = job
+                        task = loop.create_task(self._run_one(test, names, fixtures))
+                        running[task] = f"{module_name}::{full_name}"
+                if not running:
+                    break
+
+                with routed_output():
+                    done, _ = loop.run_until_complete(
+                        asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    )
+                for task in done:
+                    result = task.result()
+                    if import_time_ns:
+                        result = result._replace(import_time_ns=import_time_ns)
+                        import_time_ns = 0
+                    yield running.pop(task), result
+        finally:
+            if running:
+                for task in running:
+                    task.cancel()
+                with routed_output():
+                    loop.run_until_complete(
+                        asyncio.gather(*running, return_exceptions=True)
+                    )
@@ -0,0 +1,338 @@
+"""
+Capture the output of each test.
+
+Three strategies are available:
+    none - output goes straight to the terminal
+    sys  - sys.stdout and sys.stderr are replaced, only output written from
+           python is captured
+    fd   - file descriptors 1 and 2 are redirected to temporary files so
+           output from C extensions and subprocesses is captured too
+
+A capture is created once per runner or worker and reused for every test,
+the buffers or temporary files are emptied between tests rather than
+recreated. At most max_length characters are kept from each stream and the
+output of passing tests is dropped unless keep_passing is set.
+
+Replacing sys.stdout or the warnings hook changes them for every thread.
+Tests run concurrently in one process instead use ContextCapture and
+record_warnings inside routed_output, which installs a single proxy for
+the whole run. The proxy looks up the current test's buffers in a context
+variable, set separately by each thread or asyncio task.
+
+Warnings are recorded with the filters already in place, so a warning the
+user made an error still fails the test and one ignored by default stays
+ignored. A warning no filter matches is recorded every time it is shown,
+through an "always" filter added after the others. Otherwise a warning
+shown by one test would be hidden from every later test through the
+registry the warnings module keeps per calling module. Concurrent runs
+can't swap the filters per test, routed_output adds it once for the run.
+"""
+import io
+import os
+import sys
+import warnings
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, NamedTuple, Optional, TextIO
+
+CAPTURE_MODES = ("none", "sys", "fd")
+
+# Characters kept from each of stdout and stderr
+MAX_CAPTURE_LENGTH = 64 * 1024
+
+
+def truncated(text: str, dropped: int, unit: str = "characters") -> str:
+    """Note how much output was left out after the kept text"""
+    if not dropped:
+        return text
+    return f"{text}\n... {dropped} {unit} truncated"
+
+
+class CaptureOptions(NamedTuple):
+    """How output is captured, picklable so workers can build their own"""
+    mode: str = "sys"
+    max_length: int = MAX_CAPTURE_LENGTH
+    keep_passing: bool = False
+
+    def make(self) -> "Capture":
+        match self.mode:
+            case "none":
+                return NoCapture(self.max_length, self.keep_passing)
+            case "sys":
+                return SysCapture(self.max_length, self.keep_passing)
+            case "fd":
+                return FDCapture(self.max_length, self.keep_passing)
+        raise ValueError(f"Unknown capture mode {self.mode!r}, "
+                         f"expected one of {', '.join(CAPTURE_MODES)}")
+
+    def make_concurrent(self) -> "Capture":
+        """
+        Capture for one of several tests running at once in this process.
+        File descriptors are shared by the whole process so fd captures
+        python output only, like sys.
+        """
+        if self.mode == "none":
+            return NoCapture(self.max_length, self.keep_passing)
+        if self.mode not in CAPTURE_MODES:
+            return self.make()
+        return ContextCapture(self.max_length, self.keep_passing)
+
+
+class Capture:
+    """
+    Base capture, start before a test and stop after it to get the output.
+    """
+    def __init__(self, max_length: int = MAX_CAPTURE_LENGTH, keep_passing: bool = False):
+        self.max_length = max_length
+        self.keep_passing = keep_passing
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> tuple[str, str]:
+        """
+        Stop capturing.
+
+        :return: (stdout, stderr) written since start
+        """
+        return "", ""
+
+    def close(self) -> None:
+        pass
+
+
+class NoCapture(Capture):
+    """Leave output alone"""
+
+
+class BoundedWriter(io.StringIO):
+    """StringIO that keeps the first max_length characters written"""
+    def __init__(self, max_length: int):
+        super().__init__()
+        self.max_length = max_length
+        self.length = 0
+        self.dropped = 0
+
+    def write(self, text: str) -> int:
+        written = len(text)
+        remaining = self.max_length - self.length
+        if written > remaining:
+            self.dropped += written - max(remaining, 0)
+            text = text[:max(remaining, 0)]
+        self.length += len(text)
+        super().write(text)
+        return written
+
+    def take(self) -> str:
+        """The kept output, emptying the buffer for reuse"""
+        text = truncated(self.getvalue(), self.dropped)
+        self.seek(0)
+        self.truncate()
+        self.length = self.dropped = 0
+        return text
+
+
+class SysCapture(Capture):
+    """Replace sys.stdout and sys.stderr"""
+    def __init__(self, max_length: int = MAX_CAPTURE_LENGTH, keep_passing: bool = False):
+        super().__init__(max_length, keep_passing)
+        self.stdout = BoundedWriter(max_length)
+        self.stderr = BoundedWriter(max_length)
+        self.saved: Optional[tuple[TextIO, TextIO]] = None
+
+    def start(self) -> None:
+        self.saved = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def stop(self) -> tuple[str, str]:
+        sys.stdout, sys.stderr = self.saved
+        self.saved = None
+        return self.stdout.take(), self.stderr.take()
+
+
+class FDCapture(Capture):
+    """
+    Redirect file descriptors 1 and 2 to a temporary file each, with
+    unbuffered sys.stdout and sys.stderr writing to the same files so python
+    and C output stay in order. The files are rewound and truncated after
+    every test.
+    """
+    def __init__(self, max_length: int = MAX_CAPTURE_LENGTH, keep_passing: bool = False):
+        import tempfile
+
+        super().__init__(max_length, keep_passing)
+        self.files = [tempfile.TemporaryFile(buffering=0) for _ in range(2)]
+        self.streams = [
+            io.TextIOWrapper(
+                io.FileIO(tmp.fileno(), "wb", closefd=False),
+                encoding="utf-8",
+                errors="replace",
+                write_through=True,
+            )
+            for tmp in self.files
+        ]
+        self.saved_fds: list[int] = []
+        self.saved_streams: Optional[tuple[TextIO, TextIO]] = None
+
+    def _flush_sys(self) -> None:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (AttributeError, OSError, ValueError):
+                pass
+
+    def start(self) -> None:
+        self._flush_sys()
+        self.saved_fds = [os.dup(1), os.dup(2)]
+        for fd, tmp in zip((1, 2), self.files):
+            os.dup2(tmp.fileno(), fd)
+        self.saved_streams = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self.streams
+
+    def _read(self, tmp) -> str:
+        size = os.fstat(tmp.fileno()).st_size
+        tmp.seek(0)
+        # Up to 4 bytes per character, decoded text is cut to max_length
+        text = tmp.read(self.max_length * 4).decode("utf-8", errors="replace")
+        kept = text[:self.max_length]
+        dropped = max(size - len(kept.encode("utf-8", errors="replace")), 0)
+        tmp.seek(0)
+        tmp.truncate()
+        return truncated(kept, dropped, "bytes")
+
+    def stop(self) -> tuple[str, str]:
+        self._flush_sys()
+        sys.stdout, sys.stderr = self.saved_streams
+        self.saved_streams = None
+        for fd, saved in zip((1, 2), self.saved_fds):
+            os.dup2(saved, fd)
+            os.close(saved)
+        self.saved_fds = []
+        stdout, stderr = (self._read(tmp) for tmp in self.files)
+        return stdout, stderr
+
+    def close(self) -> None:
+        for stream in self.streams:
+            stream.close()
+        for tmp in self.files:
+            tmp.close()
+
+
+# (stdout, stderr) buffers of the test running in the current context
+_context_output: ContextVar[Optional[tuple[BoundedWriter, BoundedWriter]]] = ContextVar(
+    "smalltest_output", default=None
+)
+
+# Warnings shown by the test running in the current context
+_context_warnings: ContextVar[Optional[list[warnings.WarningMessage]]] = ContextVar(
+    "smalltest_warnings", default=None
+)
+
+
+class RoutedStream:
+    """
+    Stand in for sys.stdout or sys.stderr that writes to the buffer of the
+    test running in the current context, or to the original stream outside
+    of a test.
+    """
+    def __init__(self, original: TextIO, index: int):
+        self.original = original
+        self.index = index
+
+    def _target(self) -> TextIO:
+        output = _context_output.get()
+        return output[self.index] if output is not None else self.original
+
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def writelines(self, lines) -> None:
+        self._target().writelines(lines)
+
+    def flush(self) -> None:
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+
+# warnings.showwarning from before routed_output replaced it
+_original_show_warning = warnings.showwarning
+
+
+def _show_warning(message, category, filename, lineno, file=None, line=None):
+    """warnings.showwarning routing warnings to the current context"""
+    recorded = _context_warnings.get()
+    if recorded is None:
+        _original_show_warning(message, category, filename, lineno, file, line)
+    else:
+        recorded.append(
+            warnings.WarningMessage(message, category, filename, lineno, file, line)
+        )
+
+
+@contextmanager
+def catch_all_warnings() -> Iterator[list[warnings.WarningMessage]]:
+    """
+    Record the warnings shown inside, including those shown before, for a
+    test running alone.
+    """
+    with warnings.catch_warnings(record=True) as recorded:
+        # After the existing filters so they still apply
+        warnings.simplefilter("always", append=True)
+        yield recorded
+
+
+@contextmanager
+def routed_output() -> Iterator[None]:
+    """
+    Route sys.stdout, sys.stderr and shown warnings to the test running in
+    each context for the duration of a run.
+    """
+    global _original_show_warning
+    saved = sys.stdout, sys.stderr
+    with warnings.catch_warnings():
+        # Shared by every test running at once, see the module docstring
+        warnings.simplefilter("always", append=True)
+        _original_show_warning = warnings.showwarning
+        sys.stdout, sys.stderr = RoutedStream(sys.stdout, 0), RoutedStream(sys.stderr, 1)
+        warnings.showwarning = _show_warning
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = saved
+
+
+@contextmanager
+def record_warnings() -> Iterator[list[warnings.WarningMessage]]:
+    """
+    Record the warnings shown in the current context, the context safe
+    version of catch_all_warnings. Only records inside routed_output.
+    """
+    recorded: list[warnings.WarningMessage] = []
+    token = _context_warnings.set(recorded)
+    try:
+        yield recorded
+    finally:
+        _context_warnings.reset(token)
+
+
+class ContextCapture(Capture):
+    """
+    Capture the python output of the test running in the current context,
+    only captures inside routed_output. Each thread needs its own.
+    """
+    def __init__(self, max_length: int = MAX_CAPTURE_LENGTH, keep_passing: bool = False):
+        super().__init__(max_length, keep_passing)
+        self.output = BoundedWriter(max_length), BoundedWriter(max_length)
+        self.token = None
+
+    def start(self) -> None:
+        self.token = _context_output.set(self.output)
+
+    def stop(self) -> tuple[str, str]:
+        _context_output.reset(self.token)
+        self.token = None
+        stdout, stderr = self.output
+        return stdout.take(), stderr.take()
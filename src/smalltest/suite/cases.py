@@ -0,0 +1,174 @@
+"""
+Expand parametrized tests into their cases as they run.
+
+A test decorated with smalltest.tools.parametrize is discovered as a single
+test function. Its cases are only produced while the test runs and each one
+is reported as module::test_name[case_id]. Nothing holds the full list of
+cases, a generator of a million cases is run one case at a time.
+
+The parallel runner hands out the cases of a test CASE_BATCH_SIZE at a time.
+A worker that takes a chunk with cases left over tells the parent before
+running it, and the parent queues the rest of the test for the next free
+worker.
+
+A worker taking a chunk before the place its cursor has reached, the rest of
+a chunk whose worker was lost, produces the cases again from the start. Cases
+from a one-shot iterator can't be produced again, so the chunk is reported as
+an error instead of the cases going missing.
+"""
+from functools import partial
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from smalltest.tools import PARAMETRIZE_ATTRIBUTE
+
+# Cases of a parametrized test run by a worker before the rest is requeued
+CASE_BATCH_SIZE = 100
+
+# Longest case id made from a value
+MAX_ID_LENGTH = 40
+
+
+def is_parametrized(test: Callable) -> bool:
+    return bool(getattr(test, PARAMETRIZE_ATTRIBUTE, None))
+
+
+def case_name(test_name: str, case_id: str) -> str:
+    return f"{test_name}[{case_id}]"
+
+
+def case_test_name(name: str) -> str:
+    """Name of the test a case belongs to, the name itself for other tests"""
+    return name.partition("[")[0]
+
+
+def _value_id(argname: str, value: Any, index: int) -> str:
+    """Short id for a value, the argument name and index for anything complex"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        text = str(value)
+        if len(text) <= MAX_ID_LENGTH and "]" not in text:
+            return text
+    return f"{argname}{index}"
+
+
+def _param_cases(
+        argnames: list[str],
+        argvalues: Any,
+        ids: Optional[Any],
+) -> Iterator[tuple[str, dict[str, Any]]]:
+    """(case_id, {argname: value}) for each case of a single parametrize"""
+    values = argvalues() if callable(argvalues) else argvalues
+    id_iter = iter(ids) if ids is not None and not callable(ids) else None
+
+    for index, value in enumerate(values):
+        if len(argnames) == 1:
+            kwargs = {argnames[0]: value}
+        else:
+            value = tuple(value)
+            if len(value) != len(argnames):
+                raise ValueError(
+                    f"Case {index} has {len(value)} values "
+                    f"for {len(argnames)} names {argnames}"
+                )
+            kwargs = dict(zip(argnames, value))
+
+        case_id = None
+        if callable(ids):
+            case_id = str(ids(value))
+        elif id_iter is not None:
+            case_id = next((str(given) for given in id_iter), None)
+        if case_id is None:
+            case_id = "-".join(
+                _value_id(argname, argvalue, index)
+                for argname, argvalue in kwargs.items()
+            )
+        yield case_id, kwargs
+
+
+def iter_cases(test: Callable) -> Iterator[tuple[str, Callable[[], Any]]]:
+    """
+    Produce the cases of a parametrized test one at a time.
+
+    :param test: test function decorated with parametrize
+    :return: iterator of (case_id, zero argument callable running the case)
+    """
+    first, *rest = getattr(test, PARAMETRIZE_ATTRIBUTE)
+    # Repeated for every case of the first so read into lists once
+    rest_cases = [list(_param_cases(*params)) for params in rest]
+
+    def combine(case_id: str, kwargs: dict, remaining: list[list]) -> Iterator:
+        if not remaining:
+            yield case_id, partial(test, **kwargs)
+            return
+        for other_id, other_kwargs in remaining[0]:
+            yield from combine(
+                f"{case_id}-{other_id}", {**kwargs, **other_kwargs}, remaining[1:]
+            )
+
+    for case_id, kwargs in _param_cases(*first):
+        yield from combine(case_id, kwargs, rest_cases)
+
+
+def can_repeat_cases(test: Callable) -> bool:
+    """
+    Check if the cases of a parametrized test can be produced again, not if
+    any argvalues or ids are a one-shot iterator such as a generator.
+    """
+    return all(
+        callable(given) or iter(given) is not given
+        for _, argvalues, ids in getattr(test, PARAMETRIZE_ATTRIBUTE)
+        for given in (argvalues, ids)
+        if given is not None
+    )
+
+
+class CaseCursor:
+    """
+    Position in the cases of a parametrized test.
+
+    Workers keep a cursor for each test so a later chunk of the same test
+    carries on from where the last one stopped instead of starting over.
+    """
+    def __init__(self, test: Callable):
+        self.test = test
+        self.cases: Iterator = iter_cases(test)
+        self.position = 0
+        self._next: Optional[tuple[str, Callable]] = None
+
+    def _advance(self) -> Optional[tuple[str, Callable]]:
+        if self._next is not None:
+            case, self._next = self._next, None
+            return case
+        return next(self.cases, None)
+
+    def take(self, offset: int, count: int) -> Iterable[tuple[int, str, Callable]]:
+        """
+        Cases from offset onwards, at most count of them.
+
+        :return: iterator of (case_offset, case_id, case_callable)
+        """
+        if offset < self.position:
+            if not can_repeat_cases(self.test):
+                raise ValueError(
+                    f"Cases {offset} to {offset + count - 1} of "
+                    f"{self.test.__name__} were passed over and can't be produced "
+                    f"again from a one-shot iterator, parametrize with a list "
+                    f"or a callable to rerun them"
+                )
+            self.cases = iter_cases(self.test)
+            self.position = 0
+            self._next = None
+        while self.position < offset and self._advance() is not None:
+            self.position += 1
+
+        for _ in range(count):
+            case = self._advance()
+            if case is None:
+                return
+            yield self.position, *case
+            self.position += 1
+
+    def more(self) -> bool:
+        """Check if there are cases after the last one taken"""
+        if self._next is None:
+            self._next = next(self.cases, None)
+        return self._next is not None
@@ -0,0 +1,341 @@
+"""
+Select only the test modules affected by changes since the last run.
+
+Every module a test module imports is resolved to a file in the project
+using the same static parse that finds the test names. Following those
+imports gives the set of local files each test module depends on. The
+content hash of every file in that set is stored after a test module
+passes, and on the next run only test modules with a changed, added or
+removed dependency are selected.
+
+Only imports that can be seen in the source are followed, so a module
+loaded with importlib or by reading a data file is not tracked.
+"""
+import ast
+import sys
+
+from collections import Counter, deque
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, TextIO, Union
+
+from smalltest.util import content_hash, read_json, write_json
+from .discover import find_imports
+from .run import FAILED_RESULTS, TestResult
+
+STATE_VERSION = 1
+STATE_FILE_NAME = "dependencies.json"
+
+
+def module_search_roots(base_path: Path) -> list[Path]:
+    """
+    Folders absolute imports may resolve to a project file from.
+
+    The base path itself, a 'src' folder if there is one and any entry on
+    sys.path that is inside the base path. Packages installed elsewhere
+    are never part of the project so are never tracked.
+
+    :param base_path: Search path root of the test run
+    :return: [folder, ...]
+    """
+    base_path = base_path.absolute()
+    roots = [base_path]
+    if (base_path / "src").is_dir():
+        roots.append(base_path / "src")
+    for entry in sys.path:
+        folder = Path(entry or ".").absolute()
+        if folder.is_relative_to(base_path) and folder not in roots:
+            roots.append(folder)
+    return roots
+
+
+def _module_files(folder: Path, parts: list[str]) -> list[Path]:
+    """
+    Files for a dotted module found relative to a folder, each package
+    on the way contributes its __init__.py as importing a submodule
+    runs it.
+    """
+    files = []
+    for part in parts:
+        folder = folder / part
+        package_init = folder / "__init__.py"
+        if package_init.is_file():
+            files.append(package_init)
+            continue
+        module_file = folder.with_suffix(".py")
+        if module_file.is_file():
+            # Names after a module are attributes rather than submodules
+            files.append(module_file)
+            break
+        if not folder.is_dir():
+            break
+    return files
+
+
+class DependencyGraph:
+    """
+    Resolved imports between the python files of a project.
+
+    Files are hashed every run but only parsed again if the hash differs
+    from the cached value. Test modules can be given their imports from
+    discovery so they are never parsed twice.
+    """
+    def __init__(self, roots: list[Path], file_cache: Optional[dict] = None):
+        self.roots = roots
+        # { path: {"hash": content_hash, "imports": [[name, level], ...]} }
+        self.file_cache: dict[str, dict] = file_cache if file_cache is not None else {}
+        self.hashes: dict[Path, Optional[str]] = {}
+        self.imports: dict[Path, list] = {}
+        self._resolved: dict[tuple, list[Path]] = {}
+
+    def file_hash(self, pth: Path) -> Optional[str]:
+        """Content hash of a file, None if it can't be read"""
+        if pth not in self.hashes:
+            try:
+                self.hashes[pth] = content_hash(pth.read_bytes())
+            except OSError:
+                self.hashes[pth] = None
+        return self.hashes[pth]
+
+    def imports_of(self, pth: Path) -> list:
+        """[(module_name, level), ...] imported by a file"""
+        if pth in self.imports:
+            return self.imports[pth]
+
+        key = str(pth)
+        source_hash = self.file_hash(pth)
+        entry = self.file_cache.get(key)
+        if entry is not None and entry["hash"] == source_hash:
+            imports = entry["imports"]
+        elif source_hash is None:
+            imports = []
+        else:
+            try:
+                imports = find_imports(ast.parse(pth.read_bytes()))
+            except (OSError, SyntaxError, ValueError):
+                imports = []
+            self.file_cache[key] = {
+                "hash": source_hash,
+                "imports": [list(module_import) for module_import in imports],
+            }
+        self.imports[pth] = imports
+        return imports
+
+    def resolve(self, importer: Path, module_name: str, level: int) -> list[Path]:
+        """
+        Local files run by an import statement in importer.
+
+        :param importer: path of the importing file
+        :param module_name: dotted module name, empty for 'from . import x'
+        :param level: number of leading dots, 0 for an absolute import
+        :return: [path, ...] of project files, empty for anything external
+        """
+        folder = importer.parent
+        key = (folder, module_name, level)
+        if key in self._resolved:
+            return self._resolved[key]
+
+        parts = module_name.split(".") if module_name else []
+        if level:
+            package = folder
+            for _ in range(level - 1):
+                package = package.parent
+            files = _module_files(package, parts)
+            if not parts and (package / "__init__.py").is_file():
+                files.append(package / "__init__.py")
+        else:
+            files = []
+            # Test modules are imported from their own folder first
+            for root in [folder, *self.roots]:
+                files = _module_files(root, parts)
+                if files:
+                    break
+
+        self._resolved[key] = files
+        return files
+
+    def dependencies(self, pth: Path) -> list[Path]:
+        """Project files directly imported by a file"""
+        found = {}
+        for module_name, level in self.imports_of(pth):
+            for dependency in self.resolve(pth, module_name, level):
+                if dependency != pth:
+                    found[dependency] = None
+        return list(found)
+
+    def closure(self, pth: Path) -> dict[Path, Optional[Path]]:
+        """
+        Every project file a file depends on, directly or indirectly.
+
+        :param pth: path of the starting file
+        :return: { dependency: file that imported it, ... } with the
+                 starting file included mapped to None
+        """
+        parents: dict[Path, Optional[Path]] = {pth: None}
+        queue = deque([pth])
+        while queue:
+            current = queue.popleft()
+            for dependency in self.dependencies(current):
+                if dependency not in parents:
+                    parents[dependency] = current
+                    queue.append(dependency)
+        return parents
+
+
+class ChangeSelector:
+    """
+    Select the test modules whose dependencies changed since they last
+    passed and record which modules pass in this run.
+
+    Modules are selected as a whole, a module is only marked as passing
+    once every one of its tests has run without failing.
+    """
+    def __init__(self, base_path: Union[str, Path], state_path: Optional[Path] = None):
+        self.base_path = Path(base_path).absolute()
+        self.state_path = state_path
+
+        data = read_json(state_path, default={}) if state_path is not None else {}
+        if data.get("version") == STATE_VERSION:
+            file_cache = data.get("files", {})
+            self.modules: dict[str, dict[str, str]] = data.get("modules", {})
+        else:
+            file_cache = {}
+            self.modules = {}
+
+        self.graph = DependencyGraph(module_search_roots(self.base_path), file_cache)
+
+        # Details of the current run
+        self.total = 0
+        self.selected: dict[Path, list[str]] = {}
+        self.reasons: dict[Path, str] = {}
+        self._snapshots: dict[str, dict[str, str]] = {}
+        self._counts: Counter = Counter()
+        self._failures: set[str] = set()
+
+    def _display(self, pth: Path) -> str:
+        if pth.is_relative_to(self.base_path):
+            return str(pth.relative_to(self.base_path))
+        return str(pth)
+
+    def _chain(self, parents: dict[Path, Optional[Path]], pth: Path) -> str:
+        chain = []
+        current: Optional[Path] = pth
+        while current is not None:
+            chain.append(self._display(current))
+            current = parents[current]
+        return " <- ".join(chain)
+
+    def select(
+            self,
+            test_dict: dict[Path, list[str]],
+            test_imports: Optional[dict[Path, list]] = None,
+    ) -> dict[Path, list[str]]:
+        """
+        Filter discovered tests down to the modules affected by changes.
+
+        :param test_dict: { module: [test_name, ...] } from discover_tests
+        :param test_imports: { module: [(module_name, level), ...] } from
+                             the same discovery, parsed here if missing
+        :return: { module: [test_name, ...] } of the affected modules
+        """
+        self.total = len(test_dict)
+        test_paths = {pth: pth.absolute() for pth in test_dict}
+        if test_imports:
+            for pth, imports in test_imports.items():
+                if pth in test_paths:
+                    self.graph.imports[test_paths[pth]] = imports
+
+        for pth, test_names in test_dict.items():
+            if not test_names:
+                continue
+            module_path = test_paths[pth]
+            parents = self.graph.closure(module_path)
+            snapshot = {
+                str(dependency): self.graph.file_hash(dependency)
+                for dependency in parents
+            }
+            key = str(module_path)
+            self._snapshots[key] = snapshot
+
+            previous = self.modules.get(key)
+            if previous is None:
+                reason = "new or not passed since changes were tracked"
+            else:
+                changed = [
+                    dependency for dependency in parents
+                    if previous.get(str(dependency)) != snapshot[str(dependency)]
+                ]
+                if changed:
+                    reason = "changed: " + self._chain(parents, changed[0])
+                    if len(changed) > 1:
+                        reason += f" (and {len(changed) - 1} more)"
+                elif previous.keys() - snapshot.keys():
+                    removed = sorted(previous.keys() - snapshot.keys())[0]
+                    reason = f"no longer imports {self._display(Path(removed))}"
+                else:
+                    continue
+
+            self.selected[pth] = test_names
+            self.reasons[pth] = reason
+
+        return self.selected
+
+    def write_explanation(self, stream: TextIO) -> None:
+        """Write why each test module was selected"""
+        stream.write(
+            f"Selected {len(self.selected)} of {self.total} test modules "
+            f"affected by changes\n"
+        )
+        for pth, reason in self.reasons.items():
+            stream.write(f"    {self._display(pth.absolute())}: {reason}\n")
+
+    def record(
+            self,
+            test_results: Iterable[tuple[str, TestResult]]
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Track which modules ran every test without a failure and pass
+        each result on unchanged.
+
+        :param test_results: Results from a test run as (test_name, TestResult)
+        :return: iterator of the same (test_name, TestResult)
+        """
+        for test_name, test_result in test_results:
+            module_name = test_name.partition("::")[0]
+            self._counts[module_name] += 1
+            if test_result.result_type in FAILED_RESULTS:
+                self._failures.add(module_name)
+            yield test_name, test_result
+
+    def save(self) -> None:
+        """Store the dependencies of every module that passed in this run"""
+        for pth, test_names in self.selected.items():
+            module_name = pth.stem
+            if (
+                module_name not in self._failures
+                and self._counts[module_name] >= len(test_names)
+            ):
+                key = str(pth.absolute())
+                self.modules[key] = self._snapshots[key]
+
+        # Forget test modules that were not discovered this run
+        discovered = self._snapshots.keys()
+        self.modules = {
+            key: value for key, value in self.modules.items() if key in discovered
+        }
+
+        if self.state_path is None:
+            return
+        try:
+            write_json(
+                self.state_path,
+                {
+                    "version": STATE_VERSION,
+                    "files": {
+                        key: value for key, value in self.graph.file_cache.items()
+                        if Path(key) in self.graph.hashes
+                    },
+                    "modules": self.modules,
+                }
+            )
+        except OSError:
+            pass
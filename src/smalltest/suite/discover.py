@@ -1,17 +1,32 @@
 """
 Discover the paths and the names of each test that needs to run.
 
-This uses a simple pathlib glob to recursively search for test files.
+This uses a single os.scandir walk to recursively search for test files.
 Using the ast module it then finds any defined functions with names that
-start with the test prefix.
+start with the test prefix. The names found are kept in an on-disk index
+so unchanged files are not parsed again on the next run.
 """
-import ast
+import fnmatch
+import functools
+import os
+import re
 from pathlib import Path
-from typing import Optional, Union
+from typing import Callable, Optional, Union, TYPE_CHECKING
+
+from smalltest.util import CACHE_FOLDER_NAME, content_hash, get_cache_folder
+from .index import DiscoveryIndex, INDEX_FILE_NAME
+
+if TYPE_CHECKING:
+    import ast
 
 # When python 3.11 is released make this customizable from pyproject.toml
 TEST_FOLDER_NAMES = ["tests"]
 TEST_FILE_NAMES = ["test_*.py", "*_test.py"]
+IGNORE_FOLDER_NAMES = [
+    ".git", ".hg", ".svn", ".tox", ".nox", ".venv", "venv",
+    "__pycache__", "build", "dist", "*.egg-info", "node_modules",
+    CACHE_FOLDER_NAME,
+]
 
 
 # noinspection PyDefaultArgument
@@ -19,7 +34,8 @@ def discover_test_modules(
         base_path: Optional[Union[str, Path]] = None,
         *,
         test_file_names: list[str] = TEST_FILE_NAMES,
-        test_folder_names: list[str] = TEST_FOLDER_NAMES
+        test_folder_names: list[str] = TEST_FOLDER_NAMES,
+        ignore_folder_names: list[str] = IGNORE_FOLDER_NAMES,
 ) -> list[Path]:
     """
     Search base_path for files matching test_file_names patterns.
@@ -27,50 +43,255 @@ def discover_test_modules(
     any files matching test_file_names patterns.
     Return a list of matching files.
 
+    The tree is walked once with os.scandir, every file is checked against
+    all of the patterns and folders matching ignore_folder_names are never
+    entered.
+
     :param base_path: Path to start the search for test modules and folders
     :param test_file_names: glob wildcard filename patterns for test modules
     :param test_folder_names: foldernames in base_path to recursively search
+    :param ignore_folder_names: glob wildcard foldernames to skip
     :return: [Path(test_module), ...]
     """
     base_path = Path(base_path) if base_path else Path.cwd()
 
+    file_match = _compile_patterns(test_file_names)
+    ignore_match = _compile_patterns(ignore_folder_names)
+
     test_files = []
-    for file_name in test_file_names:
-        test_files.extend(base_path.glob(file_name))
-        for folder in test_folder_names:
-            test_files.extend(base_path.glob(f"{folder}/**/{file_name}"))
+    test_folders = []
+    for entry in _sorted_scandir(base_path):
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name in test_folder_names and not ignore_match(entry.name):
+                test_folders.append(entry.path)
+        elif file_match(entry.name):
+            test_files.append(Path(entry.path))
+
+    # Depth first walk of the test folders, pruning ignored folders
+    for folder in test_folders:
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            subfolders = []
+            for entry in _sorted_scandir(current):
+                if entry.is_dir(follow_symlinks=False):
+                    if not ignore_match(entry.name):
+                        subfolders.append(entry.path)
+                elif file_match(entry.name):
+                    test_files.append(Path(entry.path))
+            stack.extend(reversed(subfolders))
 
     return test_files
 
 
+def _compile_patterns(patterns: list[str]) -> Callable[[str], Optional[re.Match]]:
+    """Combine glob wildcard patterns into a single name matching function"""
+    if not patterns:
+        return lambda name: None
+    regex = "|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns)
+    return re.compile(regex).match
+
+
+def _sorted_scandir(folder: Union[str, Path]) -> list[os.DirEntry]:
+    """Folder entries in name order so discovery order is stable"""
+    try:
+        with os.scandir(folder) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+
+def find_test_names(source: bytes, test_prefix: str = "test_") -> list[str]:
+    """
+    Parse python source and find the names of all module level functions
+    that match the test prefix.
+
+    :param source: python source of a test module
+    :param test_prefix: prefix for test functions
+    :return: [test_function_name, ...]
+    """
+    test_names, _, _ = parse_test_module(source, test_prefix)
+    return test_names
+
+
+def parse_test_module(
+        source: bytes,
+        test_prefix: str = "test_"
+) -> tuple[list[str], list[tuple[str, int]], dict[str, list[str]]]:
+    """
+    Parse python source and find the names of all module level functions
+    that match the test prefix along with every module the source imports
+    and the parameters each test takes.
+
+    :param source: python source of a test module
+    :param test_prefix: prefix for test functions
+    :return: [test_function_name, ...], [(module_name, level), ...],
+             {test_function_name: [parameter_name, ...]} for tests that
+             take parameters
+    """
+    # Module level functions must start at the beginning of a line,
+    # if nothing can match skip the cost of the full parse.
+    if not _prefilter(test_prefix).search(source):
+        return [], [], {}
+
+    # Only imported once a file needs parsing, a warm index never does
+    import ast
+
+    # Parse the source of the text file into an AST
+    tree = ast.parse(source)
+
+    # Only care about module level functions, including async functions,
+    # that start with test_prefix
+    # Anything more complicated is currently beyond the scope of smalltest
+    test_functions = [
+        testfunc for testfunc in tree.body
+        if isinstance(testfunc, (ast.FunctionDef, ast.AsyncFunctionDef))
+        and testfunc.name.startswith(test_prefix)
+    ]
+    test_names = [testfunc.name for testfunc in test_functions]
+    test_args = {}
+    for testfunc in test_functions:
+        parameters = find_parameters(testfunc)
+        if parameters:
+            test_args[testfunc.name] = parameters
+    return test_names, find_imports(tree), test_args
+
+
+def find_parameters(function: Union["ast.FunctionDef", "ast.AsyncFunctionDef"]) -> list[str]:
+    """
+    Names of the parameters of a function definition without a default,
+    the fixtures and parametrized values a test asks for.
+    """
+    arguments = function.args
+    positional = [arg.arg for arg in arguments.posonlyargs + arguments.args]
+    if arguments.defaults:
+        positional = positional[:len(positional) - len(arguments.defaults)]
+    keyword_only = [
+        arg.arg for arg, default in zip(arguments.kwonlyargs, arguments.kw_defaults)
+        if default is None
+    ]
+    return positional + keyword_only
+
+
+def find_imports(tree: "ast.AST") -> list[tuple[str, int]]:
+    """
+    Find every module imported anywhere in a parsed module.
+
+    'from a import b' gives both 'a' and 'a.b' as b may be a submodule.
+    Relative imports keep their level so they can be resolved against the
+    importing file.
+
+    :param tree: parsed module
+    :return: [(module_name, level), ...] with level 0 for absolute imports
+    """
+    import ast
+
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            imports.extend((alias.name, 0) for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            module_name = node.module or ""
+            imports.append((module_name, node.level))
+            for alias in node.names:
+                if alias.name != "*":
+                    submodule = f"{module_name}.{alias.name}" if module_name else alias.name
+                    imports.append((submodule, node.level))
+    return list(dict.fromkeys(imports))
+
+
+@functools.cache
+def _prefilter(test_prefix: str) -> re.Pattern[bytes]:
+    """Byte pattern for a line that could define a module level test"""
+    return re.compile(
+        rb"^\f*(?:async[ \t]+)?def[ \t]+" + re.escape(test_prefix.encode()),
+        re.MULTILINE
+    )
+
+
+def _collect_file(
+        pth: Path,
+        test_prefix: str
+) -> tuple[str, list[str], list[tuple[str, int]], dict[str, list[str]]]:
+    """
+    Read and parse a single test file giving
+    (content_hash, test_names, imports, test_args)
+    """
+    source = pth.read_bytes()
+    return content_hash(source), *parse_test_module(source, test_prefix)
+
+
 def discover_test_functions(
         test_files: list[Path],
         *,
-        test_prefix: str = "test_"
+        test_prefix: str = "test_",
+        index: Optional[DiscoveryIndex] = None,
+        parallel: bool = False,
+        processes: Optional[int] = None,
+        imports: Optional[dict[Path, list[tuple[str, int]]]] = None,
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
 ) -> dict[Path, list[str]]:
     """
     Use the abstract syntax tree of the source in the test files to find the
     name of all the functions that match the test prefix.
 
+    If an imports dictionary is given it is filled with the modules imported
+    by each test file as found by the same parse. A test_args dictionary is
+    filled with the parameters of each test that takes any.
+
+    In parallel mode the files that are not in the index are read and parsed
+    across a pool of processes in chunks. The result is in the same order as
+    test_files in either mode.
+
     :param test_files: paths to python test module
     :param test_prefix: prefix for test functions
+    :param index: discovery index to skip parsing unchanged files
+    :param parallel: parse the files across a pool of processes
+    :param processes: Number of worker processes, None for the CPU count
+    :param imports: dictionary to fill with {test_path: [(module_name, level), ...]}
+    :param test_args: dictionary to fill with
+                      {test_path: {test_function_name: [parameter_name, ...]}}
     :return: {test_path: [test_function_name, ...]}
     """
-
-    test_functions: dict[Path, list[str]] = {}
+    found: dict[Path, list[str]] = {}
+    to_parse: list[Path] = []
     for pth in test_files:
-        # Parse the source of the text file into an AST
-        tree = ast.parse(pth.read_text())
+        entry = index.get(pth) if index is not None else None
+        if entry is None:
+            to_parse.append(pth)
+        else:
+            found[pth], module_imports, module_args = entry
+            if imports is not None:
+                imports[pth] = module_imports
+            if test_args is not None:
+                test_args[pth] = module_args
+
+    if parallel and len(to_parse) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = processes or os.cpu_count() or 1
+        chunksize = max(1, len(to_parse) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            collected = pool.map(
+                functools.partial(_collect_file, test_prefix=test_prefix),
+                to_parse,
+                chunksize=chunksize,
+            )
+            collected = list(collected)
+    else:
+        collected = [_collect_file(pth, test_prefix) for pth in to_parse]
 
-        # Only care about module level functions that start with test_prefix
-        # Anything more complicated is currently beyond the scope of smalltest
-        test_functions[pth] = [
-            testfunc.name for testfunc in tree.body
-            if isinstance(testfunc, ast.FunctionDef)
-            and testfunc.name.startswith(test_prefix)
-        ]
+    for pth, (source_hash, test_names, module_imports, module_args) in zip(to_parse, collected):
+        found[pth] = test_names
+        if imports is not None:
+            imports[pth] = module_imports
+        if test_args is not None:
+            test_args[pth] = module_args
+        if index is not None:
+            index.update(pth, source_hash, test_names, module_imports, module_args)
 
-    return test_functions
+    # Keep the order of the test files regardless of where names came from
+    return {pth: found[pth] for pth in test_files}
 
 
 # noinspection PyDefaultArgument
@@ -79,7 +300,13 @@ def discover_tests(
         *,
         test_file_names: list[str] = TEST_FILE_NAMES,
         test_folder_names: list[str] = TEST_FOLDER_NAMES,
+        ignore_folder_names: list[str] = IGNORE_FOLDER_NAMES,
         test_prefix: str = "test_",
+        use_index: bool = True,
+        parallel: bool = False,
+        processes: Optional[int] = None,
+        imports: Optional[dict[Path, list[tuple[str, int]]]] = None,
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
 ) -> dict[Path, list[str]]:
     """
     Search base_path for test files as discover_test_modules.
@@ -89,14 +316,40 @@ def discover_tests(
     :param base_path: Search path root
     :param test_file_names: glob wildcard filename patterns for test modules
     :param test_folder_names: exact foldernames in base_path to recursively search
+    :param ignore_folder_names: glob wildcard foldernames to skip
     :param test_prefix: prefix for test functions
+    :param use_index: use the on-disk index to skip parsing unchanged files
+    :param parallel: parse the test files across a pool of processes
+    :param processes: Number of worker processes, None for the CPU count
+    :param imports: dictionary to fill with {test_path: [(module_name, level), ...]}
+    :param test_args: dictionary to fill with
+                      {test_path: {test_function_name: [parameter_name, ...]}}
     :return: {test_path: [test_function_name, ...]}
     """
     test_files = discover_test_modules(base_path,
                                        test_file_names=test_file_names,
-                                       test_folder_names=test_folder_names
+                                       test_folder_names=test_folder_names,
+                                       ignore_folder_names=ignore_folder_names,
                                        )
-    test_dict = discover_test_functions(test_files, test_prefix=test_prefix)
+    if use_index:
+        index_path = get_cache_folder(base_path) / INDEX_FILE_NAME
+        index = DiscoveryIndex(index_path, test_prefix=test_prefix)
+    else:
+        index = None
+
+    test_dict = discover_test_functions(
+        test_files,
+        test_prefix=test_prefix,
+        index=index,
+        parallel=parallel,
+        processes=processes,
+        imports=imports,
+        test_args=test_args,
+    )
+
+    if index is not None:
+        index.save()
+
     return test_dict
 
 
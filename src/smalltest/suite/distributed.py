@@ -0,0 +1,449 @@
+"""
+Run tests on workers spread across machines.
+
+A Coordinator listens on a TCP address or Unix socket and serves the
+batches of a run to whichever workers connect. Workers are started with
+`smalltest worker ADDRESS`, on any machine with a checkout of the project,
+and keep pulling batches until the coordinator has none left. Batches and
+results use the same messages as the parallel runner's pipes, see
+smalltest.suite.workers, over multiprocessing.connection. A worker is first
+sent ("config", CaptureOptions) when it connects.
+
+Module paths are sent relative to the coordinator's root and resolved
+against each worker's root so the checkouts don't need the same location.
+
+Both ends must share an authkey, given with --authkey or the
+SMALLTEST_AUTHKEY environment variable. Connections are authenticated with
+it before any message is read, the messages themselves are pickles. Each
+connection is authenticated on a thread of its own within HANDSHAKE_TIMEOUT,
+so a client that connects and sends nothing doesn't hold up other workers.
+
+A worker that disconnects part way through a test has that test recorded as
+an error and the rest of its batch requeued for another worker. A test past
+its timeout is recorded the same way as a timeout and its worker is dropped.
+Workers can connect, or be lost, at any point in the run. The run fails if
+no worker is connected for connect_timeout seconds.
+"""
+import os
+import queue
+import threading
+import time
+import traceback
+
+from collections import Counter, deque
+from multiprocessing import Pipe
+from multiprocessing.connection import (
+    AuthenticationError,
+    Client,
+    Connection,
+    Listener,
+    answer_challenge,
+    deliver_challenge,
+    wait,
+)
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from .capture import CaptureOptions
+from .fixtures import FixtureManager
+from .run import ResultType, TestResult
+from .workers import (
+    BatchItem,
+    WorkerError,
+    WorkerHandle,
+    handle_message,
+    lost_test,
+    run_worker_batch,
+)
+
+AUTHKEY_ENVIRONMENT = "SMALLTEST_AUTHKEY"
+
+# Seconds the coordinator waits with no worker connected before failing
+CONNECT_TIMEOUT = 60.0
+
+# Seconds a connection has to complete the authkey handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+# Seconds a worker keeps trying to reach a coordinator that isn't up yet
+WORKER_RETRY_TIME = 30.0
+RETRY_INTERVAL = 0.1
+
+# Workers lost while loading a module before the module is given up on
+MAX_BATCH_LOSSES = 3
+
+Address = Union[tuple[str, int], str]
+
+
+def parse_address(text: str) -> Address:
+    """
+    Address from the command line: "host:port" for TCP, anything else is
+    the path of a Unix socket.
+    """
+    host, _, port = text.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return text
+
+
+def format_address(address: Address) -> str:
+    if isinstance(address, tuple):
+        host, port = address
+        return f"{host}:{port}"
+    return address
+
+
+def get_authkey(authkey: Optional[Union[str, bytes]] = None) -> bytes:
+    """The authkey given, or from SMALLTEST_AUTHKEY"""
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENVIRONMENT)
+    if not authkey:
+        raise ValueError(
+            f"Distributed runs need an authkey, pass one or set {AUTHKEY_ENVIRONMENT}"
+        )
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class _TimedConnection:
+    """
+    Connection for the authkey handshake that gives up waiting for the
+    other end at a deadline.
+    """
+    def __init__(self, conn: Connection, timeout: float):
+        self.conn = conn
+        self.deadline = time.monotonic() + timeout
+
+    def send_bytes(self, data: bytes) -> None:
+        self.conn.send_bytes(data)
+
+    def recv_bytes(self, maxlength: Optional[int] = None) -> bytes:
+        if not self.conn.poll(max(self.deadline - time.monotonic(), 0)):
+            raise AuthenticationError("No answer to the authkey handshake")
+        return self.conn.recv_bytes(maxlength)
+
+
+class RemoteWorker(WorkerHandle):
+    """Coordinator side handle for a connected worker"""
+    def close(self) -> None:
+        """Tell the worker there is nothing more to run"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class Coordinator:
+    """
+    Accept workers on an address and serve them batches of tests.
+
+    Workers are accepted on a background thread from the moment the
+    coordinator is created, so workers can be started once `address` is
+    known, such as after listening on port 0.
+    """
+    def __init__(
+            self,
+            address: Address,
+            authkey: Optional[Union[str, bytes]] = None,
+            root: Optional[Path] = None,
+    ):
+        self.authkey = get_authkey(authkey)
+        self.root = Path(root if root is not None else Path.cwd()).absolute()
+        # No authkey here, connections are authenticated by _authenticate
+        self.listener = Listener(address)
+        self.address: Address = self.listener.address
+        self.workers: list[RemoteWorker] = []
+
+        # Accepted connections, and a pipe to wake the serving loop for them
+        self.accepted: queue.Queue[Connection] = queue.Queue()
+        self.wake_recv, self.wake_send = Pipe(duplex=False)
+        # Held while handing over a connection or closing
+        self.accept_lock = threading.Lock()
+        self.closing = False
+        self.accept_thread = threading.Thread(
+            target=self._accept, name="smalltest-accept", daemon=True
+        )
+        self.accept_thread.start()
+
+    def _accept(self) -> None:
+        while not self.closing:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # Listener closed
+                return
+            if self.closing:
+                conn.close()
+                return
+            threading.Thread(
+                target=self._authenticate,
+                args=(conn,),
+                name="smalltest-handshake",
+                daemon=True,
+            ).start()
+
+    def _authenticate(self, conn: Connection) -> None:
+        """Check a new connection has the authkey before admitting it"""
+        timed = _TimedConnection(conn, HANDSHAKE_TIMEOUT)
+        try:
+            deliver_challenge(timed, self.authkey)
+            answer_challenge(timed, self.authkey)
+        except Exception:
+            # Failed authentication, a broken handshake or no answer
+            conn.close()
+            return
+        with self.accept_lock:
+            if self.closing:
+                conn.close()
+                return
+            self.accepted.put(conn)
+            self.wake_send.send(None)
+
+    def _admit(self, capture: CaptureOptions) -> None:
+        """Add the workers accepted since the last call"""
+        while True:
+            try:
+                conn = self.accepted.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.send(("config", capture))
+            except OSError:
+                conn.close()
+                continue
+            self.workers.append(RemoteWorker(conn))
+
+    def _wire_path(self, module_path: Path) -> Path:
+        """Module path as sent to workers, relative to the root if inside it"""
+        absolute = Path(module_path).absolute()
+        if absolute.is_relative_to(self.root):
+            return absolute.relative_to(self.root)
+        return absolute
+
+    def _drop(
+            self,
+            worker: RemoteWorker,
+            message: str,
+            pending: deque,
+            losses: Counter,
+    ) -> Optional[tuple[str, TestResult]]:
+        """Remove a worker, requeueing its batch and recording any lost test"""
+        self.workers.remove(worker)
+        worker.conn.close()
+        if not worker.busy:
+            return None
+        if worker.test_name is not None:
+            return lost_test(worker, ResultType.ERROR, message, pending)
+
+        # Lost outside a test, the batch can be retried unless the module
+        # itself keeps taking workers down
+        losses[worker.module_path] += 1
+        if losses[worker.module_path] >= MAX_BATCH_LOSSES:
+            raise WorkerError(
+                f"{losses[worker.module_path]} workers lost while "
+                f"loading {worker.module_path}: {message}"
+            )
+        pending.appendleft((worker.module_path, list(worker.remaining)))
+        worker.finish_batch()
+        return None
+
+    def run(
+            self,
+            batches: list[tuple[Path, list[BatchItem]]],
+            timeout: Optional[float] = None,
+            capture: CaptureOptions = CaptureOptions(),
+            test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+            connect_timeout: float = CONNECT_TIMEOUT,
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Serve the batches to the connected workers, yielding results in the
+        order the tests finish.
+
+        :param batches: [(module_path, [test_name, ...]), ...]
+        :param timeout: Default per-test timeout in seconds, None for no limit
+        :param capture: How the workers capture the output of each test
+        :param test_args: { module_path: { test_name: [parameter_name, ...] } }
+                          from discovery, None for workers to read them
+        :param connect_timeout: seconds to wait while no worker is connected
+        :return: iterator of (full_test_name, TestResult)
+        """
+        pending = deque(
+            (self._wire_path(module_path), items) for module_path, items in batches
+        )
+        wire_args = None
+        if test_args is not None:
+            wire_args = {
+                self._wire_path(module_path): module_args
+                for module_path, module_args in test_args.items()
+            }
+        losses: Counter = Counter()
+        last_connected = time.monotonic()
+
+        while pending or any(worker.busy for worker in self.workers):
+            self._admit(capture)
+            for worker in list(self.workers):
+                if worker.busy or not pending:
+                    continue
+                batch = pending.popleft()
+                try:
+                    worker.assign(
+                        batch,
+                        wire_args.get(batch[0]) if wire_args is not None else None,
+                    )
+                except OSError:
+                    worker.finish_batch()
+                    pending.appendleft(batch)
+                    self._drop(worker, "Worker disconnected", pending, losses)
+
+            now = time.monotonic()
+            if self.workers:
+                last_connected = now
+            elif now - last_connected > connect_timeout:
+                raise WorkerError(
+                    f"No workers connected to {format_address(self.address)} "
+                    f"for {connect_timeout}s"
+                )
+
+            wait_time = None
+            deadlines = [w.deadline for w in self.workers if w.deadline is not None]
+            if deadlines:
+                wait_time = max(min(deadlines) - now, 0)
+            if not self.workers:
+                wait_time = max(last_connected + connect_timeout - now, 0)
+
+            ready = wait(
+                [worker.conn for worker in self.workers] + [self.wake_recv],
+                timeout=wait_time,
+            )
+            while self.wake_recv.poll():
+                self.wake_recv.recv()
+
+            for worker in list(self.workers):
+                if worker.conn not in ready:
+                    continue
+                try:
+                    message = worker.conn.recv()
+                except (EOFError, OSError):
+                    lost = self._drop(worker, "Worker disconnected", pending, losses)
+                    if lost is not None:
+                        yield lost
+                    continue
+
+                finished = handle_message(worker, message, pending, timeout)
+                if finished is not None:
+                    yield finished
+
+            now = time.monotonic()
+            for worker in list(self.workers):
+                deadline = worker.deadline
+                # A result that arrived since the wait saves the worker
+                if (
+                    deadline is not None
+                    and now >= deadline
+                    and not worker.conn.poll()
+                ):
+                    # The worker can't be stopped from here, dropping the
+                    # connection makes it exit once the test returns
+                    self.workers.remove(worker)
+                    worker.conn.close()
+                    yield lost_test(
+                        worker,
+                        ResultType.TIMEOUT,
+                        f"Test timed out after {worker.test_timeout}s",
+                        pending,
+                    )
+
+    def close(self) -> None:
+        """Release the workers and stop accepting new ones"""
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+        with self.accept_lock:
+            self.closing = True
+        # Wake the accept thread with a connection of our own
+        try:
+            Client(self.address).close()
+        except Exception:
+            pass
+        self.listener.close()
+        self.accept_thread.join(1.0)
+        with self.accept_lock:
+            while not self.accepted.empty():
+                self.accepted.get_nowait().close()
+            self.wake_recv.close()
+            self.wake_send.close()
+
+
+def connect(
+        address: Address,
+        authkey: Optional[Union[str, bytes]] = None,
+        retry_for: float = WORKER_RETRY_TIME,
+) -> Connection:
+    """
+    Connect to a coordinator, retrying while it isn't listening yet.
+
+    :param address: ("host", port) or Unix socket path
+    :param authkey: shared key, SMALLTEST_AUTHKEY if None
+    :param retry_for: seconds to keep retrying
+    :return: authenticated connection
+    """
+    authkey = get_authkey(authkey)
+    give_up = time.monotonic() + retry_for
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() >= give_up:
+                raise
+            time.sleep(RETRY_INTERVAL)
+
+
+def serve_worker(
+        address: Address,
+        authkey: Optional[Union[str, bytes]] = None,
+        root: Optional[Path] = None,
+        retry_for: float = WORKER_RETRY_TIME,
+) -> int:
+    """
+    Connect to a coordinator and run the batches it sends until it has no
+    more or goes away.
+
+    :param address: ("host", port) or Unix socket path of the coordinator
+    :param authkey: shared key, SMALLTEST_AUTHKEY if None
+    :param root: folder relative module paths are resolved against, the
+                 current directory if None
+    :param retry_for: seconds to keep trying to reach the coordinator
+    :return: number of batches run
+    """
+    root = Path(root if root is not None else Path.cwd()).absolute()
+    conn = connect(address, authkey, retry_for)
+    batch_count = 0
+    test_capture = None
+    fixtures = FixtureManager()
+    try:
+        _, capture = conn.recv()
+        test_capture = capture.make()
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+
+            _, module_path, items, module_args = message
+            try:
+                run_worker_batch(
+                    conn, root / module_path, items, test_capture, fixtures, module_args
+                )
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+            else:
+                conn.send(("done",))
+            batch_count += 1
+    except (EOFError, OSError):
+        # The coordinator has gone away
+        pass
+    finally:
+        fixtures.close()
+        if test_capture is not None:
+            test_capture.close()
+        conn.close()
+    return batch_count
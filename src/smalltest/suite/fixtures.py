@@ -0,0 +1,248 @@
+"""
+Set up, cache and tear down the fixtures requested by tests.
+
+Tests request fixtures by parameter name. Discovery records the parameter
+names of each test from the same parse that finds the test names, anything
+without those, such as a hand built test_dict, falls back to the function's
+code object. A fixture is looked up by name in the module its requester is
+defined in, then in the test module.
+
+Values are cached for their scope:
+    function - set up for each test and torn down straight after it
+    module   - torn down when the runner moves on to another module
+    session  - torn down when the runner, or parallel worker, finishes
+
+An error tearing down a function fixture is the test's error. Module and
+session fixtures are torn down between tests so their errors are written to
+stderr instead.
+
+The threads of the threaded runner each keep their own function and module
+fixtures but share one set of session fixtures, see sharing_session. Those
+are set up under a lock so each is set up once for the run.
+"""
+import sys
+import threading
+
+from functools import partial
+from types import CoroutineType, GeneratorType, ModuleType
+from typing import Any, Callable, Optional
+
+from smalltest.tools import FIXTURE_ATTRIBUTE, FIXTURE_SCOPES, PARAMETRIZE_ATTRIBUTE
+
+
+class FixtureError(Exception):
+    """A fixture that can't be found, or is used from a narrower scope"""
+
+
+def argument_names(func: Callable) -> list[str]:
+    """
+    Names of the parameters of a function that have no default, looking
+    through decorators that set __wrapped__.
+    """
+    while hasattr(func, "__wrapped__"):
+        func = func.__wrapped__
+    code = func.__code__
+    positional = list(code.co_varnames[:code.co_argcount])
+    if func.__defaults__:
+        positional = positional[:len(positional) - len(func.__defaults__)]
+    keyword_only = code.co_varnames[
+        code.co_argcount:code.co_argcount + code.co_kwonlyargcount
+    ]
+    keyword_defaults = func.__kwdefaults__ or {}
+    return positional + [name for name in keyword_only if name not in keyword_defaults]
+
+
+def fixture_names(test: Callable, test_args: Optional[list[str]] = None) -> list[str]:
+    """
+    Parameters of a test that are fixtures, those not given by parametrize.
+
+    :param test: test function
+    :param test_args: parameter names found by discovery, None to read them
+                      from the function
+    :return: [fixture_name, ...]
+    """
+    names = test_args if test_args is not None else argument_names(test)
+    parametrized = {
+        argname
+        for argnames, _, _ in getattr(test, PARAMETRIZE_ATTRIBUTE, [])
+        for argname in argnames
+    }
+    return [name for name in names if name not in parametrized]
+
+
+class FixtureManager:
+    """
+    Fixture values and teardowns for one runner or worker process.
+    """
+    def __init__(self):
+        # { scope: { fixture_function: value } }
+        self.values: dict[str, dict[Callable, Any]] = {scope: {} for scope in FIXTURE_SCOPES}
+        # { scope: [suspended generator fixture, ...] } in set up order
+        self.teardowns: dict[str, list[GeneratorType]] = {scope: [] for scope in FIXTURE_SCOPES}
+        self.module: Optional[ModuleType] = None
+        # Held while setting up session fixtures shared between threads
+        self.session_lock: Optional[threading.RLock] = None
+        self.owns_session = True
+
+    def isolated(self) -> "FixtureManager":
+        """
+        Manager sharing the module and session fixtures of this one with
+        function fixtures of its own, for a test running alongside others.
+        """
+        isolated = FixtureManager()
+        isolated.module = self.module
+        for scope in ("module", "session"):
+            isolated.values[scope] = self.values[scope]
+            isolated.teardowns[scope] = self.teardowns[scope]
+        isolated.session_lock = self.session_lock
+        return isolated
+
+    def sharing_session(self) -> "FixtureManager":
+        """
+        Manager with function and module fixtures of its own sharing the
+        session fixtures of this one, for a test thread. Only this manager
+        tears the session fixtures down.
+        """
+        if self.session_lock is None:
+            self.session_lock = threading.RLock()
+        shared = FixtureManager()
+        shared.values["session"] = self.values["session"]
+        shared.teardowns["session"] = self.teardowns["session"]
+        shared.session_lock = self.session_lock
+        shared.owns_session = False
+        return shared
+
+    def enter_module(self, module: ModuleType) -> None:
+        """Tear down the module fixtures when the tests move to a new module"""
+        if module is not self.module:
+            self.module = module
+            self._teardown_reported("module")
+
+    def _lookup(self, name: str, namespaces: list[dict]) -> Callable:
+        for namespace in namespaces:
+            found = namespace.get(name)
+            if found is not None and hasattr(found, FIXTURE_ATTRIBUTE):
+                return found
+        raise FixtureError(f"fixture {name!r} not found")
+
+    def _value(self, fixture_func: Callable, requester_scope: str, chain: tuple) -> Any:
+        scope = getattr(fixture_func, FIXTURE_ATTRIBUTE)
+        if FIXTURE_SCOPES.index(scope) < FIXTURE_SCOPES.index(requester_scope):
+            raise FixtureError(
+                f"{scope} fixture {fixture_func.__name__!r} can't be used "
+                f"by a {requester_scope} fixture"
+            )
+        values = self.values[scope]
+        if fixture_func in values:
+            return values[fixture_func]
+        if scope == "session" and self.session_lock is not None:
+            with self.session_lock:
+                # Another thread may have set it up while this one waited
+                if fixture_func in values:
+                    return values[fixture_func]
+                return self._set_up(fixture_func, scope, chain)
+        return self._set_up(fixture_func, scope, chain)
+
+    def _set_up(self, fixture_func: Callable, scope: str, chain: tuple) -> Any:
+        if fixture_func in chain:
+            raise FixtureError(f"fixture {fixture_func.__name__!r} requests itself")
+
+        namespaces = [fixture_func.__globals__, vars(self.module)]
+        kwargs = {
+            name: self._value(
+                self._lookup(name, namespaces), scope, (*chain, fixture_func)
+            )
+            for name in argument_names(fixture_func)
+        }
+        value = fixture_func(**kwargs)
+        if isinstance(value, GeneratorType):
+            generator = value
+            value = next(generator)
+            self.teardowns[scope].append(generator)
+        self.values[scope][fixture_func] = value
+        return value
+
+    def request(self, names: list[str]) -> dict[str, Any]:
+        """
+        Values of the fixtures named by a test of the current module,
+        setting up any that aren't cached for their scope.
+
+        :param names: [fixture_name, ...]
+        :return: { fixture_name: value }
+        """
+        namespaces = [vars(self.module)]
+        return {
+            name: self._value(self._lookup(name, namespaces), "function", ())
+            for name in names
+        }
+
+    def teardown(self, scope: str) -> None:
+        """
+        Tear down every fixture of a scope, most recently set up first.
+        Every teardown runs, the first error is raised after them.
+        """
+        error = None
+        teardowns = self.teardowns[scope]
+        while teardowns:
+            generator = teardowns.pop()
+            try:
+                next(generator)
+            except StopIteration:
+                pass
+            except Exception as e:
+                error = error or e
+            else:
+                error = error or FixtureError(
+                    f"fixture {generator.__name__!r} yielded more than once"
+                )
+        self.values[scope].clear()
+        if error is not None:
+            raise error
+
+    def _teardown_reported(self, scope: str) -> None:
+        """Tear down a scope outside of any test, writing errors to stderr"""
+        try:
+            self.teardown(scope)
+        except Exception as e:
+            import traceback
+            sys.stderr.write(f"Error tearing down {scope} fixtures\n")
+            traceback.print_exception(e, file=sys.stderr)
+
+    def close(self) -> None:
+        """Tear down everything, at the end of a run"""
+        for scope in FIXTURE_SCOPES:
+            if scope != "session" or self.owns_session:
+                self._teardown_reported(scope)
+
+    def bind(self, test: Callable, names: list[str]) -> Callable[[], None]:
+        """
+        Zero argument callable that runs a test with its fixtures, setting
+        them up first and tearing down the function fixtures after. For an
+        async test the callable gives a coroutine that tears down once
+        awaited.
+
+        :param test: test function, or a case of a parametrized test
+        :param names: [fixture_name, ...] the test takes
+        """
+        if not names:
+            return test
+        return partial(self._call, test, names)
+
+    def _call(self, test: Callable, names: list[str]) -> Any:
+        teardown_now = True
+        try:
+            outcome = test(**self.request(names))
+            if isinstance(outcome, CoroutineType):
+                # Tear down once an async test has been awaited
+                teardown_now = False
+                return self._finish(outcome)
+            return outcome
+        finally:
+            if teardown_now:
+                self.teardown("function")
+
+    async def _finish(self, outcome: CoroutineType) -> Any:
+        try:
+            return await outcome
+        finally:
+            self.teardown("function")
@@ -0,0 +1,142 @@
+"""
+Persistent index of the test names found in each test module.
+
+Parsing every test file on each run is the bulk of the discovery cost on
+large suites. The index records the test names, imports and test parameters
+found in a file along with the file's modification time, size and content hash so
+unchanged files can skip reading and parsing entirely on the next run.
+"""
+import time
+
+from pathlib import Path
+from typing import Optional
+
+from smalltest.util import content_hash, read_json, write_json
+
+INDEX_VERSION = 4
+INDEX_FILE_NAME = "discovery_index.json"
+
+# Files modified this recently may still change again within the
+# resolution of the file system timestamp, so always check their hash.
+RACY_WINDOW_NS = 2_000_000_000
+
+
+class DiscoveryIndex:
+    """
+    On-disk cache of
+    { module_path: ([test_name, ...], [(import, level), ...], {test_name: [arg, ...]}) }
+
+    Entries are matched first on mtime and size and then on the content
+    hash so a touched but unchanged file still avoids a parse. Entries for
+    files that were not looked up during the run are dropped on save.
+    """
+    def __init__(self, index_path: Path, test_prefix: str = "test_"):
+        self.index_path = index_path
+        self.test_prefix = test_prefix
+
+        data = read_json(index_path, default={})
+        if (
+            data.get("version") == INDEX_VERSION
+            and data.get("test_prefix") == test_prefix
+        ):
+            self.entries: dict[str, dict] = data.get("files", {})
+        else:
+            self.entries = {}
+
+        self.seen: set[str] = set()
+        self.changed = False
+
+    @staticmethod
+    def _key(pth: Path) -> str:
+        return str(pth.absolute())
+
+    def get(
+            self,
+            pth: Path
+    ) -> Optional[tuple[list[str], list[tuple[str, int]], dict[str, list[str]]]]:
+        """
+        Get the cached test names, imports and test parameters for a file
+        if the file is unchanged.
+
+        :param pth: path to python test module
+        :return: ([test_function_name, ...], [(module_name, level), ...],
+                  {test_function_name: [parameter_name, ...]})
+                 or None if not cached or stale
+        """
+        key = self._key(pth)
+        self.seen.add(key)
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        stat = pth.stat()
+        if (
+            not entry["racy"]
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry["tests"], entry["imports"], entry["args"]
+
+        # Modified time or size differ, the contents may still match
+        if entry["hash"] == content_hash(pth.read_bytes()):
+            self._store(
+                key, stat, entry["hash"], entry["tests"], entry["imports"], entry["args"]
+            )
+            return entry["tests"], entry["imports"], entry["args"]
+
+        return None
+
+    def update(
+            self,
+            pth: Path,
+            source_hash: str,
+            test_names: list[str],
+            imports: list[tuple[str, int]],
+            test_args: dict[str, list[str]],
+    ) -> None:
+        """
+        Record the test names, imports and test parameters found in a file.
+
+        :param pth: path to python test module
+        :param source_hash: content_hash of the source the names were found in
+        :param test_names: [test_function_name, ...]
+        :param imports: [(module_name, level), ...]
+        :param test_args: {test_function_name: [parameter_name, ...]}
+        """
+        key = self._key(pth)
+        self.seen.add(key)
+        self._store(key, pth.stat(), source_hash, test_names, imports, test_args)
+
+    def _store(self, key, stat, source_hash, test_names, imports, test_args):
+        self.entries[key] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": source_hash,
+            "racy": stat.st_mtime_ns >= time.time_ns() - RACY_WINDOW_NS,
+            "tests": test_names,
+            "imports": [list(module_import) for module_import in imports],
+            "args": test_args,
+        }
+        self.changed = True
+
+    def save(self) -> None:
+        """Write the index to disk, dropping entries for unseen files"""
+        stale = self.entries.keys() - self.seen
+        for key in stale:
+            del self.entries[key]
+
+        if self.changed or stale:
+            try:
+                write_json(
+                    self.index_path,
+                    {
+                        "version": INDEX_VERSION,
+                        "test_prefix": self.test_prefix,
+                        "files": self.entries,
+                    }
+                )
+            except OSError:
+                # An unwritable tree just doesn't get an index
+                pass
+            self.changed = False
@@ -0,0 +1,158 @@
+"""
+Cache of the outcome of every test for rerunning failures.
+
+The result of each test is stored by its module::test_name along with the
+path of its module. Rerunning only the last failures then needs just the
+modules that contain them, every other module is neither discovered nor
+imported. A failing case of a parametrized test reruns every case of the
+test, its cases are only known once the test runs.
+"""
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from smalltest.util import read_json, write_json
+from .discover import discover_test_functions
+from .run import FAILED_RESULTS, TestResult
+
+RESULTS_VERSION = 1
+RESULTS_FILE_NAME = "results.json"
+
+FAILED_NAMES = {result_type.name for result_type in FAILED_RESULTS}
+
+
+def strip_case_id(test_name: str) -> str:
+    """Test function name of a parametrized case, test_name[case_id]"""
+    return test_name.partition("[")[0]
+
+
+class ResultCache:
+    """
+    The outcome of every test from previous runs, persisted between runs.
+    """
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+
+        data = read_json(path, default={}) if path is not None else {}
+        if data.get("version") == RESULTS_VERSION:
+            # { module::test_name: [result_type_name, module_path] }
+            self.results: dict[str, list[str]] = data.get("results", {})
+        else:
+            self.results = {}
+
+    def failed(self) -> dict[Path, list[str]]:
+        """
+        Tests that failed, errored or timed out when they last ran.
+
+        :return: { module: [test_name, ...] } in the order they were recorded
+        """
+        failed: dict[Path, list[str]] = {}
+        for full_test_name, (result_name, module_path) in self.results.items():
+            if result_name in FAILED_NAMES:
+                test_name = strip_case_id(full_test_name.partition("::")[2])
+                test_names = failed.setdefault(Path(module_path), [])
+                if test_name not in test_names:
+                    test_names.append(test_name)
+        return failed
+
+    def failed_names(self) -> set[str]:
+        """{ module::test_name, ... } of the tests that last failed"""
+        return {
+            strip_case_id(full_test_name)
+            for full_test_name, (result_name, _) in self.results.items()
+            if result_name in FAILED_NAMES
+        }
+
+    def last_failed_tests(
+            self,
+            test_prefix: str = "test_",
+            imports: Optional[dict[Path, list[tuple[str, int]]]] = None,
+    ) -> dict[Path, list[str]]:
+        """
+        Discover the tests that failed last time they ran, only the modules
+        containing them are parsed. Tests or modules that no longer exist are
+        left out.
+
+        :param test_prefix: prefix for test functions
+        :param imports: dictionary to fill with the imports of each module
+        :return: { module: [test_name, ...] }
+        """
+        failed = {
+            module_path: test_names
+            for module_path, test_names in self.failed().items()
+            if module_path.is_file()
+        }
+        found = discover_test_functions(
+            list(failed), test_prefix=test_prefix, imports=imports
+        )
+
+        tests = {}
+        for module_path, test_names in failed.items():
+            remaining = [name for name in test_names if name in found[module_path]]
+            if remaining:
+                tests[module_path] = remaining
+        return tests
+
+    def failed_first(self, test_dict: dict[Path, list[str]]) -> dict[Path, list[str]]:
+        """
+        Reorder tests so modules with failures come first and the failing
+        tests lead their module. The order is otherwise unchanged.
+
+        :param test_dict: { module: [test_name, ...] }
+        :return: { module: [test_name, ...] } reordered
+        """
+        failed = {
+            module_path.absolute(): set(test_names)
+            for module_path, test_names in self.failed().items()
+        }
+
+        def reorder(module_path):
+            failed_names = failed.get(module_path.absolute(), set())
+            # Stable sort, failures first
+            return sorted(
+                test_dict[module_path],
+                key=lambda test_name: test_name not in failed_names,
+            )
+
+        first = [pth for pth in test_dict if pth.absolute() in failed]
+        rest = [pth for pth in test_dict if pth.absolute() not in failed]
+        return {pth: reorder(pth) for pth in first + rest}
+
+    def record(
+            self,
+            test_results: Iterable[tuple[str, TestResult]],
+            test_dict: dict[Path, list[str]],
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Record the outcome of each result and pass it on unchanged.
+
+        :param test_results: Results from a test run as (test_name, TestResult)
+        :param test_dict: { module: [test_name, ...] } the results were run from
+        :return: iterator of the same (test_name, TestResult)
+        """
+        module_paths = {pth.stem: str(pth.absolute()) for pth in test_dict}
+        for test_name, test_result in test_results:
+            module_name = test_name.partition("::")[0]
+            self.results[test_name] = [
+                test_result.result_type.name,
+                module_paths[module_name],
+            ]
+            yield test_name, test_result
+
+    def save(self) -> None:
+        """Write the results to disk, dropping modules that no longer exist"""
+        if self.path is None:
+            return
+        existing: dict[str, bool] = {}
+        results = {}
+        for full_test_name, (result_name, module_path) in self.results.items():
+            if module_path not in existing:
+                existing[module_path] = Path(module_path).is_file()
+            if existing[module_path]:
+                results[full_test_name] = [result_name, module_path]
+        try:
+            write_json(
+                self.path,
+                {"version": RESULTS_VERSION, "results": results}
+            )
+        except OSError:
+            pass
@@ -1,22 +1,29 @@
+import heapq
+import json
+import re
 import sys
-import traceback
 from collections import Counter
+from pathlib import Path
 
-from typing import TextIO
+from typing import Iterable, Iterator, Optional, TextIO
 
 from .run import ResultType, TestResult
 from smalltest.util import WritelnDecorator
 
 
 def text_reporter(
-        test_results: dict[str, TestResult],
+        test_results: Iterable[tuple[str, TestResult]],
         stream: TextIO = None,
         strict_xfail: bool = False
 ) -> dict[ResultType, int]:
     """
     Basic reporter that writes a text report of failed tests
     and captured stdout/stderr/warnings
-    :param test_results: Results from a test run
+
+    Results are consumed one at a time as the runner yields them, failures
+    are reported as soon as they arrive and only the counts are kept.
+
+    :param test_results: Results from a test run as (test_name, TestResult)
     :param stream: Stream to write text results to.
     :param strict_xfail: Report XPASS as failure
     """
@@ -25,7 +32,7 @@ def text_reporter(
     stream = stream if stream else sys.stdout
     stream = WritelnDecorator(stream)
 
-    for test_name, test_result in test_results.items():
+    for test_name, test_result in test_results:
         # XPASS on strict_xfail is counted as failure
         if strict_xfail and test_result.result_type == ResultType.XPASS:
             test_counts[ResultType.FAILURE] += 1
@@ -36,6 +43,8 @@ def text_reporter(
             case ResultType.FAILURE:
                 stream.writeln(f"{test_name} Failed")
                 for arg in test_result.exception.args:
+                    # Rewritten asserts explain themselves over several lines
+                    arg = arg.replace("\n", "\n\t")
                     stream.writeln(f"\t{arg}")
                 stream.writeln("")
             case ResultType.XPASS:
@@ -51,15 +60,21 @@ def text_reporter(
                 for arg in test_result.exception.args:
                     stream.writeln(f"\t\t{arg}")
                 stream.writeln(f"\tTraceback")
-                formatted_tb = traceback.format_tb(test_result.exception.traceback)
-                for line in formatted_tb[1:]:  # Skip the line from running the test itself
-                    print(line)
+                for frame in test_result.exception.traceback:
+                    stream.write(frame)
+                stream.writeln("")
+            case ResultType.TIMEOUT:
+                stream.writeln(f"{test_name} did not finish")
+                for arg in test_result.exception.args:
+                    stream.writeln(f"\t{arg}")
                 stream.writeln("")
 
     digits = len(str(test_counts.total()))
 
     failure_count = (
-            test_counts[ResultType.FAILURE] + test_counts[ResultType.ERROR]
+            test_counts[ResultType.FAILURE]
+            + test_counts[ResultType.ERROR]
+            + test_counts[ResultType.TIMEOUT]
     )
     if strict_xfail:
         failure_count += test_counts[ResultType.XPASS]
@@ -94,5 +109,313 @@ def text_reporter(
             f"    {test_counts[ResultType.ERROR]:{digits}d} "
             f"Failed to run due to errors"
         )
+    if test_counts[ResultType.TIMEOUT]:
+        stream.writeln(
+            f"    {test_counts[ResultType.TIMEOUT]:{digits}d} Timed out"
+        )
 
     return test_counts
+
+
+class TimingReport:
+    """
+    Collect test durations as the results stream past.
+
+    Only the slowest tests and the per-module totals are kept in memory.
+    If an export file is given every test's timings are written to it as
+    JSON Lines as soon as the result arrives, followed by one line per
+    module when the run is finished.
+    """
+    def __init__(self, slowest: int = 10, export_path: Optional[Path] = None):
+        self.slowest = slowest
+        self.export_path = export_path
+
+        # min-heap of (wall_time_ns, cpu_time_ns, test_name)
+        self.slowest_tests: list[tuple[int, int, str]] = []
+        # module_name: [test count, import_time_ns, wall_time_ns, cpu_time_ns]
+        self.module_times: dict[str, list[int]] = {}
+
+    def record(
+            self,
+            test_results: Iterable[tuple[str, TestResult]]
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Record the timings of each result and pass it on unchanged.
+
+        :param test_results: Results from a test run as (test_name, TestResult)
+        :return: iterator of the same (test_name, TestResult)
+        """
+        export = None
+        if self.export_path is not None:
+            export = open(self.export_path, 'w', encoding="utf-8")
+        try:
+            for test_name, test_result in test_results:
+                self._add(test_name, test_result)
+                if export is not None:
+                    export.write(json.dumps({
+                        "type": "test",
+                        "name": test_name,
+                        "result": test_result.result_type.name,
+                        "wall_time_ns": test_result.wall_time_ns,
+                        "cpu_time_ns": test_result.cpu_time_ns,
+                        "import_time_ns": test_result.import_time_ns,
+                    }))
+                    export.write("\n")
+                yield test_name, test_result
+
+            if export is not None:
+                for module_name, (count, imp, wall, cpu) in self.module_times.items():
+                    export.write(json.dumps({
+                        "type": "module",
+                        "name": module_name,
+                        "tests": count,
+                        "import_time_ns": imp,
+                        "wall_time_ns": wall,
+                        "cpu_time_ns": cpu,
+                    }))
+                    export.write("\n")
+        finally:
+            if export is not None:
+                export.close()
+
+    def _add(self, test_name: str, test_result: TestResult) -> None:
+        entry = (test_result.wall_time_ns, test_result.cpu_time_ns, test_name)
+        if len(self.slowest_tests) < self.slowest:
+            heapq.heappush(self.slowest_tests, entry)
+        elif self.slowest:
+            heapq.heappushpop(self.slowest_tests, entry)
+
+        module_name = test_name.partition("::")[0]
+        times = self.module_times.setdefault(module_name, [0, 0, 0, 0])
+        times[0] += 1
+        times[1] += test_result.import_time_ns
+        times[2] += test_result.wall_time_ns
+        times[3] += test_result.cpu_time_ns
+
+    def write_report(self, stream: TextIO = None) -> None:
+        """
+        Write the slowest tests and modules sections.
+
+        :param stream: Stream to write text results to.
+        """
+        if not self.slowest:
+            return
+
+        stream = stream if stream else sys.stdout
+        stream = WritelnDecorator(stream)
+
+        stream.writeln(f"Slowest {self.slowest} tests")
+        for wall, cpu, test_name in sorted(self.slowest_tests, reverse=True):
+            stream.writeln(
+                f"    {wall / 1e6:10.3f}ms wall {cpu / 1e6:10.3f}ms cpu  "
+                f"{test_name}"
+            )
+
+        slowest_modules = heapq.nlargest(
+            self.slowest,
+            self.module_times.items(),
+            key=lambda item: item[1][1] + item[1][2]
+        )
+        stream.writeln(f"Slowest {self.slowest} modules")
+        for module_name, (count, imp, wall, cpu) in slowest_modules:
+            stream.writeln(
+                f"    {(imp + wall) / 1e6:10.3f}ms total "
+                f"{imp / 1e6:10.3f}ms import  {module_name} ({count} tests)"
+            )
+
+
+# Bytes buffered by the machine readable reporters between writes
+REPORT_BUFFER_SIZE = 64 * 1024
+
+
+def _result_message(test_result: TestResult) -> str:
+    """Exception arguments of a result joined into one message"""
+    if test_result.exception is None:
+        return ""
+    return "\n".join(test_result.exception.args)
+
+
+def _warning_texts(test_result: TestResult) -> list[str]:
+    return [
+        f"{warning.category}: {warning.message}"
+        for warning in test_result.warnings
+    ]
+
+
+class JSONLinesReport:
+    """
+    Write one JSON object per test as the results stream past, followed by
+    a summary of the counts once the run is finished.
+
+    Nothing but the counts is kept in memory, each line is written to a
+    buffered file as soon as its result arrives.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+
+    def record(
+            self,
+            test_results: Iterable[tuple[str, TestResult]]
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Write each result and pass it on unchanged.
+
+        :param test_results: Results from a test run as (test_name, TestResult)
+        :return: iterator of the same (test_name, TestResult)
+        """
+        test_counts = Counter()
+        with open(self.path, "w", encoding="utf-8", buffering=REPORT_BUFFER_SIZE) as f:
+            for test_name, test_result in test_results:
+                test_counts[test_result.result_type.name] += 1
+                exception = test_result.exception
+                f.write(json.dumps({
+                    "type": "test",
+                    "name": test_name,
+                    "result": test_result.result_type.name,
+                    "wall_time_ns": test_result.wall_time_ns,
+                    "cpu_time_ns": test_result.cpu_time_ns,
+                    "import_time_ns": test_result.import_time_ns,
+                    "exception": exception.name if exception else None,
+                    "message": _result_message(test_result),
+                    "traceback": "".join(exception.traceback) if exception else "",
+                    "stdout": test_result.stdout,
+                    "stderr": test_result.stderr,
+                    "warnings": _warning_texts(test_result),
+                }))
+                f.write("\n")
+                yield test_name, test_result
+
+            f.write(json.dumps({
+                "type": "summary",
+                "tests": test_counts.total(),
+                "results": dict(test_counts),
+            }))
+            f.write("\n")
+
+
+# Characters XML 1.0 doesn't allow, even escaped
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+# Room left in the opening testsuite tag for the counts written at the end
+_SUITE_ATTRIBUTE_WIDTH = 120
+
+
+def _xml_text(text: str) -> str:
+    from xml.sax.saxutils import escape
+    return escape(_INVALID_XML.sub("\ufffd", text))
+
+
+def _xml_attribute(text: str) -> str:
+    from xml.sax.saxutils import quoteattr
+    return quoteattr(_INVALID_XML.sub("\ufffd", text))
+
+
+class JUnitXMLReport:
+    """
+    Write a JUnit XML report as the results stream past.
+
+    Each testcase element is written to a buffered file as soon as its
+    result arrives. The suite totals aren't known until the end, so the
+    opening testsuite tag is written with blank space that the totals are
+    written into once the run is finished.
+
+    XFAIL and SKIP are reported as skipped, TIMEOUT as an error and XPASS
+    as a failure with strict_xfail.
+    """
+    def __init__(self, path: Path, strict_xfail: bool = False, suite_name: str = "smalltest"):
+        self.path = path
+        self.strict_xfail = strict_xfail
+        self.suite_name = suite_name
+
+    def _testcase(self, test_name: str, test_result: TestResult) -> str:
+        module_name, _, function_name = test_name.partition("::")
+        seconds = test_result.wall_time_ns / 1e9
+        opening = (
+            f"    <testcase classname={_xml_attribute(module_name)} "
+            f"name={_xml_attribute(function_name)} time=\"{seconds:.6f}\""
+        )
+
+        children = []
+        message = _xml_attribute(_result_message(test_result))
+        exception = test_result.exception
+        details = _xml_text("".join(exception.traceback)) if exception else ""
+        error_type = _xml_attribute(exception.name or "") if exception else '""'
+        match test_result.result_type:
+            case ResultType.FAILURE:
+                children.append(
+                    f"      <failure type={error_type} message={message}>"
+                    f"{details}</failure>\n"
+                )
+            case ResultType.ERROR | ResultType.TIMEOUT:
+                children.append(
+                    f"      <error type={error_type} message={message}>"
+                    f"{details}</error>\n"
+                )
+            case ResultType.XPASS if self.strict_xfail:
+                children.append(
+                    f"      <failure type=\"XPASS\" message={message}/>\n"
+                )
+            case ResultType.SKIP | ResultType.XFAIL:
+                children.append(f"      <skipped message={message}/>\n")
+
+        if test_result.stdout:
+            children.append(
+                f"      <system-out>{_xml_text(test_result.stdout)}</system-out>\n"
+            )
+        stderr = test_result.stderr
+        if test_result.warnings:
+            stderr += "".join(f"{text}\n" for text in _warning_texts(test_result))
+        if stderr:
+            children.append(f"      <system-err>{_xml_text(stderr)}</system-err>\n")
+
+        if not children:
+            return f"{opening}/>\n"
+        return f"{opening}>\n{''.join(children)}    </testcase>\n"
+
+    def record(
+            self,
+            test_results: Iterable[tuple[str, TestResult]]
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Write each result and pass it on unchanged.
+
+        :param test_results: Results from a test run as (test_name, TestResult)
+        :return: iterator of the same (test_name, TestResult)
+        """
+        tests = failures = errors = skipped = 0
+        total_ns = 0
+        with open(self.path, "w", encoding="utf-8", buffering=REPORT_BUFFER_SIZE) as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+            f.write(f"  <testsuite name={_xml_attribute(self.suite_name)}")
+            try:
+                totals_position = f.tell()
+            except OSError:
+                # A pipe can't be rewound, the totals are left out
+                totals_position = None
+            else:
+                f.write(" " * _SUITE_ATTRIBUTE_WIDTH)
+            f.write(">\n")
+
+            for test_name, test_result in test_results:
+                tests += 1
+                total_ns += test_result.wall_time_ns
+                match test_result.result_type:
+                    case ResultType.FAILURE:
+                        failures += 1
+                    case ResultType.XPASS if self.strict_xfail:
+                        failures += 1
+                    case ResultType.ERROR | ResultType.TIMEOUT:
+                        errors += 1
+                    case ResultType.SKIP | ResultType.XFAIL:
+                        skipped += 1
+                f.write(self._testcase(test_name, test_result))
+                yield test_name, test_result
+
+            f.write("  </testsuite>\n</testsuites>\n")
+            totals = (
+                f' tests="{tests}" failures="{failures}" errors="{errors}"'
+                f' skipped="{skipped}" time="{total_ns / 1e9:.6f}"'
+            )
+            if totals_position is not None:
+                f.seek(totals_position)
+                f.write(totals)
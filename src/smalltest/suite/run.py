@@ -4,18 +4,24 @@ Run the tests_unittest
 import sys
 import enum
 import importlib.util
+import os
+import time
 import warnings
 
-from contextlib import redirect_stderr, redirect_stdout
-from io import StringIO
 from pathlib import Path
-from typing import Any, Callable, Optional, TextIO
-from typing import NamedTuple
-from types import TracebackType
-from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Collection, ContextManager, Iterator, Optional, TextIO
+from typing import NamedTuple, TYPE_CHECKING
+from types import CoroutineType, ModuleType
 
 from smalltest.tools import XFailMarker, XPassMarker, SkipMarker
 from smalltest.util import WritelnDecorator
+from .capture import Capture, CaptureOptions, SysCapture, catch_all_warnings
+from .cases import case_name, case_test_name, is_parametrized, iter_cases
+from .fixtures import FixtureManager, fixture_names
+
+if TYPE_CHECKING:
+    from .asyncrun import AsyncTestRunner
+    from .schedule import DurationStore
 
 
 class TestResult(NamedTuple):
@@ -23,13 +29,113 @@ class TestResult(NamedTuple):
     exception: Optional["ErrorDetails"]
     stdout: str
     stderr: str
-    warnings: list[warnings.WarningMessage]
+    warnings: list["WarningDetails"]
+    # Durations of the test function call itself
+    wall_time_ns: int = 0
+    cpu_time_ns: int = 0
+    # Time spent importing the test module, only set on the first test run
+    # after each import of the module
+    import_time_ns: int = 0
+
+
+# Longest text kept for a single exception argument
+MAX_ARG_LENGTH = 2000
+
+# Frames from files in here are smalltest's own, such as run_test and the
+# fixture and xfail wrappers around a test
+SMALLTEST_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 class ErrorDetails(NamedTuple):
-    args: tuple[Any, ...]
+    """
+    Compact description of an exception raised by a test.
+
+    Everything is stored as text so results can cross the process boundary
+    in parallel runs and are rendered the same way in every mode.
+    """
+    args: tuple[str, ...]
     name: Optional[str] = None
-    traceback: Optional[TracebackType] = None
+    traceback: tuple[str, ...] = ()
+
+    @classmethod
+    def from_exception(
+            cls,
+            e: BaseException,
+            include_traceback: bool = False
+    ) -> "ErrorDetails":
+        """
+        Convert an exception into its text details.
+
+        :param e: exception raised by the test
+        :param include_traceback: format the traceback frames
+        :return: ErrorDetails
+        """
+        if include_traceback:
+            import traceback
+            summary = traceback.extract_tb(e.__traceback__)
+            # Skip the frames of smalltest itself above the test
+            skip = 0
+            while (
+                skip < len(summary)
+                and summary[skip].filename.startswith(SMALLTEST_FOLDER + os.sep)
+            ):
+                skip += 1
+            frames = tuple(traceback.format_list(summary[skip:]))
+        else:
+            frames = ()
+        return cls(
+            tuple(safe_repr(arg) for arg in e.args),
+            name=e.__class__.__qualname__,
+            traceback=frames,
+        )
+
+
+class WarningDetails(NamedTuple):
+    """
+    Text of a warning shown by a test.
+
+    Like ErrorDetails this only holds text, a warning class defined in a
+    test module or a message holding a lock still crosses the process
+    boundary.
+    """
+    category: str
+    message: str
+    filename: str
+    lineno: int
+
+    @classmethod
+    def from_warning(cls, warning: warnings.WarningMessage) -> "WarningDetails":
+        try:
+            message = str(warning.message)
+        except Exception as e:
+            message = (f"<{type(warning.message).__qualname__} object "
+                       f"- str failed with {e.__class__.__qualname__}>")
+        return cls(
+            warning.category.__qualname__,
+            safe_repr(message),
+            str(warning.filename),
+            warning.lineno or 0,
+        )
+
+
+def safe_repr(value: Any) -> str:
+    """
+    Text form of an exception argument that never raises.
+
+    Strings are kept as they are, anything else uses its repr.
+    Long values are truncated to MAX_ARG_LENGTH.
+    """
+    if isinstance(value, str):
+        text = value
+    else:
+        try:
+            text = repr(value)
+        except Exception as e:
+            text = (f"<{type(value).__qualname__} object "
+                    f"- repr failed with {e.__class__.__qualname__}>")
+    if len(text) > MAX_ARG_LENGTH:
+        text = f"{text[:MAX_ARG_LENGTH]}... [{len(text) - MAX_ARG_LENGTH} more]"
+    return text
 
 
 class ResultType(enum.Enum):
@@ -39,97 +145,341 @@ class ResultType(enum.Enum):
     XFAIL = 2
     XPASS = 3
     SKIP = 4
+    TIMEOUT = 5
+
 
+# Results counted towards maxfail
+FAILED_RESULTS = frozenset({ResultType.FAILURE, ResultType.ERROR, ResultType.TIMEOUT})
 
-def run_test(test: Callable) -> TestResult:
+
+def run_test(
+        test: Callable,
+        capture: Optional[Capture] = None,
+        warning_recorder: Optional[Callable[[], ContextManager[list]]] = None,
+        cpu_clock: Callable[[], int] = time.process_time_ns,
+) -> TestResult:
     """
     Run the test function, capture stdout, stderr and uncaught warnings
     to display in the report.
 
-    :param test function
+    Output of a passing test is dropped unless the capture keeps it.
+    An async test is run to completion on an event loop of its own.
+
+    :param test: test function
+    :param capture: Capture reused between tests, a new SysCapture if None
+    :param warning_recorder: context manager giving the list of warnings
+                             shown inside it, catch_all_warnings if None
+    :param cpu_clock: CPU time in nanoseconds, for the whole process unless
+                      other tests run alongside this one
     :return: TestResult
     """
-    stdout = StringIO()
-    stderr = StringIO()
-    try:
-        with redirect_stdout(stdout), \
-             redirect_stderr(stderr), \
-             warnings.catch_warnings(record=True) as warns:
-            test()
-    except AssertionError as e:
-        result = TestResult(
-            ResultType.FAILURE,
-            ErrorDetails(e.args, traceback=e.__traceback__),
-            stdout.getvalue(),
-            stderr.getvalue(),
-            warns
-        )
-    except XFailMarker as e:
-        result = TestResult(
-            ResultType.XFAIL,
-            ErrorDetails(e.args),
-            stdout.getvalue(),
-            stderr.getvalue(),
-            warns
-        )
-    except XPassMarker as e:
-        result = TestResult(
-            ResultType.XPASS,
-            ErrorDetails(e.args),
-            stdout.getvalue(),
-            stderr.getvalue(),
-            warns
-        )
-    except SkipMarker as e:
-        result = TestResult(
-            ResultType.SKIP,
-            ErrorDetails(e.args),
-            stdout.getvalue(),
-            stderr.getvalue(),
-            warns
-        )
-    except Exception as e:
-        # In the case of an unexpected error, also provide more error info
-        result = TestResult(
-            ResultType.ERROR,
-            ErrorDetails(
-                e.args,
-                name=e.__class__.__qualname__,
-                traceback=e.__traceback__
-            ),
-            stdout.getvalue(),
-            stderr.getvalue(),
-            warns
-        )
-    else:
-        result = TestResult(
-            ResultType.SUCCESS,
-            None,
-            stdout.getvalue(),
-            stderr.getvalue(),
-            warns
+    capture = capture if capture is not None else SysCapture()
+    if warning_recorder is None:
+        warning_recorder = catch_all_warnings
+    error = None
+    stdout = stderr = ""
+    wall_time_ns = cpu_time_ns = 0
+    with warning_recorder() as warns:
+        capture.start()
+        try:
+            wall_start = time.perf_counter_ns()
+            cpu_start = cpu_clock()
+            try:
+                outcome = test()
+                if isinstance(outcome, CoroutineType):
+                    import asyncio
+                    asyncio.run(outcome)
+            except Exception as e:
+                error = e
+            finally:
+                wall_time_ns = time.perf_counter_ns() - wall_start
+                cpu_time_ns = cpu_clock() - cpu_start
+        finally:
+            stdout, stderr = capture.stop()
+
+    result = result_from_error(error, stdout, stderr, warns, capture.keep_passing)
+    return result._replace(wall_time_ns=wall_time_ns, cpu_time_ns=cpu_time_ns)
+
+
+async def run_test_async(
+        test: Callable,
+        capture: Capture,
+        warning_recorder: Callable[[], ContextManager[list]],
+) -> TestResult:
+    """
+    Await an async test on the running event loop, alongside other tests.
+
+    The capture and warning recorder must only see this test, such as a
+    ContextCapture and record_warnings inside routed_output. Only the wall
+    time is recorded, CPU time can't be told apart between the tests
+    sharing the loop.
+
+    :param test: async test function
+    :param capture: Capture for this test alone
+    :param warning_recorder: context manager recording this test's warnings
+    :return: TestResult
+    """
+    error = None
+    stdout = stderr = ""
+    with warning_recorder() as warns:
+        capture.start()
+        try:
+            wall_start = time.perf_counter_ns()
+            try:
+                await test()
+            except Exception as e:
+                error = e
+            finally:
+                wall_time_ns = time.perf_counter_ns() - wall_start
+        finally:
+            stdout, stderr = capture.stop()
+
+    result = result_from_error(error, stdout, stderr, warns, capture.keep_passing)
+    return result._replace(wall_time_ns=wall_time_ns)
+
+
+def result_from_error(
+        error: Optional[Exception],
+        stdout: str,
+        stderr: str,
+        warns: list[warnings.WarningMessage],
+        keep_passing: bool = False,
+) -> TestResult:
+    """
+    Result of a test from the exception it raised, None if it passed.
+
+    :param error: exception raised by the test
+    :param stdout: captured stdout
+    :param stderr: captured stderr
+    :param warns: warnings shown by the test
+    :param keep_passing: keep the output of a passing test
+    :return: TestResult
+    """
+    warns = [WarningDetails.from_warning(warning) for warning in warns]
+    match error:
+        case None:
+            if not keep_passing:
+                stdout = stderr = ""
+            return TestResult(ResultType.SUCCESS, None, stdout, stderr, warns)
+        case AssertionError():
+            result_type, include_traceback = ResultType.FAILURE, True
+        case XFailMarker():
+            result_type, include_traceback = ResultType.XFAIL, False
+        case XPassMarker():
+            result_type, include_traceback = ResultType.XPASS, False
+        case SkipMarker():
+            result_type, include_traceback = ResultType.SKIP, False
+        case _:
+            # In the case of an unexpected error, also provide more error info
+            result_type, include_traceback = ResultType.ERROR, True
+    return TestResult(
+        result_type,
+        ErrorDetails.from_exception(error, include_traceback=include_traceback),
+        stdout,
+        stderr,
+        warns
+    )
+
+
+def write_progress(
+        stream: WritelnDecorator,
+        full_test_name: str,
+        result: TestResult,
+        tests_started: int,
+        test_total: int,
+) -> None:
+    """
+    Write the single line progress report for a finished test.
+
+    :param stream: Output stream wrapped in WritelnDecorator
+    :param full_test_name: module::test_name, or module::test_name[case_id]
+    :param result: Result of the test
+    :param tests_started: Number of test functions with a result, including
+                          this one. The cases of a parametrized test count
+                          once between them.
+    :param test_total: Total number of test functions being run
+    """
+    stream.write(f"[{tests_started}/{test_total}] ")
+
+    match result.result_type:
+        case ResultType.SUCCESS:
+            stream.writeln(f"{full_test_name} - Success")
+        case ResultType.FAILURE:
+            stream.writeln(f"{full_test_name} - Failure")
+        case ResultType.XFAIL:
+            stream.writeln(f"{full_test_name} - XFailed")
+        case ResultType.XPASS:
+            stream.writeln(f"{full_test_name} - XPassed")
+        case ResultType.SKIP:
+            stream.writeln(f"{full_test_name} - Skipped / "
+                           f"{result.exception.args[0]}")
+        case ResultType.ERROR:
+            stream.writeln(f"{full_test_name} - ERROR")
+        case ResultType.TIMEOUT:
+            stream.writeln(f"{full_test_name} - TIMEOUT")
+
+
+def write_stopped(
+        stream: WritelnDecorator,
+        failure_count: int,
+        result_count: int,
+        tests_started: int,
+        test_total: int,
+) -> None:
+    """
+    Note that a run was stopped early by maxfail.
+
+    :param stream: Output stream wrapped in WritelnDecorator
+    :param failure_count: Number of failed tests
+    :param result_count: Number of results, one for each case of a
+                         parametrized test
+    :param tests_started: Number of test functions with a result
+    :param test_total: Total number of test functions being run
+    """
+    cases = f" ({result_count} results)" if result_count != tests_started else ""
+    stream.writeln(f"Stopping after {failure_count} failures, "
+                   f"{tests_started} of {test_total} tests run{cases}")
+
+
+def iter_module_tests(
+        module: ModuleType,
+        test_names: list[str],
+        import_time_ns: int = 0,
+        capture: Optional[Capture] = None,
+        fixtures: Optional[FixtureManager] = None,
+        module_args: Optional[dict[str, list[str]]] = None,
+        warning_recorder: Optional[Callable[[], ContextManager[list]]] = None,
+        async_runner: Optional["AsyncTestRunner"] = None,
+) -> Iterator[tuple[str, TestResult]]:
+    """
+    Run tests from an imported module, yielding each result as it finishes.
+
+    Each case of a parametrized test is run and yielded as it is produced,
+    named module::test_name[case_id].
+
+    With an async_runner the async tests of the module are run concurrently
+    on its event loop once the other tests have finished. Without one each
+    async test is run on an event loop of its own.
+
+    :param module: imported test module
+    :param test_names: names of the test functions to run
+    :param import_time_ns: time taken to import the module, recorded
+                           on the first result
+    :param capture: Capture reused for every test
+    :param fixtures: FixtureManager shared by the run, None to call the
+                     tests without arguments
+    :param module_args: { test_name: [parameter_name, ...] } from discovery,
+                        None to read the parameters from each test
+    :param warning_recorder: how run_test records warnings, see run_test
+    :param async_runner: AsyncTestRunner shared by the run
+    :return: iterator of (full_test_name, TestResult)
+    """
+    module_name = module.__name__
+    if fixtures is not None:
+        fixtures.enter_module(module)
+
+    async_names = []
+    if async_runner is not None:
+        from .asyncrun import is_async_test
+        async_names = [
+            test_name for test_name in test_names
+            if is_async_test(getattr(module, test_name))
+        ]
+        test_names = [
+            test_name for test_name in test_names if test_name not in async_names
+        ]
+
+    for test_name in test_names:
+        test = getattr(module, test_name)
+        names = []
+        if fixtures is not None:
+            names = fixtures_for_test(test, test_name, module_args)
+        if not is_parametrized(test):
+            cases = [(test_name, test)]
+        else:
+            cases = (
+                (case_name(test_name, case_id), case)
+                for case_id, case in iter_cases(test)
+            )
+
+        try:
+            for full_name, case in cases:
+                if names:
+                    case = fixtures.bind(case, names)
+                result = run_test(case, capture, warning_recorder)
+                if import_time_ns:
+                    result = result._replace(import_time_ns=import_time_ns)
+                    import_time_ns = 0
+                yield f"{module_name}::{full_name}", result
+        except Exception as e:
+            # The cases themselves couldn't be produced
+            yield f"{module_name}::{test_name}", case_error(e)
+
+    if async_names:
+        yield from async_runner.run(
+            module, async_names, import_time_ns, fixtures, module_args
         )
 
-    return result
+
+def fixtures_for_test(
+        test: Callable,
+        test_name: str,
+        module_args: Optional[dict[str, list[str]]] = None,
+) -> list[str]:
+    """Fixtures a test takes, from the discovered parameters if given"""
+    test_args = None
+    if module_args is not None:
+        test_args = module_args.get(test_name, [])
+    return fixture_names(test, test_args)
+
+
+def case_error(e: Exception) -> TestResult:
+    """ERROR result for a parametrized test whose cases raised"""
+    return TestResult(
+        ResultType.ERROR,
+        ErrorDetails.from_exception(e, include_traceback=True),
+        "",
+        "",
+        [],
+    )
 
 
 def run_tests_serial(
         test_dict: dict[Path, list[str]],
-        stream: Optional[TextIO] = None
-) -> dict[str, TestResult]:
+        stream: Optional[TextIO] = None,
+        maxfail: Optional[int] = None,
+        capture: CaptureOptions = CaptureOptions(),
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+        async_concurrency: Optional[int] = None,
+) -> Iterator[tuple[str, TestResult]]:
     """
     Run the tests one at a time serially.
 
+    Async tests are the exception, the async tests of each module run
+    concurrently on an event loop shared by the whole run, see
+    smalltest.suite.asyncrun.
+
+    This is a generator, tests are only run as the results are consumed
+    and each result is yielded as soon as the test has finished.
+
     :param test_dict: { module: [test_name, ...] }
     :param stream: Output stream - should be stdout/stderr or equivalent
-    :return: result dict
+    :param maxfail: Stop the run after this many failures or errors
+    :param capture: How the output of each test is captured
+    :param test_args: { module: { test_name: [parameter_name, ...] } } from
+                      discovery, None to read the parameters from each test
+    :param async_concurrency: Most async tests running at once, None for
+                              the default
+    :return: iterator of (full_test_name, TestResult)
     """
-    results = {}
+    from .asyncrun import AsyncTestRunner, DEFAULT_CONCURRENCY
+
     stream = stream if stream else sys.stdout
     stream = WritelnDecorator(stream)
 
     test_total = sum(len(tests) for tests in test_dict.values())
-    test_counter = 0
+    result_count = 0
+    started_tests: set[str] = set()
 
     top_banner = (f"Smalltest: running {test_total} tests "
                   f"from {len(test_dict)} modules")
@@ -140,92 +490,199 @@ def run_tests_serial(
     stream.writeln(top_banner)
     stream.writeln(delimiters)
 
-    for module_path, test_names in test_dict.items():
-
-        # Load the test module
-        module_name = module_path.stem
-        spec = importlib.util.spec_from_file_location(module_name, module_path)
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = module
-        spec.loader.exec_module(module)
-
-        # Collect the results
-        for test_name in test_names:
-            test_counter += 1
-            result = run_test(getattr(module, test_name))
-            stream.write(f"[{test_counter}/{test_total}] ")
-
-            full_test_name = f"{module_name}::{test_name}"
-
-            match result.result_type:
-                case ResultType.SUCCESS:
-                    stream.writeln(f"{full_test_name} - Success")
-                case ResultType.FAILURE:
-                    stream.writeln(f"{full_test_name} - Failure")
-                case ResultType.XFAIL:
-                    stream.writeln(f"{full_test_name} - XFailed")
-                case ResultType.XPASS:
-                    stream.writeln(f"{full_test_name} - XPassed")
-                case ResultType.SKIP:
-                    stream.writeln(f"{full_test_name} - Skipped / "
-                                   f"{result.exception.args[0]}")
-                case ResultType.ERROR:
-                    stream.writeln(f"{full_test_name} - ERROR")
-
-            results[full_test_name] = result
-        stream.flush()
+    failure_count = 0
+    test_capture = capture.make()
+    fixtures = FixtureManager()
+    async_runner = AsyncTestRunner(async_concurrency or DEFAULT_CONCURRENCY, capture)
+    try:
+        for module_path, test_names in test_dict.items():
+            # Load the test module
+            import_start = time.perf_counter_ns()
+            module = load_test_module(module_path)
+            import_time_ns = time.perf_counter_ns() - import_start
+
+            # Yield the results as they are completed
+            module_results = iter_module_tests(
+                module,
+                test_names,
+                import_time_ns,
+                test_capture,
+                fixtures,
+                test_args.get(module_path) if test_args is not None else None,
+                async_runner=async_runner,
+            )
+            try:
+                for full_test_name, result in module_results:
+                    result_count += 1
+                    started_tests.add(case_test_name(full_test_name))
+                    write_progress(stream, full_test_name, result,
+                                   len(started_tests), test_total)
+                    yield full_test_name, result
+
+                    if result.result_type in FAILED_RESULTS:
+                        failure_count += 1
+                        if maxfail is not None and failure_count >= maxfail:
+                            break
+            finally:
+                # Cancels any async tests still running on the loop
+                module_results.close()
+
+            stream.flush()
+            if maxfail is not None and failure_count >= maxfail:
+                write_stopped(stream, failure_count, result_count,
+                              len(started_tests), test_total)
+                break
+    finally:
+        async_runner.close()
+        fixtures.close()
+        test_capture.close()
     stream.writeln(delimiters)
     stream.flush()
-    return results
 
 
-def run_isolated_test(testdetails: tuple[Path, str]) -> tuple[str, TestResult]:
-    module_path = testdetails[0]
-    test_name = testdetails[1]
+# Test modules already imported by this process, keyed by path.
+# Parallel workers keep this between batches so each module is only
+# imported once per worker rather than once per test.
+_module_cache: dict[Path, ModuleType] = {}
 
-    stream = sys.stdout
-    stream = WritelnDecorator(stream)
 
-    # Load the test module
+def load_test_module(module_path: Path) -> ModuleType:
+    """
+    Import a test module from its file path and register it in sys.modules
+
+    The module's assert statements are rewritten to report the values
+    they compared, see smalltest.internals.
+
+    :param module_path: path to the python test module
+    :return: the imported module
+    """
+    from smalltest.internals import AssertRewritingLoader
+
     module_name = module_path.stem
-    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    spec = importlib.util.spec_from_file_location(
+        module_name,
+        module_path,
+        loader=AssertRewritingLoader(module_name, str(module_path)),
+    )
     module = importlib.util.module_from_spec(spec)
     sys.modules[module_name] = module
     spec.loader.exec_module(module)
+    return module
 
-    test = getattr(module, test_name)
-    result = run_test(test)
 
-    full_test_name = f"{module_name}::{test_name}"
+def get_cached_module(module_path: Path) -> tuple[ModuleType, int]:
+    """
+    Get a test module, importing it only if this process has not already
+    done so.
+
+    :param module_path: path to the python test module
+    :return: the imported module, nanoseconds spent importing it (0 if cached)
+    """
+    try:
+        return _module_cache[module_path], 0
+    except KeyError:
+        import_start = time.perf_counter_ns()
+        module = _module_cache[module_path] = load_test_module(module_path)
+        return module, time.perf_counter_ns() - import_start
 
-    match result.result_type:
-        case ResultType.SUCCESS:
-            stream.writeln(f"{full_test_name} - Success")
-        case ResultType.FAILURE:
-            stream.writeln(f"{full_test_name} - Failure")
-        case ResultType.XFAIL:
-            stream.writeln(f"{full_test_name} - XFailed")
-        case ResultType.XPASS:
-            stream.writeln(f"{full_test_name} - XPassed")
-        case ResultType.SKIP:
-            stream.writeln(f"{full_test_name} - Skipped / "
-                           f"{result.exception.args[0]}")
-        case ResultType.ERROR:
-            stream.writeln(f"{full_test_name} - ERROR")
 
-    return full_test_name, result
+def make_batches(
+        test_dict: dict[Path, list[str]],
+        batch_size: Optional[int] = None,
+) -> list[tuple[Path, list[str]]]:
+    """
+    Split the tests into module-affine batches.
+
+    Every batch only contains tests from a single module so a worker only
+    needs to import the modules for the batches it is given.
+
+    :param test_dict: { module: [test_name, ...] }
+    :param batch_size: maximum tests per batch, None keeps whole modules
+    :return: [(module, [test_name, ...]), ...]
+    """
+    batches = []
+    for module_path, test_names in test_dict.items():
+        if not test_names:
+            continue
+        if batch_size is None:
+            batches.append((module_path, list(test_names)))
+        else:
+            for i in range(0, len(test_names), batch_size):
+                batches.append((module_path, test_names[i:i + batch_size]))
+    return batches
 
 
 def run_tests_parallel(
         test_dict: dict[Path, list[str]],
         stream: Optional[TextIO] = None,
         processes: Optional[int] = None,
-        timeout: Optional[int] = None,
-) -> dict[str, TestResult]:
+        timeout: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        durations: Optional["DurationStore"] = None,
+        maxfail: Optional[int] = None,
+        run_first: Optional[Collection[str]] = None,
+        coverage_options: Optional[dict] = None,
+        start_method: Optional[str] = None,
+        preload: Collection[str] = (),
+        capture: CaptureOptions = CaptureOptions(),
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+) -> Iterator[tuple[str, TestResult]]:
+    """
+    Run the tests across a pool of worker processes.
+
+    Tests are sent to the workers in module-affine batches, each worker
+    imports a module once and runs every test it is given from that module
+    against the cached import.
+
+    If the durations from previous runs are given the batches are sized and
+    started longest first to minimise the total wall time, batch_size is
+    ignored and the predicted and actual wall time are reported at the end.
+    Batches holding any of the run_first tests are started ahead of the rest,
+    without durations the batches follow the order of test_dict.
+
+    A test still running after its timeout, from the timeout argument or
+    the smalltest.tools.timeout decorator, is recorded as a TIMEOUT result.
+    Its worker is killed and replaced and the run carries on.
+
+    Once maxfail failures have been seen the queued batches are dropped and
+    the workers still running tests are killed.
+
+    With coverage_options each worker measures coverage into its own data
+    file, see coverage_if_available in smalltest.main.
+
+    Modules in preload, such as the heavy dependencies of the project, are
+    imported once before the workers are started so no worker pays for them.
+    Workers are reused for batches from any module.
+
+    Each worker keeps its own fixtures, a session fixture is set up at most
+    once per worker.
+
+    This is a generator, results are yielded in the order the tests finish.
+
+    :param test_dict: { module: [test_name, ...] }
+    :param stream: Output stream - should be stdout/stderr or equivalent
+    :param processes: Number of worker processes, None for the CPU count
+    :param timeout: Default per-test timeout in seconds
+    :param batch_size: Maximum tests per batch, None sends whole modules
+    :param durations: Test durations recorded by previous runs
+    :param maxfail: Stop the run after this many failures or errors
+    :param run_first: { module::test_name, ... } to schedule first
+    :param coverage_options: coverage.Coverage arguments for the workers
+    :param start_method: 'fork', 'forkserver' or 'spawn', None for the default
+    :param preload: modules to import before the workers start
+    :param capture: How each worker captures the output of its tests
+    :param test_args: { module: { test_name: [parameter_name, ...] } } from
+                      discovery, None for workers to read them from each test
+    :return: iterator of (full_test_name, TestResult)
+    """
+    from .workers import run_batches
+
     stream = stream if stream else sys.stdout
     stream = WritelnDecorator(stream)
 
     test_total = sum(len(tests) for tests in test_dict.values())
+    result_count = 0
+    started_tests: set[str] = set()
 
     top_banner = (f"Smalltest: running {test_total} tests in parallel "
                   f"from {len(test_dict)} modules")
@@ -236,14 +693,218 @@ def run_tests_parallel(
     stream.writeln(top_banner)
     stream.writeln(delimiters)
 
-    test_params = [
-        (pth, test_name) for pth in test_dict.keys() for test_name in test_dict[pth]
-    ]
+    if durations is None:
+        batches = make_batches(test_dict, batch_size)
+        predicted_ns = None
+    else:
+        from .schedule import plan_batches
+        workers = processes or os.cpu_count() or 1
+        batches, predicted_ns = plan_batches(
+            test_dict, durations, workers, run_first=run_first
+        )
+
+    run_start = time.perf_counter_ns()
+
+    failure_count = 0
+    results = run_batches(
+        batches,
+        processes=processes,
+        timeout=timeout,
+        coverage_options=coverage_options,
+        start_method=start_method,
+        preload=list(preload),
+        capture=capture,
+        test_args=test_args,
+    )
+    try:
+        for full_test_name, result in results:
+            result_count += 1
+            started_tests.add(case_test_name(full_test_name))
+            write_progress(stream, full_test_name, result,
+                           len(started_tests), test_total)
+            yield full_test_name, result
+
+            if result.result_type in FAILED_RESULTS:
+                failure_count += 1
+                if maxfail is not None and failure_count >= maxfail:
+                    write_stopped(stream, failure_count, result_count,
+                                  len(started_tests), test_total)
+                    break
+    finally:
+        # Kills any workers still running tests if the run stopped early
+        results.close()
+
+    if predicted_ns is not None:
+        actual_ns = time.perf_counter_ns() - run_start
+        stream.writeln(f"Predicted wall time {predicted_ns / 1e9:.3f}s, "
+                       f"actual {actual_ns / 1e9:.3f}s")
+    stream.writeln(delimiters)
+    stream.flush()
+
 
-    with ProcessPoolExecutor(max_workers=processes) as pool:
-        results = pool.map(run_isolated_test, test_params, timeout=timeout)
+def run_tests_threaded(
+        test_dict: dict[Path, list[str]],
+        stream: Optional[TextIO] = None,
+        threads: Optional[int] = None,
+        maxfail: Optional[int] = None,
+        capture: CaptureOptions = CaptureOptions(),
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+) -> Iterator[tuple[str, TestResult]]:
+    """
+    Run the tests across a pool of threads in this process.
+
+    Suited to tests that spend their time waiting on sockets, subprocesses
+    or sleeps, without the cost of starting worker processes. Every module
+    is imported before the first test starts. The output and warnings of
+    each test are captured for its own thread, fd capture is process wide
+    so only python output is captured. Tests marked with
+    smalltest.tools.thread_unsafe run alone after the rest.
+
+    Once maxfail failures have been seen no more tests are started, the
+    tests already running are left to finish.
+
+    This is a generator, results are yielded in the order the tests finish.
 
-    sys.stdout.flush()
+    :param test_dict: { module: [test_name, ...] }
+    :param stream: Output stream - should be stdout/stderr or equivalent
+    :param threads: Number of threads, None for a default based on the
+                    CPU count
+    :param maxfail: Stop the run after this many failures or errors
+    :param capture: How the output of each test is captured
+    :param test_args: { module: { test_name: [parameter_name, ...] } } from
+                      discovery, None to read the parameters from each test
+    :return: iterator of (full_test_name, TestResult)
+    """
+    from .threads import default_threads, run_in_threads
+
+    stream = stream if stream else sys.stdout
+    stream = WritelnDecorator(stream)
+
+    test_total = sum(len(tests) for tests in test_dict.values())
+    result_count = 0
+    started_tests: set[str] = set()
+
+    top_banner = (f"Smalltest: running {test_total} tests on "
+                  f"{threads or default_threads()} threads "
+                  f"from {len(test_dict)} modules")
+
+    delimiters = "=" * len(top_banner)
+
+    stream.writeln(delimiters)
+    stream.writeln(top_banner)
+    stream.writeln(delimiters)
+
+    failure_count = 0
+    results = run_in_threads(test_dict, threads, capture, test_args)
+    try:
+        for full_test_name, result in results:
+            result_count += 1
+            started_tests.add(case_test_name(full_test_name))
+            write_progress(stream, full_test_name, result,
+                           len(started_tests), test_total)
+            yield full_test_name, result
+
+            if result.result_type in FAILED_RESULTS:
+                failure_count += 1
+                if maxfail is not None and failure_count >= maxfail:
+                    write_stopped(stream, failure_count, result_count,
+                                  len(started_tests), test_total)
+                    break
+    finally:
+        # Starts no more tests if the run stopped early
+        results.close()
+
+    stream.writeln(delimiters)
+    stream.flush()
+
+
+def run_tests_distributed(
+        test_dict: dict[Path, list[str]],
+        stream: Optional[TextIO] = None,
+        address: Any = ("127.0.0.1", 0),
+        authkey: Optional[bytes] = None,
+        timeout: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        maxfail: Optional[int] = None,
+        capture: CaptureOptions = CaptureOptions(),
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+        connect_timeout: Optional[float] = None,
+) -> Iterator[tuple[str, TestResult]]:
+    """
+    Serve the tests to workers on other machines, or other processes.
+
+    Listens on address and hands module-affine batches to the workers that
+    connect with `smalltest worker ADDRESS`, as each asks for more. Workers
+    may join or leave at any point in the run. A test whose worker
+    disconnects is recorded as an ERROR result and the rest of its batch is
+    served to another worker. See smalltest.suite.distributed.
+
+    Once maxfail failures have been seen the queued batches are dropped and
+    the workers are sent away.
+
+    This is a generator, results are yielded in the order the tests finish.
+
+    :param test_dict: { module: [test_name, ...] }
+    :param stream: Output stream - should be stdout/stderr or equivalent
+    :param address: ("host", port) to listen on, or a Unix socket path
+    :param authkey: Key shared with the workers, None for SMALLTEST_AUTHKEY
+    :param timeout: Default per-test timeout in seconds
+    :param batch_size: Maximum tests per batch, None sends whole modules
+    :param maxfail: Stop the run after this many failures or errors
+    :param capture: How each worker captures the output of its tests
+    :param test_args: { module: { test_name: [parameter_name, ...] } } from
+                      discovery, None for workers to read them from each test
+    :param connect_timeout: Seconds to wait while no worker is connected,
+                            None for the default
+    :return: iterator of (full_test_name, TestResult)
+    """
+    from .distributed import CONNECT_TIMEOUT, Coordinator, format_address
+
+    stream = stream if stream else sys.stdout
+    stream = WritelnDecorator(stream)
+
+    test_total = sum(len(tests) for tests in test_dict.values())
+    result_count = 0
+    started_tests: set[str] = set()
+
+    coordinator = Coordinator(address, authkey)
+    top_banner = (f"Smalltest: serving {test_total} tests "
+                  f"from {len(test_dict)} modules "
+                  f"on {format_address(coordinator.address)}")
+
+    delimiters = "=" * len(top_banner)
+
+    stream.writeln(delimiters)
+    stream.writeln(top_banner)
     stream.writeln(delimiters)
+    stream.flush()
+
+    failure_count = 0
+    results = coordinator.run(
+        make_batches(test_dict, batch_size),
+        timeout=timeout,
+        capture=capture,
+        test_args=test_args,
+        connect_timeout=connect_timeout if connect_timeout is not None else CONNECT_TIMEOUT,
+    )
+    try:
+        for full_test_name, result in results:
+            result_count += 1
+            started_tests.add(case_test_name(full_test_name))
+            write_progress(stream, full_test_name, result,
+                           len(started_tests), test_total)
+            yield full_test_name, result
+
+            if result.result_type in FAILED_RESULTS:
+                failure_count += 1
+                if maxfail is not None and failure_count >= maxfail:
+                    write_stopped(stream, failure_count, result_count,
+                                  len(started_tests), test_total)
+                    break
+    finally:
+        # Sends the workers away if the run stopped early
+        results.close()
+        coordinator.close()
 
-    return dict(results)
+    stream.writeln(delimiters)
+    stream.flush()
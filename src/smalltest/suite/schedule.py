@@ -0,0 +1,173 @@
+"""
+Schedule parallel test batches using the durations of previous runs.
+
+Batches are started longest first (LPT scheduling) so the long running
+tests don't start last and leave the other workers idle at the end of the
+run. Tests without a recorded duration get the median of the known tests.
+"""
+import heapq
+
+from pathlib import Path
+from typing import Collection, Iterable, Iterator, Optional
+
+from smalltest.util import read_json, write_json
+from .run import TestResult
+
+DURATIONS_VERSION = 1
+DURATIONS_FILE_NAME = "durations.json"
+
+# Estimate used when nothing has been recorded yet
+DEFAULT_ESTIMATE_NS = 1_000_000
+
+
+class DurationStore:
+    """
+    Per-test wall clock durations and per-module import times
+    persisted between runs.
+    """
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+
+        data = read_json(path, default={}) if path is not None else {}
+        if data.get("version") == DURATIONS_VERSION:
+            self.tests: dict[str, int] = data.get("tests", {})
+            self.imports: dict[str, int] = data.get("imports", {})
+        else:
+            self.tests = {}
+            self.imports = {}
+
+        self._default_test = self._median(self.tests, DEFAULT_ESTIMATE_NS)
+        self._default_import = self._median(self.imports, 0)
+
+    @staticmethod
+    def _median(durations: dict[str, int], default: int) -> int:
+        # statistics.median would import fractions and decimal on every run
+        if not durations:
+            return default
+        values = sorted(durations.values())
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) // 2
+
+    def test_estimate(self, test_name: str) -> int:
+        """Estimated nanoseconds to run module::test_name"""
+        return self.tests.get(test_name, self._default_test)
+
+    def import_estimate(self, module_name: str) -> int:
+        """Estimated nanoseconds to import a test module"""
+        return self.imports.get(module_name, self._default_import)
+
+    def record(
+            self,
+            test_results: Iterable[tuple[str, TestResult]]
+    ) -> Iterator[tuple[str, TestResult]]:
+        """
+        Record the durations of each result and pass it on unchanged.
+
+        :param test_results: Results from a test run as (test_name, TestResult)
+        :return: iterator of the same (test_name, TestResult)
+        """
+        # Cases are scheduled as part of their test so share one total
+        case_totals: dict[str, int] = {}
+        for test_name, test_result in test_results:
+            base_name, case, _ = test_name.partition("[")
+            if case:
+                case_totals[base_name] = (
+                    case_totals.get(base_name, 0) + test_result.wall_time_ns
+                )
+                self.tests[base_name] = case_totals[base_name]
+            else:
+                self.tests[test_name] = test_result.wall_time_ns
+            if test_result.import_time_ns:
+                module_name = test_name.partition("::")[0]
+                self.imports[module_name] = test_result.import_time_ns
+            yield test_name, test_result
+
+    def save(self) -> None:
+        """Write the durations to disk for the next run"""
+        if self.path is None:
+            return
+        try:
+            write_json(
+                self.path,
+                {
+                    "version": DURATIONS_VERSION,
+                    "tests": self.tests,
+                    "imports": self.imports,
+                }
+            )
+        except OSError:
+            pass
+
+
+def batch_estimate(durations: DurationStore, batch: tuple[Path, list[str]]) -> int:
+    """Estimated nanoseconds for a worker to import and run a batch"""
+    module_path, test_names = batch
+    module_name = module_path.stem
+    return durations.import_estimate(module_name) + sum(
+        durations.test_estimate(f"{module_name}::{test_name}")
+        for test_name in test_names
+    )
+
+
+def plan_batches(
+        test_dict: dict[Path, list[str]],
+        durations: DurationStore,
+        workers: int,
+        run_first: Optional[Collection[str]] = None,
+) -> tuple[list[tuple[Path, list[str]]], int]:
+    """
+    Split the tests into module-affine batches and order them longest first.
+
+    Modules estimated to take longer than an even share of the run are split
+    so a single module can't hold up the end of the run on its own.
+
+    Batches holding any of the run_first tests are started before the rest,
+    longest first among themselves.
+
+    :param test_dict: { module: [test_name, ...] }
+    :param durations: durations recorded by previous runs
+    :param workers: number of worker processes
+    :param run_first: { module::test_name, ... } to schedule ahead of the rest
+    :return: [(module, [test_name, ...]), ...], predicted wall time in ns
+    """
+    total = sum(
+        batch_estimate(durations, (module_path, test_names))
+        for module_path, test_names in test_dict.items()
+    )
+    share = max(total // max(workers, 1), 1)
+
+    estimated_batches = []
+    for module_path, test_names in test_dict.items():
+        if not test_names:
+            continue
+        module_name = module_path.stem
+        import_time = durations.import_estimate(module_name)
+
+        current, current_time = [], import_time
+        for test_name in test_names:
+            test_time = durations.test_estimate(f"{module_name}::{test_name}")
+            if current and current_time + test_time > share:
+                estimated_batches.append((current_time, (module_path, current)))
+                current, current_time = [], import_time
+            current.append(test_name)
+            current_time += test_time
+        estimated_batches.append((current_time, (module_path, current)))
+
+    # Stable sort keeps discovery order for batches with equal estimates
+    estimated_batches.sort(key=lambda item: item[0], reverse=True)
+    if run_first:
+        estimated_batches.sort(
+            key=lambda item: not any(
+                f"{item[1][0].stem}::{test_name}" in run_first
+                for test_name in item[1][1]
+            )
+        )
+
+    # Each batch goes to whichever worker is free first
+    worker_loads = [0] * max(workers, 1)
+    for estimate, _ in estimated_batches:
+        heapq.heapreplace(worker_loads, worker_loads[0] + estimate)
+
+    return [batch for _, batch in estimated_batches], max(worker_loads)
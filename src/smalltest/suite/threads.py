@@ -0,0 +1,215 @@
+"""
+Thread pool for the threaded runner.
+
+Every test module is imported on the calling thread before any test starts.
+Each test, and each case of a parametrized test, is then run as its own job
+on a ThreadPoolExecutor. Cases are produced on the calling thread as jobs
+finish, at most JOBS_PER_THREAD jobs per thread are queued at a time so a
+generator of cases is never read all at once. Results are passed back
+through a queue and yielded on the calling thread in the order they finish.
+
+Output and warnings are captured per thread through routed_output in
+smalltest.suite.capture. Each thread keeps its own capture and its own
+FixtureManager. Session fixtures are shared by every thread and set up once
+for the run, module fixtures are set up by each thread that runs a test of
+the module.
+Nothing else is shared between the threads, on a free-threaded build of
+CPython the tests run truly in parallel.
+
+The CPU time of a test on the pool is that of its own thread, any threads
+the test starts itself aren't counted.
+
+Tests marked with smalltest.tools.thread_unsafe run one at a time on the
+calling thread after the pool has finished. Tests that fork, or change
+process wide state such as the working directory, need the marker.
+"""
+import os
+import queue
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from types import ModuleType
+from typing import Callable, Iterator, Optional, Union
+
+from smalltest.tools import THREAD_UNSAFE_ATTRIBUTE
+from .capture import Capture, CaptureOptions, record_warnings, routed_output
+from .cases import case_name, is_parametrized, iter_cases
+from .fixtures import FixtureManager
+from .run import (
+    TestResult,
+    case_error,
+    iter_module_tests,
+    load_test_module,
+    run_test,
+    fixtures_for_test,
+)
+
+# A test to run: (module, test_name, import_time_ns, module_args)
+ThreadedTest = tuple[ModuleType, str, int, Optional[dict[str, list[str]]]]
+
+# A job for the pool: (module, full_test_name, test_callable, fixture_names,
+# import_time_ns), or (full_test_name, TestResult) for cases that couldn't
+# be produced
+Job = Union[tuple[ModuleType, str, Callable, list[str], int], tuple[str, TestResult]]
+
+# Jobs queued for each thread ahead of the results being read
+JOBS_PER_THREAD = 2
+
+
+def default_threads() -> int:
+    """Same default as ThreadPoolExecutor, tests are expected to wait on I/O"""
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def collect_tests(
+        test_dict: dict[Path, list[str]],
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+) -> tuple[list[ThreadedTest], list[ThreadedTest]]:
+    """
+    Import every test module and split the tests into those that can run
+    on the pool and those marked thread_unsafe.
+
+    :return: ([thread safe test, ...], [thread unsafe test, ...])
+    """
+    safe, unsafe = [], []
+    for module_path, test_names in test_dict.items():
+        import_start = time.perf_counter_ns()
+        module = load_test_module(module_path)
+        import_time_ns = time.perf_counter_ns() - import_start
+        module_args = test_args.get(module_path) if test_args is not None else None
+
+        for test_name in test_names:
+            test = getattr(module, test_name)
+            tests = unsafe if getattr(test, THREAD_UNSAFE_ATTRIBUTE, False) else safe
+            tests.append((module, test_name, import_time_ns, module_args))
+            # Import time is recorded on the first test of each module
+            import_time_ns = 0
+    return safe, unsafe
+
+
+def iter_jobs(tests: list[ThreadedTest]) -> Iterator[Job]:
+    """
+    Jobs for the pool, the cases of a parametrized test are only produced
+    as the jobs are taken.
+    """
+    for module, test_name, import_time_ns, module_args in tests:
+        test = getattr(module, test_name)
+        names = fixtures_for_test(test, test_name, module_args)
+        if not is_parametrized(test):
+            yield module, test_name, test, names, import_time_ns
+            continue
+        try:
+            for case_id, case in iter_cases(test):
+                yield module, case_name(test_name, case_id), case, names, import_time_ns
+                import_time_ns = 0
+        except Exception as e:
+            # The cases themselves couldn't be produced
+            yield f"{module.__name__}::{test_name}", case_error(e)
+
+
+class _ThreadState(threading.local):
+    """Capture and fixtures kept by each thread for the whole run"""
+    capture: Optional[Capture] = None
+    fixtures: Optional[FixtureManager] = None
+
+
+def run_in_threads(
+        test_dict: dict[Path, list[str]],
+        threads: Optional[int] = None,
+        capture: CaptureOptions = CaptureOptions(),
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+) -> Iterator[tuple[str, TestResult]]:
+    """
+    Run the tests across a pool of threads, yielding results in the order
+    the tests finish.
+
+    Closing the generator early lets the running tests finish but starts
+    no more.
+
+    :param test_dict: { module: [test_name, ...] }
+    :param threads: Number of threads, None for default_threads
+    :param capture: How each thread captures the output of its tests
+    :param test_args: { module: { test_name: [parameter_name, ...] } } from
+                      discovery, None to read the parameters from each test
+    :return: iterator of (full_test_name, TestResult)
+    """
+    threads = threads or default_threads()
+    safe, unsafe = collect_tests(test_dict, test_args)
+
+    state = _ThreadState()
+    # Owns the session fixtures every thread shares
+    session_fixtures = FixtureManager()
+    made: list[tuple[Capture, FixtureManager]] = []
+    made_lock = threading.Lock()
+    # (full_test_name, TestResult) or the Future of a finished job
+    results: queue.Queue = queue.Queue()
+
+    def run_job(module, full_name, call, names, import_time_ns) -> None:
+        if state.capture is None:
+            state.capture = capture.make_concurrent()
+            state.fixtures = session_fixtures.sharing_session()
+            with made_lock:
+                made.append((state.capture, state.fixtures))
+        state.fixtures.enter_module(module)
+        if names:
+            call = state.fixtures.bind(call, names)
+        # Process CPU time would include the tests on the other threads
+        result = run_test(call, state.capture, record_warnings, time.thread_time_ns)
+        if import_time_ns:
+            result = result._replace(import_time_ns=import_time_ns)
+        results.put((f"{module.__name__}::{full_name}", result))
+
+    with routed_output():
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="smalltest")
+        try:
+            jobs = iter_jobs(safe)
+            queued = 0
+            while True:
+                while jobs is not None and queued < threads * JOBS_PER_THREAD:
+                    job = next(jobs, None)
+                    if job is None:
+                        jobs = None
+                    elif len(job) == 2:
+                        yield job
+                    else:
+                        executor.submit(run_job, *job).add_done_callback(results.put)
+                        queued += 1
+                if not queued:
+                    break
+
+                item = results.get()
+                if isinstance(item, Future):
+                    queued -= 1
+                    # Raise anything that went wrong outside of a test
+                    item.result()
+                else:
+                    yield item
+            executor.shutdown(wait=True)
+            for test_capture, fixtures in made:
+                fixtures.close()
+                test_capture.close()
+            made.clear()
+
+            if unsafe:
+                test_capture = capture.make_concurrent()
+                try:
+                    for module, test_name, import_time_ns, module_args in unsafe:
+                        yield from iter_module_tests(
+                            module,
+                            [test_name],
+                            import_time_ns,
+                            test_capture,
+                            session_fixtures,
+                            module_args,
+                            record_warnings,
+                        )
+                finally:
+                    test_capture.close()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for test_capture, fixtures in made:
+                fixtures.close()
+                test_capture.close()
+            session_fixtures.close()
@@ -0,0 +1,214 @@
+"""
+Rerun the tests affected by each save from a long lived process.
+
+The project is polled for python files whose modification time or size
+changed. The import graph from depgraph picks the test modules that depend
+on a changed file and only those are run again. Project modules that depend
+on a changed file are dropped from sys.modules so the next import runs the
+new source, everything else, including third party packages, stays
+imported between runs.
+"""
+import os
+import sys
+import time
+
+from collections import Counter
+from pathlib import Path
+from typing import Optional, TextIO, Union
+
+from smalltest.util import get_cache_folder
+from .depgraph import DependencyGraph, module_search_roots
+from .discover import (
+    IGNORE_FOLDER_NAMES,
+    _compile_patterns,
+    _sorted_scandir,
+    discover_tests,
+)
+from .report import text_reporter
+from .run import run_tests_serial
+
+POLL_INTERVAL = 0.25
+
+
+def scan_python_files(
+        base_path: Path,
+        ignore_folder_names: list[str] = IGNORE_FOLDER_NAMES,
+) -> dict[Path, tuple[int, int]]:
+    """
+    Modification time and size of every python file under base_path.
+
+    :param base_path: Folder to search
+    :param ignore_folder_names: glob wildcard foldernames to skip
+    :return: { path: (mtime_ns, size) }
+    """
+    ignore_match = _compile_patterns(ignore_folder_names)
+    found = {}
+    stack = [base_path]
+    while stack:
+        for entry in _sorted_scandir(stack.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                if not ignore_match(entry.name):
+                    stack.append(entry.path)
+            elif entry.name.endswith(".py"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                found[Path(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+    return found
+
+
+class Watcher:
+    """
+    Track the python files of a project and run the tests affected by
+    each change in this process.
+    """
+    def __init__(
+            self,
+            base_path: Union[str, Path],
+            stream: Optional[TextIO] = None,
+            strict_xfail: bool = False,
+            use_index: bool = True,
+    ):
+        self.base_path = Path(base_path).absolute()
+        self.stream = stream if stream else sys.stdout
+        self.strict_xfail = strict_xfail
+        self.use_index = use_index
+
+        self.roots = module_search_roots(self.base_path)
+        # Shared between runs so unchanged files are never parsed again
+        self.file_cache: dict[str, dict] = {}
+        # { file: {dependency, ...} } from the last run, a dependency that
+        # has been deleted no longer shows up in a fresh closure
+        self.closures: dict[Path, set[Path]] = {}
+        self.snapshot = scan_python_files(self.base_path)
+
+    def changed_files(self) -> set[Path]:
+        """Files modified, added or removed since the last call"""
+        current = scan_python_files(self.base_path)
+        changed = {
+            pth for pth in current.keys() | self.snapshot.keys()
+            if current.get(pth) != self.snapshot.get(pth)
+        }
+        self.snapshot = current
+        return changed
+
+    def _affected(
+            self,
+            graph: DependencyGraph,
+            changed: set[Path],
+            affected: dict[Path, bool],
+            pth: Path,
+    ) -> bool:
+        """Check if pth depends on a changed file now or as of the last run"""
+        if pth not in affected:
+            previous = self.closures.get(pth, set())
+            self.closures[pth] = set(graph.closure(pth))
+            affected[pth] = not changed.isdisjoint(self.closures[pth] | previous)
+        return affected[pth]
+
+    def evict_modules(
+            self,
+            graph: DependencyGraph,
+            changed: set[Path],
+            affected: Optional[dict[Path, bool]] = None,
+    ) -> list[str]:
+        """
+        Remove project modules that depend on a changed file from
+        sys.modules. Modules from outside the project are kept.
+
+        :param graph: Import graph of the project
+        :param changed: absolute paths of the changed files
+        :param affected: { path: depends on a change } shared within a run
+        :return: [module_name, ...] that were removed
+        """
+        affected = affected if affected is not None else {}
+        evicted = []
+        for name, module in list(sys.modules.items()):
+            module_file = getattr(module, "__file__", None)
+            if not module_file:
+                continue
+            pth = Path(module_file).absolute()
+            if not pth.is_relative_to(self.base_path):
+                continue
+            if self._affected(graph, changed, affected, pth):
+                del sys.modules[name]
+                evicted.append(name)
+        return evicted
+
+    def run(self, changed: Optional[set[Path]] = None) -> Counter:
+        """
+        Run the tests affected by the changed files, or every test.
+
+        :param changed: absolute paths from changed_files, None to run all
+        :return: Counter of ResultType from the text reporter
+        """
+        graph = DependencyGraph(self.roots, self.file_cache)
+        tests = discover_tests(self.base_path, use_index=self.use_index)
+
+        if changed is None:
+            for pth in tests:
+                self.closures[pth] = set(graph.closure(pth))
+        else:
+            affected: dict[Path, bool] = {}
+            self.evict_modules(graph, changed, affected)
+            tests = {
+                pth: test_names for pth, test_names in tests.items()
+                if self._affected(graph, changed, affected, pth)
+            }
+
+        if not tests:
+            self.stream.write("No tests affected\n")
+            return Counter()
+        return text_reporter(
+            run_tests_serial(tests, stream=self.stream),
+            stream=self.stream,
+            strict_xfail=self.strict_xfail,
+        )
+
+
+def watch_tests(
+        base_path: Optional[Union[str, Path]] = None,
+        stream: Optional[TextIO] = None,
+        strict_xfail: bool = False,
+        interval: float = POLL_INTERVAL,
+        use_index: bool = True,
+) -> None:
+    """
+    Run every test then keep rerunning the affected tests after each
+    change until interrupted.
+
+    :param base_path: Search path root, the current directory if not given
+    :param stream: Output stream - should be stdout/stderr or equivalent
+    :param strict_xfail: Treat XPASS as failure
+    :param interval: seconds between polls of the project files
+    :param use_index: Use the discovery index and the rewritten asserts
+                      stored in .smalltest_cache
+    """
+    if use_index:
+        from smalltest.internals import set_cache_folder, REWRITE_FOLDER_NAME
+        set_cache_folder(get_cache_folder(base_path) / REWRITE_FOLDER_NAME)
+    watcher = Watcher(
+        base_path if base_path else Path.cwd(),
+        stream=stream,
+        strict_xfail=strict_xfail,
+        use_index=use_index,
+    )
+    changed = None
+    while True:
+        try:
+            watcher.run(changed)
+        except Exception as e:
+            import traceback
+            traceback.print_exception(e, file=watcher.stream)
+        watcher.stream.write("\nWatching for changes, Ctrl-C to stop\n")
+        watcher.stream.flush()
+
+        changed = set()
+        while not changed:
+            time.sleep(interval)
+            changed = watcher.changed_files()
+        names = ", ".join(
+            os.path.relpath(pth, watcher.base_path) for pth in sorted(changed)
+        )
+        watcher.stream.write(f"\nChanged: {names}\n")
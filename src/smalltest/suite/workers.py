@@ -0,0 +1,547 @@
+"""
+Worker processes for the parallel runner.
+
+Each worker is a separate process connected to the parent by its own pipe.
+The parent hands a worker one module-affine batch at a time and the worker
+reports when each test starts and finishes. This lets the parent enforce
+per-test timeouts: a worker stuck in a test past its deadline is killed
+and replaced, the test is recorded as a timeout and the rest of its batch
+is sent to the next free worker.
+
+Messages from the parent to a worker:
+    ("batch", module_path,
+     [test_name or (test_name, case_offset[, stop]), ...],
+     {test_name: [parameter_name, ...]} or None)
+    None - exit
+
+Messages from a worker to the parent:
+    ("start", test_name, timeout or None)
+    ("result", full_test_name, TestResult)
+    ("case", full_test_name, TestResult, (test_name, next_case_offset))
+    ("split", (test_name, offset, stop), (test_name, stop) or None)
+    ("chunk",)
+    ("done",)
+    ("error", formatted_traceback)
+
+A parametrized test in a batch runs at most CASE_BATCH_SIZE cases, starting
+from its case offset. Before running them the worker sends "split", which
+bounds the test's place in the batch to the chunk and, if the test has cases
+left, queues the rest for the next free worker. So the chunks of one test
+run on several workers at once. Each finished case moves the test's place
+in the batch on to the next offset, "chunk" takes the test out of the batch
+once its chunk is done. A chunk with a stop offset, the rest of a chunk
+whose worker was lost, is never split again. Workers keep their place in
+the cases of each test so a later chunk carries on rather than producing
+the earlier cases again.
+
+Workers are started with the platform's default start method unless
+another is given: fork on Linux before Python 3.14, spawn on macOS and
+Windows, forkserver on Linux from 3.14. Modules listed to preload are
+imported before the workers start: in the parent for fork, in the
+forkserver process for forkserver, so every worker begins with them
+already imported. With spawn each worker imports them as it starts. A worker
+is reused for batches from any module until the run ends.
+
+Each worker has one FixtureManager for its lifetime so session fixtures are
+set up at most once per worker and torn down when it exits.
+
+The same messages are sent over sockets to the workers of a distributed
+run, WorkerHandle, handle_message and lost_test are shared with the
+coordinator in smalltest.suite.distributed.
+"""
+import importlib
+import multiprocessing
+import os
+import time
+import traceback
+
+from collections import deque
+from multiprocessing.connection import Connection, wait
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+
+from smalltest.tools import TIMEOUT_ATTRIBUTE
+from .capture import Capture, CaptureOptions
+from .cases import CASE_BATCH_SIZE, CaseCursor, case_name, is_parametrized
+from .fixtures import FixtureManager
+from .run import (
+    ErrorDetails,
+    ResultType,
+    TestResult,
+    case_error,
+    get_cached_module,
+    run_test,
+    fixtures_for_test,
+)
+
+# A test name, or a parametrized test and the offset of its next case,
+# with the offset its chunk stops at once the chunk has been split off
+BatchItem = Union[str, tuple[str, int], tuple[str, int, int]]
+
+# Seconds to let an idle worker exit before it is killed
+WORKER_EXIT_TIMEOUT = 1.0
+
+# Seconds between an idle worker checking the parent is still alive
+PARENT_CHECK_INTERVAL = 1.0
+
+
+class WorkerError(Exception):
+    """An error in a worker outside of running a test, such as a test
+    module that fails to import"""
+
+
+# Place in the cases of each parametrized test this worker has run
+_case_cursors: dict[tuple[Path, str], CaseCursor] = {}
+
+
+def run_worker_batch(
+        conn: Connection,
+        module_path: Path,
+        items: list[BatchItem],
+        capture: Optional[Capture] = None,
+        fixtures: Optional[FixtureManager] = None,
+        module_args: Optional[dict[str, list[str]]] = None,
+) -> None:
+    """
+    Run a batch of tests in a worker, reporting the start and result of
+    each test over the connection.
+    """
+    module, import_time_ns = get_cached_module(module_path)
+    module_name = module.__name__
+    if fixtures is not None:
+        fixtures.enter_module(module)
+
+    for item in items:
+        test_name, offset, stop = (
+            (item, 0, None) if isinstance(item, str) else (*item, None)[:3]
+        )
+        test = getattr(module, test_name)
+        test_timeout = getattr(test, TIMEOUT_ATTRIBUTE, None)
+        names = []
+        if fixtures is not None:
+            names = fixtures_for_test(test, test_name, module_args)
+
+        if not is_parametrized(test):
+            conn.send(("start", test_name, test_timeout))
+            result = run_test(fixtures.bind(test, names) if names else test, capture)
+            if import_time_ns:
+                result = result._replace(import_time_ns=import_time_ns)
+                import_time_ns = 0
+            conn.send(("result", f"{module_name}::{test_name}", result))
+            continue
+
+        cursor = _case_cursors.get((module_path, test_name))
+        if cursor is None or cursor.test is not test:
+            cursor = _case_cursors[module_path, test_name] = CaseCursor(test)
+        rest = None
+        try:
+            if stop is None:
+                stop = offset + CASE_BATCH_SIZE
+                # Produced up front to know if any cases are left for others
+                chunk = list(cursor.take(offset, stop - offset))
+                if cursor.more():
+                    rest = (test_name, stop)
+            else:
+                chunk = list(cursor.take(offset, stop - offset))
+        except Exception as e:
+            # The cases themselves couldn't be produced
+            conn.send(("start", test_name, None))
+            conn.send(("result", f"{module_name}::{test_name}", case_error(e)))
+            continue
+
+        # Any free worker can take the rest while this chunk runs
+        conn.send(("split", (test_name, offset, stop), rest))
+        for case_offset, case_id, case in chunk:
+            full_name = case_name(test_name, case_id)
+            conn.send(("start", full_name, test_timeout))
+            result = run_test(fixtures.bind(case, names) if names else case, capture)
+            if import_time_ns:
+                result = result._replace(import_time_ns=import_time_ns)
+                import_time_ns = 0
+            conn.send((
+                "case",
+                f"{module_name}::{full_name}",
+                result,
+                (test_name, case_offset + 1, stop),
+            ))
+        conn.send(("chunk",))
+
+
+def start_coverage(coverage_options: dict):
+    """
+    Start measuring coverage in a worker. Each worker writes its own data
+    file, named from the data_file option with a unique suffix, for the
+    parent to combine.
+
+    :param coverage_options: keyword arguments for coverage.Coverage
+    :return: the running coverage.Coverage
+    """
+    import coverage
+    cov = coverage.Coverage(data_suffix=True, **coverage_options)
+    cov.start()
+    return cov
+
+
+def preload_modules(module_names: Sequence[str]) -> None:
+    """Import modules so processes forked afterwards already have them"""
+    for module_name in module_names:
+        importlib.import_module(module_name)
+
+
+def worker_main(
+        conn: Connection,
+        coverage_options: Optional[dict] = None,
+        preload: Sequence[str] = (),
+        capture: CaptureOptions = CaptureOptions(),
+) -> None:
+    """
+    Main loop of a worker process, run batches until told to exit or the
+    parent goes away.
+
+    :param conn: connection to the parent
+    :param coverage_options: measure coverage with these coverage.Coverage
+                             arguments, None to not measure coverage
+    :param preload: modules to import before the first batch, already
+                    imported unless the worker was spawned
+    :param capture: How the output of each test is captured, the capture
+                    is made once and reused for every test
+    """
+    parent_pid = os.getppid()
+    cov = start_coverage(coverage_options) if coverage_options else None
+    test_capture = capture.make()
+    fixtures = FixtureManager()
+    try:
+        preload_modules(preload)
+        while True:
+            # Forked siblings share the parent's end of the pipe so EOF alone
+            # can't be relied on to notice the parent has died.
+            while not conn.poll(PARENT_CHECK_INTERVAL):
+                if os.getppid() != parent_pid:
+                    return
+            message = conn.recv()
+            if message is None:
+                break
+
+            _, module_path, test_names, module_args = message
+            try:
+                run_worker_batch(
+                    conn, module_path, test_names, test_capture, fixtures, module_args
+                )
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+            else:
+                conn.send(("done",))
+    except (EOFError, OSError, KeyboardInterrupt):
+        # The parent has gone away
+        pass
+    finally:
+        fixtures.close()
+        test_capture.close()
+        conn.close()
+        # A worker killed for a timeout loses its coverage data
+        if cov is not None:
+            cov.stop()
+            cov.save()
+
+
+class WorkerHandle:
+    """
+    Parent side view of a worker connected by conn: the batch it is
+    running and the test it is part way through.
+    """
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.module_path: Optional[Path] = None
+        # Tests of the current batch that haven't finished
+        self.remaining: deque[BatchItem] = deque()
+        # Test currently running and when it must finish by
+        self.test_name: Optional[str] = None
+        self.test_start = 0.0
+        self.test_timeout: Optional[float] = None
+
+    @property
+    def busy(self) -> bool:
+        return self.module_path is not None
+
+    @property
+    def deadline(self) -> Optional[float]:
+        if self.test_name is None or self.test_timeout is None:
+            return None
+        return self.test_start + self.test_timeout
+
+    def assign(
+            self,
+            batch: tuple[Path, list[BatchItem]],
+            module_args: Optional[dict[str, list[str]]] = None,
+    ) -> None:
+        self.module_path, test_names = batch
+        self.remaining = deque(test_names)
+        self.conn.send(("batch", self.module_path, test_names, module_args))
+
+    def finish_batch(self) -> None:
+        self.module_path = None
+        self.remaining = deque()
+        self.test_name = None
+
+
+class LocalWorker(WorkerHandle):
+    """Parent side handle for a worker process"""
+    def __init__(
+            self,
+            context,
+            coverage_options: Optional[dict] = None,
+            preload: Sequence[str] = (),
+            capture: CaptureOptions = CaptureOptions(),
+    ):
+        conn, child_conn = context.Pipe()
+        # Not a daemon so tests can start processes of their own,
+        # a worker exits by itself when the parent's end of the pipe closes.
+        self.process = context.Process(
+            target=worker_main,
+            args=(child_conn, coverage_options, preload, capture),
+        )
+        self.process.start()
+        child_conn.close()
+        super().__init__(conn)
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self) -> None:
+        """Ask an idle worker to exit, killing it if it doesn't"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(WORKER_EXIT_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def handle_message(
+        worker: WorkerHandle,
+        message: tuple,
+        pending: deque,
+        timeout: Optional[float] = None,
+) -> Optional[tuple[str, TestResult]]:
+    """
+    Follow a worker through its batch from one of its messages.
+
+    :param worker: the worker that sent the message
+    :param message: message from the worker, see the module docstring
+    :param pending: queue of batches, the rest of a split test goes on the front
+    :param timeout: Default per-test timeout in seconds, None for no limit
+    :return: (full_test_name, TestResult) for a finished test, otherwise None
+    """
+    match message:
+        case ("start", test_name, test_timeout):
+            worker.test_name = test_name
+            worker.test_start = time.monotonic()
+            worker.test_timeout = (
+                test_timeout if test_timeout is not None else timeout
+            )
+        case ("result", full_test_name, result):
+            worker.remaining.popleft()
+            worker.test_name = None
+            return full_test_name, result
+        case ("case", full_test_name, result, next_item):
+            worker.remaining[0] = next_item
+            worker.test_name = None
+            return full_test_name, result
+        case ("split", chunk_item, rest_item):
+            worker.remaining[0] = chunk_item
+            if rest_item is not None:
+                # Any free worker can take the next chunk
+                pending.appendleft((worker.module_path, [rest_item]))
+        case ("chunk",):
+            worker.remaining.popleft()
+        case ("done",):
+            worker.finish_batch()
+        case ("error", formatted_traceback):
+            raise WorkerError(formatted_traceback)
+    return None
+
+
+def lost_test(
+        worker: WorkerHandle,
+        result_type: ResultType,
+        message: str,
+        pending: deque,
+) -> tuple[str, TestResult]:
+    """
+    Record the test a worker was running as lost and requeue the rest of
+    its batch at the front of pending.
+
+    :param worker: worker that died, or was stopped, part way through a test
+    :param result_type: ResultType.ERROR or ResultType.TIMEOUT
+    :param message: why the test was lost
+    :param pending: queue of batches
+    :return: (full_test_name, TestResult) for the lost test
+    """
+    elapsed = time.monotonic() - worker.test_start
+    full_test_name = f"{worker.module_path.stem}::{worker.test_name}"
+    result = TestResult(
+        result_type,
+        ErrorDetails((message,), name=result_type.name.title()),
+        "",
+        "",
+        [],
+        wall_time_ns=int(elapsed * 1e9),
+    )
+
+    item = worker.remaining.popleft()
+    if "[" in worker.test_name:
+        # Carry on with the cases after the lost one, up to the end of its
+        # chunk as the rest of the test was split off before it ran
+        test_name, offset, stop = item
+        if offset + 1 < stop:
+            worker.remaining.appendleft((test_name, offset + 1, stop))
+    if worker.remaining:
+        pending.appendleft((worker.module_path, list(worker.remaining)))
+    worker.finish_batch()
+    return full_test_name, result
+
+
+def run_batches(
+        batches: list[tuple[Path, list[str]]],
+        processes: Optional[int] = None,
+        timeout: Optional[float] = None,
+        coverage_options: Optional[dict] = None,
+        start_method: Optional[str] = None,
+        preload: Sequence[str] = (),
+        capture: CaptureOptions = CaptureOptions(),
+        test_args: Optional[dict[Path, dict[str, list[str]]]] = None,
+) -> Iterator[tuple[str, TestResult]]:
+    """
+    Run batches of tests across worker processes, yielding results in the
+    order the tests finish.
+
+    A worker running a test past its timeout is killed and replaced. If a
+    worker dies the test it was running is recorded as an error. In both
+    cases the rest of the batch is sent back to the front of the queue.
+
+    Closing the generator early kills any workers still running tests.
+
+    :param batches: [(module_path, [test_name, ...]), ...]
+    :param processes: Number of worker processes, None for the CPU count
+    :param timeout: Default per-test timeout in seconds, None for no limit
+    :param coverage_options: coverage.Coverage arguments for the workers,
+                             None to not measure coverage
+    :param start_method: multiprocessing start method, None for the default
+    :param preload: modules every worker should start with imported
+    :param capture: How the workers capture the output of each test
+    :param test_args: { module_path: { test_name: [parameter_name, ...] } }
+                      from discovery, None for workers to read them
+    :return: iterator of (full_test_name, TestResult)
+    """
+    context = multiprocessing.get_context(start_method)
+    method = context.get_start_method()
+
+    worker_preload: Sequence[str] = ()
+    if method == "fork":
+        preload_modules(preload)
+    elif method == "forkserver":
+        # Only applies if this process hasn't started its forkserver yet
+        context.set_forkserver_preload(["smalltest.suite.workers", *preload])
+    else:
+        worker_preload = preload
+
+    def start_worker() -> LocalWorker:
+        return LocalWorker(context, coverage_options, worker_preload, capture)
+
+    pending = deque(batches)
+    max_workers = processes or os.cpu_count() or 1
+    workers = [start_worker() for _ in range(min(max_workers, len(pending)))]
+
+    def replace(worker: LocalWorker) -> None:
+        worker.kill()
+        workers[workers.index(worker)] = start_worker()
+
+    def abandon(
+            worker: LocalWorker,
+            result_type: ResultType,
+            message: str
+    ) -> tuple[str, TestResult]:
+        """Record the running test as lost and requeue the rest of the batch"""
+        if worker.test_name is None:
+            # Died outside a test, don't retry a module that can't be imported
+            raise WorkerError(
+                f"Worker exited while loading {worker.module_path}: {message}"
+            )
+        lost = lost_test(worker, result_type, message, pending)
+        replace(worker)
+        return lost
+
+    try:
+        while True:
+            for worker in workers:
+                if not worker.busy and pending:
+                    batch = pending.popleft()
+                    worker.assign(
+                        batch,
+                        test_args.get(batch[0]) if test_args is not None else None,
+                    )
+            # Chunks split off a parametrized test can outnumber the batches
+            # the pool was sized for
+            while pending and len(workers) < max_workers:
+                worker = start_worker()
+                workers.append(worker)
+                batch = pending.popleft()
+                worker.assign(
+                    batch,
+                    test_args.get(batch[0]) if test_args is not None else None,
+                )
+
+            busy = [worker for worker in workers if worker.busy]
+            if not busy:
+                break
+
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            wait_time = None
+            if deadlines:
+                wait_time = max(min(deadlines) - time.monotonic(), 0)
+
+            ready = wait([worker.conn for worker in busy], timeout=wait_time)
+            for worker in busy:
+                if worker.conn not in ready:
+                    continue
+                try:
+                    message = worker.conn.recv()
+                except (EOFError, OSError):
+                    worker.process.join()
+                    yield abandon(
+                        worker,
+                        ResultType.ERROR,
+                        f"Worker process exited unexpectedly "
+                        f"with code {worker.process.exitcode}"
+                    )
+                    continue
+
+                finished = handle_message(worker, message, pending, timeout)
+                if finished is not None:
+                    yield finished
+
+            now = time.monotonic()
+            for worker in list(workers):
+                deadline = worker.deadline
+                # A result that arrived since the wait saves the worker
+                if (
+                    deadline is not None
+                    and now >= deadline
+                    and not worker.conn.poll()
+                ):
+                    yield abandon(
+                        worker,
+                        ResultType.TIMEOUT,
+                        f"Test timed out after {worker.test_timeout}s"
+                    )
+    finally:
+        for worker in workers:
+            if worker.busy:
+                worker.kill()
+            else:
+                worker.stop()
@@ -1,2 +1,3 @@
-from ._modifiers import skip, skipif, xfail, XPassMarker, XFailMarker, SkipMarker
+from ._modifiers import skip, skipif, xfail, timeout, thread_unsafe, parametrize, fixture, XPassMarker, XFailMarker, SkipMarker
+from ._modifiers import TIMEOUT_ATTRIBUTE, THREAD_UNSAFE_ATTRIBUTE, PARAMETRIZE_ATTRIBUTE, FIXTURE_ATTRIBUTE, FIXTURE_SCOPES
 from ._exception import raises
@@ -1,8 +1,24 @@
 """
 Special test decorators to mark for skip/xfail/parameterized tests
+and to define fixtures
 """
+import inspect
+
 from functools import wraps
 
+# Attribute holding the per-test timeout set by the timeout decorator
+TIMEOUT_ATTRIBUTE = "__smalltest_timeout__"
+
+# Attribute set by thread_unsafe on tests the threaded runner must run alone
+THREAD_UNSAFE_ATTRIBUTE = "__smalltest_thread_unsafe__"
+
+# Attribute holding [(argnames, argvalues, ids), ...] set by parametrize
+PARAMETRIZE_ATTRIBUTE = "__smalltest_parametrize__"
+
+# Attribute holding the scope of a function marked with the fixture decorator
+FIXTURE_ATTRIBUTE = "__smalltest_fixture__"
+FIXTURE_SCOPES = ("function", "module", "session")
+
 
 # Normally a test can only pass or fail, provide special exceptions
 # for alternative  test conditions
@@ -25,7 +41,7 @@ class SkipMarker(MarkerException):
 def skip(reason=''):
     def skipped(func):
         @wraps(func)
-        def inner():
+        def inner(*args, **kwargs):
             raise SkipMarker(reason)
         return inner
     return skipped
@@ -35,7 +51,7 @@ def skipif(condition, reason=''):
     def skipped(func):
         if condition:
             @wraps(func)
-            def inner():
+            def inner(*args, **kwargs):
                 raise SkipMarker(reason)
             return inner
         else:
@@ -45,11 +61,21 @@ def skipif(condition, reason=''):
 
 def xfail(condition=True, reason=''):
     def xfailed(func):
-        if condition:
+        if condition and inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_inner(*args, **kwargs):
+                try:
+                    await func(*args, **kwargs)
+                except AssertionError as e:
+                    raise XFailMarker(reason, *e.args)
+                else:
+                    raise XPassMarker(reason)
+            return async_inner
+        elif condition:
             @wraps(func)
-            def inner():
+            def inner(*args, **kwargs):
                 try:
-                    func()
+                    func(*args, **kwargs)
                 except AssertionError as e:
                     raise XFailMarker(reason, *e.args)
                 else:
@@ -58,3 +84,84 @@ def xfail(condition=True, reason=''):
         else:
             return func
     return xfailed
+
+
+def timeout(seconds):
+    """
+    Limit how long a test may run before it is stopped and recorded
+    as a timeout. Only enforced by the parallel runner.
+    """
+    def timed(func):
+        setattr(func, TIMEOUT_ATTRIBUTE, seconds)
+        return func
+    return timed
+
+
+def thread_unsafe(func):
+    """
+    Mark a test that can't run alongside other tests in the same process,
+    such as one that changes the working directory or global state. The
+    threaded runner runs these on its own thread once the other tests have
+    finished.
+    """
+    setattr(func, THREAD_UNSAFE_ATTRIBUTE, True)
+    return func
+
+
+def parametrize(argnames, argvalues, ids=None):
+    """
+    Run a test once for each case in argvalues, each case is reported as
+    its own module::test_name[case_id] result.
+
+    The cases are only produced as the test runs, so argvalues can be a
+    generator of any length. A callable returning an iterable is called
+    again whenever the cases are needed, a generator can only be read once
+    by each process.
+
+    Stacking the decorator runs every combination of the cases, the
+    decorator closest to the function is read lazily and the others are
+    read into lists.
+
+    :param argnames: "name", "first, second" or ["first", "second"]
+    :param argvalues: iterable of values, tuples when there are several
+                      names, or a callable returning such an iterable
+    :param ids: iterable of case ids or a callable taking each value,
+                ids are made from the values if not given
+    """
+    if isinstance(argnames, str):
+        argnames = [name.strip() for name in argnames.split(",") if name.strip()]
+    argnames = list(argnames)
+
+    def parametrized(func):
+        params = getattr(func, PARAMETRIZE_ATTRIBUTE, [])
+        setattr(func, PARAMETRIZE_ATTRIBUTE, [*params, (argnames, argvalues, ids)])
+        return func
+    return parametrized
+
+
+def fixture(func=None, *, scope="function"):
+    """
+    Mark a function as a fixture. A test, or another fixture, gets the value
+    of a fixture by taking a parameter with the fixture's name, looked up in
+    the module the test or fixture is defined in. A fixture imported into a
+    test module can be used by its tests.
+
+    A fixture that yields is set up by running it to the yield and torn
+    down by running the rest once its scope ends.
+
+    :param scope: "function" for a fresh value for every test, "module" to
+                  share one value between the tests of a module or
+                  "session" to share one value for the whole run, one per
+                  worker process in parallel runs
+    """
+    if scope not in FIXTURE_SCOPES:
+        raise ValueError(f"Unknown fixture scope {scope!r}, "
+                         f"expected one of {', '.join(FIXTURE_SCOPES)}")
+
+    def fixtured(fixture_func):
+        setattr(fixture_func, FIXTURE_ATTRIBUTE, scope)
+        return fixture_func
+
+    if func is not None:
+        return fixtured(func)
+    return fixtured
@@ -1 +1,2 @@
 from .writelndecorator import WritelnDecorator
+from .cache import CACHE_FOLDER_NAME, get_cache_folder, content_hash, read_json, write_json
@@ -0,0 +1,61 @@
+"""
+Helpers for reading and writing smalltest's on-disk cache folder.
+
+Everything smalltest stores between runs lives in a single folder in the
+base path of the test run as plain JSON files.
+"""
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from typing import Any, Optional, Union
+
+CACHE_FOLDER_NAME = ".smalltest_cache"
+
+
+def get_cache_folder(base_path: Optional[Union[str, Path]] = None) -> Path:
+    """
+    Get the path of the cache folder for a test run, the folder is
+    not created until something is written to it.
+
+    :param base_path: Search path root of the test run
+    :return: Path of the cache folder
+    """
+    base_path = Path(base_path) if base_path else Path.cwd()
+    return base_path / CACHE_FOLDER_NAME
+
+
+def content_hash(data: bytes) -> str:
+    """Short hex digest used to check if file contents have changed"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_json(path: Path, default: Any = None) -> Any:
+    """
+    Read a JSON cache file, a missing or corrupt file gives the default.
+
+    :param path: Path of the cache file
+    :param default: Value to return if the file can not be read
+    :return: decoded data
+    """
+    try:
+        with open(path, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path: Path, data: Any) -> None:
+    """
+    Write a JSON cache file, replacing the old file in one step so a
+    concurrent or interrupted run never sees a partial file.
+
+    :param path: Path of the cache file
+    :param data: JSON serializable data
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
@@ -0,0 +1,129 @@
+import time
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.capture import CaptureOptions
+from smalltest.suite.discover import find_test_names
+from smalltest.suite.run import ResultType, run_test, run_tests_serial
+from smalltest.tools import thread_unsafe
+
+async_tests = """
+import asyncio
+import sys
+import warnings
+
+from smalltest.tools import fixture, parametrize, xfail
+
+@fixture
+def delay():
+    return 0.3
+
+@parametrize("n", range(40))
+async def test_waits(n, delay):
+    print(f"start {n}")
+    await asyncio.sleep(delay)
+    warnings.warn(f"warning {n}")
+    print(f"end {n}", file=sys.stderr)
+
+@xfail(reason="never equal")
+async def test_expected_failure():
+    await asyncio.sleep(0)
+    assert 1 == 2
+
+def test_plain():
+    pass
+"""
+
+
+def test_find_async_test_names():
+    source = "async def test_waits():\n    pass\n\ndef test_plain():\n    pass\n"
+    assert find_test_names(source.encode()) == ["test_waits", "test_plain"]
+
+
+def test_run_async_test_alone():
+    async def check_fails():
+        assert False
+
+    async def check_passes():
+        pass
+
+    assert run_test(check_fails).result_type == ResultType.FAILURE
+    assert run_test(check_passes).result_type == ResultType.SUCCESS
+
+
+@thread_unsafe
+def test_run_async_tests_concurrently():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_async_waits.py"
+        testfile.write_text(async_tests)
+        test_dict = {testfile: find_test_names(async_tests.encode())}
+
+        start = time.perf_counter()
+        results = dict(run_tests_serial(
+            test_dict, stream=StringIO(), capture=CaptureOptions(keep_passing=True)
+        ))
+        elapsed = time.perf_counter() - start
+
+        # Limited to 10 at a time the waits are spread over 4 rounds
+        start = time.perf_counter()
+        limited = dict(run_tests_serial(
+            test_dict, stream=StringIO(), async_concurrency=10
+        ))
+        limited_elapsed = time.perf_counter() - start
+
+    assert len(results) == 42
+    assert results["test_async_waits::test_plain"].result_type == ResultType.SUCCESS
+    assert results["test_async_waits::test_expected_failure"].result_type == ResultType.XFAIL
+    for n in range(40):
+        result = results[f"test_async_waits::test_waits[{n}]"]
+        assert result.result_type == ResultType.SUCCESS
+        assert (result.stdout, result.stderr) == (f"start {n}\n", f"end {n}\n")
+        assert [warning.message for warning in result.warnings] == [f"warning {n}"]
+        assert 0.25e9 < result.wall_time_ns < 1e9
+
+    assert elapsed < 1.5
+    assert len(limited) == 42
+    assert limited_elapsed > 1.1
+
+
+repeated_tests = """
+import asyncio
+import warnings
+
+def warn():
+    warnings.warn("shown by every test")
+
+async def test_a():
+    await asyncio.sleep(0.01)
+    warn()
+
+async def test_b():
+    await asyncio.sleep(0.01)
+    warn()
+
+async def test_error():
+    await asyncio.sleep(0)
+    raise ValueError("from the test")
+"""
+
+
+@thread_unsafe
+def test_async_warnings_and_tracebacks():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_async_repeated.py"
+        testfile.write_text(repeated_tests)
+        results = dict(run_tests_serial(
+            {testfile: ["test_a", "test_b", "test_error"]}, stream=StringIO()
+        ))
+
+    for name in ("test_a", "test_b"):
+        result = results[f"test_async_repeated::{name}"]
+        assert [warning.message for warning in result.warnings] == ["shown by every test"]
+
+    # Only the test's own frame, none of the runner's
+    error = results["test_async_repeated::test_error"]
+    assert error.result_type == ResultType.ERROR
+    assert len(error.exception.traceback) == 1
+    assert "in test_error" in error.exception.traceback[0]
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+from smalltest.suite.capture import CaptureOptions, FDCapture, SysCapture
+from smalltest.suite.run import ResultType, run_test
+from smalltest.tools import thread_unsafe
+
+
+def noisy_pass():
+    print("passing output")
+
+
+def noisy_fail():
+    print("x" * 100)
+    assert False
+
+
+@thread_unsafe
+def test_passing_output_dropped():
+    assert run_test(noisy_pass).stdout == ""
+    kept = run_test(noisy_pass, SysCapture(keep_passing=True))
+    assert kept.stdout == "passing output\n"
+
+
+@thread_unsafe
+def test_sys_capture_bounded():
+    capture = CaptureOptions("sys", max_length=10).make()
+    result = run_test(noisy_fail, capture)
+    assert result.result_type == ResultType.FAILURE
+    assert result.stdout == "x" * 10 + "\n... 91 characters truncated"
+
+    # The buffer is emptied for the next test
+    assert run_test(noisy_fail, capture).stdout == result.stdout
+
+
+@thread_unsafe
+def test_fd_capture():
+    def test_low_level():
+        print("from python")
+        os.write(1, b"from fd\n")
+        subprocess.run([sys.executable, "-c", "import sys; sys.stderr.write('from child')"])
+        assert False
+
+    capture = FDCapture()
+    try:
+        for _ in range(2):
+            result = run_test(test_low_level, capture)
+            assert result.stdout == "from python\nfrom fd\n"
+            assert result.stderr == "from child"
+    finally:
+        capture.close()
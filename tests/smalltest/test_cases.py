@@ -0,0 +1,141 @@
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.capture import CaptureOptions
+from smalltest.suite.cases import CASE_BATCH_SIZE, CaseCursor, iter_cases
+from smalltest.suite.run import ResultType, run_tests_parallel, run_tests_serial
+from smalltest.suite.workers import run_worker_batch
+from smalltest.tools import parametrize, thread_unsafe, xfail
+
+
+@parametrize("a, b", [(1, "x"), (2, object())])
+@parametrize("flag", [True], ids=["on"])
+def check_pair(a, b, flag):
+    assert a < 2
+
+
+def test_iter_cases_ids():
+    cases = list(iter_cases(check_pair))
+    assert [case_id for case_id, _ in cases] == ["on-1-x", "on-2-b1"]
+    cases[0][1]()
+
+
+def test_case_cursor_generator():
+    @parametrize("n", (n for n in range(250)))
+    def check_number(n):
+        pass
+
+    cursor = CaseCursor(check_number)
+    first = list(cursor.take(0, CASE_BATCH_SIZE))
+    assert [offset for offset, _, _ in first] == list(range(CASE_BATCH_SIZE))
+    assert cursor.more()
+
+    # A later chunk carries on from the same generator
+    last = list(cursor.take(200, CASE_BATCH_SIZE))
+    assert [case_id for _, case_id, _ in last] == [str(n) for n in range(200, 250)]
+    assert not cursor.more()
+
+
+class ListConnection:
+    """Collects the messages a worker sends"""
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+@thread_unsafe
+def test_lost_chunk_on_reused_worker():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_rerun_cases.py"
+        testfile.write_text(
+            "from smalltest.tools import parametrize\n\n"
+            f"@parametrize('n', range({CASE_BATCH_SIZE * 2}))\n"
+            "def test_listed(n):\n"
+            "    pass\n\n"
+            f"@parametrize('n', (n for n in range({CASE_BATCH_SIZE * 2})))\n"
+            "def test_generated(n):\n"
+            "    pass\n"
+        )
+        conn = ListConnection()
+        # The worker runs the first chunk of each, then is handed back the
+        # end of a chunk another worker was lost part way through
+        for test_name in ("test_listed", "test_generated"):
+            run_worker_batch(conn, testfile, [(test_name, 0)])
+            conn.messages.clear()
+            run_worker_batch(conn, testfile, [(test_name, 5, CASE_BATCH_SIZE)])
+
+            results = {
+                message[1]: message[2]
+                for message in conn.messages
+                if message[0] in ("case", "result")
+            }
+            if test_name == "test_listed":
+                assert list(results) == [
+                    f"test_rerun_cases::test_listed[{n}]"
+                    for n in range(5, CASE_BATCH_SIZE)
+                ]
+            else:
+                (error,) = results.values()
+                assert error.result_type == ResultType.ERROR
+                assert f"Cases 5 to {CASE_BATCH_SIZE - 1}" in error.exception.args[0]
+
+
+def test_xfail_parametrized():
+    @xfail(reason="odd numbers")
+    @parametrize("n", [1, 3])
+    def check_even(n):
+        assert n % 2 == 0
+
+    assert [case_id for case_id, _ in iter_cases(check_even)] == ["1", "3"]
+
+
+@thread_unsafe
+def test_run_parametrized_cases():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_parametrized_cases.py"
+        testfile.write_text(
+            "from smalltest.tools import parametrize\n\n"
+            "@parametrize('n', (n for n in range(250)))\n"
+            "def test_number(n):\n"
+            "    assert n != 137\n\n"
+            "def test_plain():\n"
+            "    pass\n"
+        )
+        test_dict = {testfile: ["test_number", "test_plain"]}
+
+        serial = dict(run_tests_serial(test_dict, stream=StringIO()))
+        parallel = dict(run_tests_parallel(test_dict, stream=StringIO(), processes=2))
+
+    for results in (serial, parallel):
+        assert len(results) == 251
+        assert results["test_parametrized_cases::test_number[137]"].result_type == ResultType.FAILURE
+        assert results["test_parametrized_cases::test_number[249]"].result_type == ResultType.SUCCESS
+        assert results["test_parametrized_cases::test_plain"].result_type == ResultType.SUCCESS
+
+
+@thread_unsafe
+def test_parallel_cases_share_workers():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_shared_cases.py"
+        testfile.write_text(
+            "import os\n"
+            "import time\n"
+            "from smalltest.tools import parametrize\n\n"
+            f"@parametrize('n', range({CASE_BATCH_SIZE * 4}))\n"
+            "def test_number(n):\n"
+            "    print(os.getpid())\n"
+            "    time.sleep(0.002)\n"
+        )
+        results = dict(run_tests_parallel(
+            {testfile: ["test_number"]},
+            stream=StringIO(),
+            processes=2,
+            capture=CaptureOptions(keep_passing=True),
+        ))
+
+    assert len(results) == CASE_BATCH_SIZE * 4
+    # The chunks of the one test ran on both workers
+    assert len({result.stdout for result in results.values()}) == 2
@@ -0,0 +1,78 @@
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.depgraph import ChangeSelector, DependencyGraph
+from smalltest.suite.run import ResultType, TestResult
+
+
+def make_project(base: Path) -> None:
+    (base / "pkg").mkdir()
+    (base / "pkg" / "__init__.py").write_text("")
+    (base / "pkg" / "core.py").write_text("from .helpers import helper\n")
+    (base / "pkg" / "helpers.py").write_text("import os\n\ndef helper():\n    pass\n")
+    (base / "pkg" / "other.py").write_text("")
+    (base / "test_core.py").write_text("from pkg.core import helper\n\ndef test_core():\n    pass\n")
+    (base / "test_other.py").write_text("import pkg.other\n\ndef test_other():\n    pass\n")
+
+
+def test_dependency_closure():
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        make_project(base)
+
+        graph = DependencyGraph([base])
+        closure = graph.closure(base / "test_core.py")
+
+        assert set(closure) == {
+            base / "test_core.py",
+            base / "pkg" / "__init__.py",
+            base / "pkg" / "core.py",
+            base / "pkg" / "helpers.py",
+        }
+        assert closure[base / "pkg" / "helpers.py"] == base / "pkg" / "core.py"
+
+
+def passing(test_dict):
+    for pth, test_names in test_dict.items():
+        for test_name in test_names:
+            yield f"{pth.stem}::{test_name}", TestResult(ResultType.SUCCESS, None, "", "", [])
+
+
+def test_change_selector():
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        make_project(base)
+        state_path = base / "dependencies.json"
+        test_dict = {
+            base / "test_core.py": ["test_core"],
+            base / "test_other.py": ["test_other"],
+        }
+
+        selector = ChangeSelector(base, state_path)
+        assert selector.select(test_dict) == test_dict
+        list(selector.record(passing(test_dict)))
+        selector.save()
+
+        selector = ChangeSelector(base, state_path)
+        assert selector.select(test_dict) == {}
+        selector.save()
+
+        (base / "pkg" / "helpers.py").write_text("def helper():\n    return 1\n")
+        selector = ChangeSelector(base, state_path)
+        assert selector.select(test_dict) == {base / "test_core.py": ["test_core"]}
+
+        output = StringIO()
+        selector.write_explanation(output)
+        assert "Selected 1 of 2 test modules" in output.getvalue()
+        assert (
+            "test_core.py: changed: pkg/helpers.py <- pkg/core.py <- test_core.py"
+            in output.getvalue()
+        )
+
+        # A failing module stays selected
+        failure = TestResult(ResultType.FAILURE, None, "", "", [])
+        list(selector.record([("test_core::test_core", failure)]))
+        selector.save()
+        selector = ChangeSelector(base, state_path)
+        assert selector.select(test_dict) == {base / "test_core.py": ["test_core"]}
@@ -1,7 +1,10 @@
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from smalltest.suite.discover import discover_tests, discover_test_functions, discover_test_modules
+from smalltest.suite.discover import discover_tests, discover_test_functions, discover_test_modules, find_test_names
+from smalltest.suite.index import DiscoveryIndex, INDEX_FILE_NAME
+from smalltest.tools import thread_unsafe
+from smalltest.util import get_cache_folder
 
 faketests = """
 
@@ -67,3 +70,112 @@ def test_discover_test_functions():
         result = discover_test_functions(test_files=[testfile])
 
         assert expected == result
+
+
+def test_discover_tests_index():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_fake.py"
+        testfile.write_text(faketests)
+
+        discover_tests(base_path=tmpfolder)
+
+        index_path = get_cache_folder(tmpfolder) / INDEX_FILE_NAME
+        index = DiscoveryIndex(index_path)
+        assert index.get(testfile) == (["test_fake", "test_real"], [], {})
+
+        # Changed contents invalidate the entry
+        testfile.write_text(faketests.replace("test_real", "test_other"))
+        assert index.get(testfile) is None
+
+        expected = {testfile: ["test_fake", "test_other"]}
+        assert discover_tests(base_path=tmpfolder) == expected
+
+
+def test_discover_tests_index_stale():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_fake.py"
+        testfile.write_text(faketests)
+        testfile2 = Path(tmpfolder) / "fake_test.py"
+        testfile2.write_text(faketests)
+
+        discover_tests(base_path=tmpfolder)
+        testfile2.unlink()
+        discover_tests(base_path=tmpfolder)
+
+        index_path = get_cache_folder(tmpfolder) / INDEX_FILE_NAME
+        index = DiscoveryIndex(index_path)
+        assert list(index.entries) == [str(testfile.absolute())]
+
+
+def test_discover_tests_no_index():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_fake.py"
+        testfile.write_text(faketests)
+
+        expected = {testfile: ["test_fake", "test_real"]}
+        result = discover_tests(base_path=tmpfolder, use_index=False)
+
+        assert expected == result
+        assert not get_cache_folder(tmpfolder).exists()
+
+
+def test_discover_modules_overlapping_patterns():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_fake_test.py"
+        testfile.write_text(faketests)
+
+        result = discover_test_modules(base_path=tmpfolder)
+
+        assert result == [testfile]
+
+
+def test_discover_modules_nested_and_ignored():
+    with TemporaryDirectory() as tmpfolder:
+        nested = Path(tmpfolder) / "tests" / "nested"
+        nested.mkdir(parents=True)
+        testfile = nested / "test_fake.py"
+        testfile.write_text(faketests)
+
+        for ignored in ["__pycache__", ".venv", "build"]:
+            ignored_folder = Path(tmpfolder) / "tests" / ignored
+            ignored_folder.mkdir()
+            (ignored_folder / "test_fake.py").write_text(faketests)
+
+        result = discover_test_modules(base_path=tmpfolder)
+        assert result == [testfile]
+
+        result = discover_test_modules(
+            base_path=tmpfolder,
+            ignore_folder_names=["nested"]
+        )
+        assert len(result) == 3
+
+
+@thread_unsafe
+def test_discover_test_functions_parallel():
+    with TemporaryDirectory() as tmpfolder:
+        testfiles = []
+        for i in range(6):
+            testfile = Path(tmpfolder) / f"test_fake_{i}.py"
+            testfile.write_text(faketests)
+            testfiles.append(testfile)
+
+        expected = discover_test_functions(test_files=testfiles)
+        result = discover_test_functions(
+            test_files=testfiles,
+            parallel=True,
+            processes=2
+        )
+
+        assert expected == result
+        assert list(expected) == list(result)
+
+
+def test_find_test_names_prefilter():
+    no_tests = b"class TestThing:\n    def test_method(self):\n        pass\n"
+    assert find_test_names(no_tests) == []
+
+    # The prefilter skips the parse so invalid syntax is never seen
+    assert find_test_names(b"def not_a_test(:\n") == []
+
+    assert find_test_names(faketests.encode()) == ["test_fake", "test_real"]
@@ -0,0 +1,156 @@
+import multiprocessing
+import socket
+import subprocess
+import sys
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.distributed import Coordinator, parse_address, serve_worker
+from smalltest.suite.run import ResultType, run_tests_distributed
+from smalltest.tools import thread_unsafe
+
+AUTHKEY = b"smalltest-test-key"
+
+crashing_tests = """
+import os
+from pathlib import Path
+
+from smalltest.tools import parametrize
+
+def test_before():
+    pass
+
+@parametrize("n", range(4))
+def test_crash(n):
+    # Takes down the first worker to reach the second case
+    marker = Path(__file__).with_suffix(".crashed")
+    if n == 1 and not marker.exists():
+        marker.write_text("")
+        os._exit(1)
+
+def test_after():
+    pass
+"""
+
+other_tests = """
+import time
+
+def test_slow():
+    time.sleep(2)
+
+def test_quick():
+    pass
+"""
+
+
+def test_parse_address():
+    assert parse_address("localhost:8765") == ("localhost", 8765)
+    assert parse_address("10.0.0.2:0") == ("10.0.0.2", 0)
+    assert parse_address("/tmp/smalltest.sock") == "/tmp/smalltest.sock"
+    assert parse_address("relative/socket") == "relative/socket"
+
+
+@thread_unsafe
+def test_run_tests_distributed_requeues_lost_worker():
+    with TemporaryDirectory() as tmpfolder:
+        root = Path(tmpfolder)
+        testfile = root / "test_distributed_crash.py"
+        testfile.write_text(crashing_tests)
+        address = str(root / "smalltest.sock")
+
+        # Two workers started from the command line, and a third with the
+        # wrong key that is turned away
+        workers = [
+            subprocess.Popen(
+                [sys.executable, "-m", "smalltest.main", "worker", address,
+                 "--authkey", key, "--root", tmpfolder, "--retry-for", "20"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for key in (AUTHKEY.decode(), AUTHKEY.decode(), "wrong-key")
+        ]
+        try:
+            results = dict(run_tests_distributed(
+                {testfile: ["test_before", "test_crash", "test_after"]},
+                stream=StringIO(),
+                address=address,
+                authkey=AUTHKEY,
+                connect_timeout=20,
+            ))
+        finally:
+            exit_codes = [worker.wait(20) for worker in workers]
+
+    lost = results.pop("test_distributed_crash::test_crash[1]")
+    assert lost.result_type == ResultType.ERROR
+    assert "disconnected" in lost.exception.args[0]
+    # The rest of the batch was picked up by the other worker
+    assert sorted(results) == [
+        "test_distributed_crash::test_after",
+        "test_distributed_crash::test_before",
+        "test_distributed_crash::test_crash[0]",
+        "test_distributed_crash::test_crash[2]",
+        "test_distributed_crash::test_crash[3]",
+    ]
+    assert all(result.result_type == ResultType.SUCCESS for result in results.values())
+    assert sorted(exit_codes) == [0, 1, 4]
+
+
+@thread_unsafe
+def test_coordinator_over_tcp_with_timeout():
+    context = multiprocessing.get_context("fork")
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_distributed_other.py"
+        testfile.write_text(other_tests)
+
+        coordinator = Coordinator(("127.0.0.1", 0), AUTHKEY, root=Path(tmpfolder))
+        workers = [
+            context.Process(
+                target=serve_worker,
+                args=(coordinator.address, AUTHKEY, Path(tmpfolder), 10),
+            )
+            for _ in range(2)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            results = dict(coordinator.run(
+                [(testfile, ["test_slow"]), (testfile, ["test_quick"])],
+                timeout=0.5,
+                connect_timeout=10,
+            ))
+        finally:
+            coordinator.close()
+            for worker in workers:
+                worker.join(10)
+
+    assert results["test_distributed_other::test_slow"].result_type == ResultType.TIMEOUT
+    assert results["test_distributed_other::test_quick"].result_type == ResultType.SUCCESS
+
+
+@thread_unsafe
+def test_coordinator_admits_workers_past_silent_client():
+    context = multiprocessing.get_context("fork")
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_distributed_other.py"
+        testfile.write_text(other_tests)
+
+        coordinator = Coordinator(("127.0.0.1", 0), AUTHKEY, root=Path(tmpfolder))
+        # Connects like a port scanner and never answers the handshake
+        silent = socket.create_connection(coordinator.address)
+        worker = context.Process(
+            target=serve_worker,
+            args=(coordinator.address, AUTHKEY, Path(tmpfolder), 10),
+        )
+        worker.start()
+        try:
+            results = dict(coordinator.run(
+                [(testfile, ["test_quick"])], connect_timeout=5,
+            ))
+        finally:
+            silent.close()
+            coordinator.close()
+            worker.join(10)
+
+    assert results["test_distributed_other::test_quick"].result_type == ResultType.SUCCESS
@@ -0,0 +1,157 @@
+import sys
+
+from collections import Counter
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.discover import discover_tests
+from smalltest.suite.fixtures import FixtureManager, argument_names, fixture_names
+from smalltest.suite.run import (
+    ResultType,
+    run_tests_parallel,
+    run_tests_serial,
+    run_tests_threaded,
+)
+from smalltest.tools import fixture, parametrize, thread_unsafe
+
+fixture_module = """\
+import os
+from smalltest.tools import fixture
+
+LOG = {log!r}
+
+def log(text):
+    with open(LOG, "a") as f:
+        f.write(f"{{text}}\\n")
+
+@fixture(scope="session")
+def resource():
+    log(f"session setup {{os.getpid()}}")
+    yield "resource"
+    log(f"session teardown {{os.getpid()}}")
+
+@fixture(scope="module")
+def per_module(resource):
+    log("module setup")
+    yield resource + "-module"
+    log("module teardown")
+
+@fixture
+def per_test(per_module):
+    return per_module + "-test"
+"""
+
+
+def test_fixture_names_skip_parametrized():
+    @parametrize("n", [1, 2])
+    def check(n, per_test, optional=None):
+        pass
+
+    assert argument_names(check) == ["n", "per_test"]
+    assert fixture_names(check) == ["per_test"]
+    assert fixture_names(check, ["n", "other"]) == ["other"]
+
+
+def test_fixture_scopes_and_teardown():
+    order = []
+
+    @fixture(scope="module")
+    def outer():
+        order.append("outer setup")
+        yield 1
+        order.append("outer teardown")
+
+    @fixture
+    def inner(outer):
+        order.append("inner setup")
+        yield outer + 1
+        order.append("inner teardown")
+
+    def check(inner, outer):
+        assert (inner, outer) == (2, 1)
+
+    class Module:
+        pass
+
+    module = Module()
+    module.outer, module.inner = outer, inner
+    manager = FixtureManager()
+    manager.enter_module(module)
+    manager.bind(check, ["inner", "outer"])()
+    manager.bind(check, ["inner", "outer"])()
+    manager.close()
+    assert order == [
+        "outer setup",
+        "inner setup", "inner teardown",
+        "inner setup", "inner teardown",
+        "outer teardown",
+    ]
+
+
+@thread_unsafe
+def test_run_fixtures():
+    with TemporaryDirectory() as tmpfolder:
+        log = Path(tmpfolder) / "fixtures.log"
+        (Path(tmpfolder) / "shared_run_fixtures.py").write_text(
+            fixture_module.format(log=str(log))
+        )
+        for name in ("test_fixture_a", "test_fixture_b"):
+            (Path(tmpfolder) / f"{name}.py").write_text(
+                "from shared_run_fixtures import resource, per_module, per_test\n"
+                "\ndef test_value(per_test):\n"
+                "    assert per_test == 'resource-module-test'\n"
+                "\ndef test_missing(no_such_fixture):\n"
+                "    pass\n"
+                "\ndef test_error(per_test):\n"
+                "    raise ValueError(per_test)\n"
+            )
+        test_args = {}
+        test_dict = discover_tests(tmpfolder, use_index=False, test_args=test_args)
+        assert all(
+            module_args["test_missing"] == ["no_such_fixture"]
+            for module_args in test_args.values()
+        )
+
+        sys.path.insert(0, tmpfolder)
+        try:
+            serial = dict(run_tests_serial(test_dict, stream=StringIO(), test_args=test_args))
+            serial_log = log.read_text().splitlines()
+            log.unlink()
+
+            parallel = dict(run_tests_parallel(
+                test_dict, stream=StringIO(), processes=2, test_args=test_args
+            ))
+            parallel_log = log.read_text().splitlines()
+            log.unlink()
+
+            threaded = dict(run_tests_threaded(
+                test_dict, stream=StringIO(), threads=4, test_args=test_args
+            ))
+            threaded_log = log.read_text().splitlines()
+        finally:
+            sys.path.remove(tmpfolder)
+            sys.modules.pop("shared_run_fixtures", None)
+
+    for results in (serial, parallel, threaded):
+        assert results["test_fixture_a::test_value"].result_type == ResultType.SUCCESS
+        assert results["test_fixture_b::test_missing"].result_type == ResultType.ERROR
+        # Tracebacks start at the test, not the fixture wrapper
+        error = results["test_fixture_b::test_error"].exception
+        assert len(error.traceback) == 1
+        assert "in test_error" in error.traceback[0]
+
+    # Module fixtures are set up again for each module, the session once
+    counts = Counter(line.split(" ")[0] + " " + line.split(" ")[1] for line in serial_log)
+    assert counts == {
+        "session setup": 1, "session teardown": 1,
+        "module setup": 2, "module teardown": 2,
+    }
+
+    # Each worker sets up its session fixture once
+    setups = Counter(line for line in parallel_log if line.startswith("session setup"))
+    assert set(setups.values()) == {1}
+
+    # The threads share one session fixture
+    counts = Counter(line.split(" ")[0] + " " + line.split(" ")[1] for line in threaded_log)
+    assert counts["session setup"] == counts["session teardown"] == 1
@@ -0,0 +1,57 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.lastfailed import ResultCache
+from smalltest.suite.run import ResultType, TestResult
+
+
+def make_result(result_type):
+    return TestResult(result_type, None, "", "", [])
+
+
+def test_result_cache_last_failed():
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        first = base / "test_lf_first.py"
+        first.write_text("def test_a():\n    pass\n\ndef test_b():\n    pass\n")
+        second = base / "test_lf_second.py"
+        second.write_text("def test_c():\n    pass\n")
+        test_dict = {first: ["test_a", "test_b"], second: ["test_c"]}
+
+        path = base / "results.json"
+        cache = ResultCache(path)
+        results = [
+            ("test_lf_first::test_a", make_result(ResultType.SUCCESS)),
+            ("test_lf_first::test_b", make_result(ResultType.FAILURE)),
+            ("test_lf_second::test_c", make_result(ResultType.SUCCESS)),
+        ]
+        assert list(cache.record(results, test_dict)) == results
+        cache.save()
+
+        loaded = ResultCache(path)
+        assert loaded.failed_names() == {"test_lf_first::test_b"}
+        assert loaded.last_failed_tests() == {first.absolute(): ["test_b"]}
+        assert loaded.failed_first({second: ["test_c"], first: ["test_a", "test_b"]}) == {
+            first: ["test_b", "test_a"],
+            second: ["test_c"],
+        }
+
+        # A failing test that has since been removed is not selected
+        first.write_text("def test_a():\n    pass\n")
+        assert loaded.last_failed_tests() == {}
+
+
+def test_result_cache_parametrized_cases():
+    with TemporaryDirectory() as tmpfolder:
+        module = Path(tmpfolder) / "test_lf_cases.py"
+        module.write_text("def test_p(n):\n    pass\n")
+        cache = ResultCache()
+        results = [
+            ("test_lf_cases::test_p[1]", make_result(ResultType.FAILURE)),
+            ("test_lf_cases::test_p[2]", make_result(ResultType.FAILURE)),
+        ]
+        list(cache.record(results, {module: ["test_p"]}))
+
+        # Every case of the test reruns
+        assert cache.failed_names() == {"test_lf_cases::test_p"}
+        assert cache.last_failed_tests() == {module.absolute(): ["test_p"]}
@@ -0,0 +1,51 @@
+import sys
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.main import discover_run_report, ExitCode
+from smalltest.suite import run_tests_parallel
+from smalltest.tools import skipif, thread_unsafe
+
+try:
+    import coverage
+except ImportError:
+    coverage = None
+
+
+@skipif(coverage is None, reason="coverage is not installed")
+@thread_unsafe
+def test_parallel_coverage_report():
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        (base / "covered_module.py").write_text(
+            "def branch(x):\n"
+            "    if x:\n"
+            "        return 1\n"
+            "    return 2\n"
+        )
+        (base / "test_covered.py").write_text(
+            "from covered_module import branch\n\n"
+            "def test_branch():\n"
+            "    assert branch(True) == 1\n"
+        )
+
+        output = StringIO()
+        sys.path.insert(0, tmpfolder)
+        try:
+            result = discover_run_report(
+                base,
+                stream=output,
+                runner=run_tests_parallel,
+                use_cache=False,
+                processes=2,
+            )
+        finally:
+            sys.path.remove(tmpfolder)
+            sys.modules.pop("covered_module", None)
+
+        assert result == ExitCode.SUCCESS
+        report = output.getvalue().partition("Coverage Report")[2]
+        assert "covered_module.py" in report
+        assert "75%" in report
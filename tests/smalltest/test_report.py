@@ -0,0 +1,129 @@
+import json
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.report import JSONLinesReport, JUnitXMLReport, TimingReport
+from smalltest.suite.run import ErrorDetails, ResultType, TestResult
+
+
+def make_result(wall_ms, import_ms=0):
+    return TestResult(
+        ResultType.SUCCESS, None, "", "", [],
+        wall_time_ns=wall_ms * 1_000_000,
+        cpu_time_ns=wall_ms * 500_000,
+        import_time_ns=import_ms * 1_000_000,
+    )
+
+
+timing_results = [
+    ("test_a::test_1", make_result(5, import_ms=10)),
+    ("test_a::test_2", make_result(1)),
+    ("test_b::test_1", make_result(30, import_ms=1)),
+    ("test_b::test_2", make_result(2)),
+]
+
+
+def test_timing_report_slowest():
+    timing_report = TimingReport(slowest=2)
+    assert list(timing_report.record(timing_results)) == timing_results
+
+    output = StringIO()
+    timing_report.write_report(output)
+    lines = output.getvalue().splitlines()
+
+    assert lines[0] == "Slowest 2 tests"
+    assert lines[1].endswith("test_b::test_1")
+    assert lines[2].endswith("test_a::test_1")
+    assert lines[3] == "Slowest 2 modules"
+    assert lines[4].endswith("test_b (2 tests)")
+    assert lines[5].endswith("test_a (2 tests)")
+
+
+def test_timing_report_export():
+    with TemporaryDirectory() as tmpfolder:
+        export_path = Path(tmpfolder) / "timings.jsonl"
+        timing_report = TimingReport(slowest=0, export_path=export_path)
+        for _ in timing_report.record(timing_results):
+            pass
+
+        records = [
+            json.loads(line)
+            for line in export_path.read_text().splitlines()
+        ]
+
+    tests = [record for record in records if record["type"] == "test"]
+    modules = [record for record in records if record["type"] == "module"]
+
+    assert [test["name"] for test in tests] == [name for name, _ in timing_results]
+    assert tests[2]["wall_time_ns"] == 30_000_000
+    assert modules[0] == {
+        "type": "module",
+        "name": "test_a",
+        "tests": 2,
+        "import_time_ns": 10_000_000,
+        "wall_time_ns": 6_000_000,
+        "cpu_time_ns": 3_000_000,
+    }
+
+
+mixed_results = [
+    ("test_c::test_pass", make_result(1)),
+    ("test_c::test_fail", TestResult(
+        ResultType.FAILURE,
+        ErrorDetails(("1 != 2",), name="AssertionError", traceback=("  line 3\n",)),
+        "printed <out>\x00",
+        "",
+        [],
+        wall_time_ns=2_000_000,
+    )),
+    ("test_d::test_skip", TestResult(
+        ResultType.SKIP, ErrorDetails(("not today",), name="SkipMarker"), "", "", []
+    )),
+]
+
+
+def test_junit_xml_report():
+    import xml.etree.ElementTree as ElementTree
+
+    with TemporaryDirectory() as tmpfolder:
+        report_path = Path(tmpfolder) / "junit.xml"
+        report = JUnitXMLReport(report_path)
+        assert list(report.record(mixed_results)) == mixed_results
+        root = ElementTree.parse(report_path).getroot()
+
+    suite = root.find("testsuite")
+    assert suite.attrib["tests"] == "3"
+    assert suite.attrib["failures"] == "1"
+    assert suite.attrib["skipped"] == "1"
+    assert suite.attrib["errors"] == "0"
+
+    cases = suite.findall("testcase")
+    assert [case.attrib["classname"] for case in cases] == ["test_c", "test_c", "test_d"]
+    assert cases[1].attrib["time"] == "0.002000"
+    failure = cases[1].find("failure")
+    assert failure.attrib["message"] == "1 != 2"
+    assert failure.text == "  line 3\n"
+    assert cases[1].find("system-out").text == "printed <out>\ufffd"
+    assert cases[2].find("skipped").attrib["message"] == "not today"
+
+
+def test_json_lines_report():
+    with TemporaryDirectory() as tmpfolder:
+        report_path = Path(tmpfolder) / "results.jsonl"
+        report = JSONLinesReport(report_path)
+        for _ in report.record(mixed_results):
+            pass
+
+        records = [json.loads(line) for line in report_path.read_text().splitlines()]
+
+    assert [record["name"] for record in records[:3]] == [name for name, _ in mixed_results]
+    assert records[1]["result"] == "FAILURE"
+    assert records[1]["message"] == "1 != 2"
+    assert records[1]["stdout"] == "printed <out>\x00"
+    assert records[3] == {
+        "type": "summary",
+        "tests": 3,
+        "results": {"SUCCESS": 1, "FAILURE": 1, "SKIP": 1},
+    }
@@ -0,0 +1,96 @@
+import subprocess
+import sys
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.internals import assert_loader
+from smalltest.internals.assert_loader import get_rewritten_code
+from smalltest.internals.rewrite_assert_statements import compile_rewritten
+from smalltest.tools import raises, thread_unsafe
+
+assert_source = b'''
+def double(x):
+    return x * 2
+
+def test_compare():
+    values = [1, 2]
+    assert double(values[0]) == values[1] + 1
+
+def test_short_circuit():
+    empty = []
+    assert empty and empty[0], "needs a value"
+'''
+
+
+def run_rewritten(code, test_name):
+    namespace = {}
+    exec(code, namespace)
+    with raises(AssertionError) as error:
+        namespace[test_name]()
+    return error.value.args[0]
+
+
+def test_rewritten_assert_values():
+    code = compile_rewritten(assert_source, "test_rewrite_source.py")
+
+    assert run_rewritten(code, "test_compare").splitlines() == [
+        "assert double(values[0]) == values[1] + 1",
+        "  values[0] = 1",
+        "  double(values[0]) = 2",
+        "  values[1] = 2",
+        "  values[1] + 1 = 3",
+    ]
+    # The unevaluated right hand side isn't reported
+    assert run_rewritten(code, "test_short_circuit").splitlines() == [
+        "needs a value",
+        "assert empty and empty[0]",
+        "  empty = []",
+    ]
+
+
+@thread_unsafe
+def test_rewritten_code_cached():
+    original_folder = assert_loader.cache_folder
+    with TemporaryDirectory() as tmpfolder:
+        cache_folder = Path(tmpfolder)
+        assert_loader.set_cache_folder(cache_folder)
+        try:
+            get_rewritten_code(assert_source, "test_rewrite_cached.py")
+            cached_files = list(cache_folder.iterdir())
+            assert len(cached_files) == 1
+
+            # A second import reads the stored bytecode
+            mtime = cached_files[0].stat().st_mtime_ns
+            code = get_rewritten_code(assert_source, "test_rewrite_cached.py")
+            assert cached_files[0].stat().st_mtime_ns == mtime
+            assert run_rewritten(code, "test_compare").startswith("assert double")
+
+            # Changing the source replaces the stored bytecode
+            get_rewritten_code(assert_source + b"\n", "test_rewrite_cached.py")
+            new_files = list(cache_folder.iterdir())
+            assert len(new_files) == 1
+            assert new_files != cached_files
+
+            # Bytecode of another interpreter sharing the folder is kept
+            other = new_files[0].with_name(
+                new_files[0].name.replace(sys.implementation.cache_tag, "other-99")
+            )
+            other.write_bytes(b"")
+            get_rewritten_code(assert_source + b"\n\n", "test_rewrite_cached.py")
+            assert other.exists()
+            assert len(list(cache_folder.iterdir())) == 2
+        finally:
+            assert_loader.set_cache_folder(original_folder)
+
+
+def test_no_cache_folder_by_default():
+    # Importing the loader as a library stores nothing until asked to
+    output = subprocess.run(
+        [sys.executable, "-c",
+         "from smalltest.internals import assert_loader; print(assert_loader.cache_folder)"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output.strip() == "None"
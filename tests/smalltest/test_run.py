@@ -0,0 +1,422 @@
+import sys
+import warnings
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.run import (
+    make_batches,
+    get_cached_module,
+    run_tests_parallel,
+    run_tests_serial,
+    run_tests_threaded,
+    ResultType,
+)
+from smalltest.tools import thread_unsafe
+
+counting_tests = """
+import_count = globals().get("import_count", 0) + 1
+
+def test_first():
+    pass
+
+def test_second():
+    pass
+
+def test_third():
+    assert import_count == 1
+"""
+
+
+def test_make_batches_whole_modules():
+    test_dict = {
+        Path("test_a.py"): ["test_1", "test_2", "test_3"],
+        Path("test_b.py"): ["test_1"],
+        Path("test_c.py"): [],
+    }
+    expected = [
+        (Path("test_a.py"), ["test_1", "test_2", "test_3"]),
+        (Path("test_b.py"), ["test_1"]),
+    ]
+    assert make_batches(test_dict) == expected
+
+
+def test_make_batches_split():
+    test_dict = {
+        Path("test_a.py"): ["test_1", "test_2", "test_3"],
+        Path("test_b.py"): ["test_1"],
+    }
+    expected = [
+        (Path("test_a.py"), ["test_1", "test_2"]),
+        (Path("test_a.py"), ["test_3"]),
+        (Path("test_b.py"), ["test_1"]),
+    ]
+    assert make_batches(test_dict, batch_size=2) == expected
+
+
+def test_get_cached_module():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_cached_module.py"
+        testfile.write_text(counting_tests)
+
+        first, first_import_time = get_cached_module(testfile)
+        second, second_import_time = get_cached_module(testfile)
+
+        assert first is second
+        assert first.import_count == 1
+        assert first_import_time > 0
+        assert second_import_time == 0
+
+
+@thread_unsafe
+def test_run_tests_parallel_batched():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_parallel_batch.py"
+        testfile.write_text(counting_tests)
+
+        test_dict = {testfile: ["test_first", "test_second", "test_third"]}
+        results = dict(run_tests_parallel(
+            test_dict, stream=StringIO(), processes=2, batch_size=2
+        ))
+
+        assert sorted(results) == [
+            "test_parallel_batch::test_first",
+            "test_parallel_batch::test_second",
+            "test_parallel_batch::test_third",
+        ]
+        assert all(
+            result.result_type == ResultType.SUCCESS
+            for result in results.values()
+        )
+
+
+def test_run_tests_serial_streams():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_serial_stream.py"
+        testfile.write_text(counting_tests)
+
+        test_dict = {testfile: ["test_first", "test_second", "test_third"]}
+        results = run_tests_serial(test_dict, stream=StringIO())
+
+        # Nothing runs until the results are consumed
+        assert "test_serial_stream" not in sys.modules
+
+        name, result = next(results)
+        assert name == "test_serial_stream::test_first"
+        assert result.result_type == ResultType.SUCCESS
+        assert [name for name, _ in results] == [
+            "test_serial_stream::test_second",
+            "test_serial_stream::test_third",
+        ]
+
+
+failing_tests = """
+import threading
+
+def test_fails():
+    assert False, "Expected failure"
+
+def test_unpicklable_error():
+    raise ValueError("Can't send a lock", threading.Lock())
+"""
+
+
+@thread_unsafe
+def test_error_details_cross_process():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_error_details.py"
+        testfile.write_text(failing_tests)
+
+        test_dict = {testfile: ["test_fails", "test_unpicklable_error"]}
+        serial = dict(run_tests_serial(test_dict, stream=StringIO()))
+        parallel = dict(
+            run_tests_parallel(test_dict, stream=StringIO(), processes=1)
+        )
+
+        assert serial.keys() == parallel.keys()
+        for name, result in serial.items():
+            assert result.result_type == parallel[name].result_type
+            assert result.exception.traceback == parallel[name].exception.traceback
+
+        failure = parallel["test_error_details::test_fails"]
+        assert failure.result_type == ResultType.FAILURE
+        assert failure.exception.args == ("Expected failure",)
+
+        error = parallel["test_error_details::test_unpicklable_error"]
+        assert error.result_type == ResultType.ERROR
+        assert error.exception.name == "ValueError"
+        assert error.exception.args[0] == "Can't send a lock"
+        assert error.exception.args[1].startswith("<unlocked _thread.lock")
+        assert "test_unpicklable_error" in error.exception.traceback[0]
+
+
+warning_tests = """
+import threading
+import warnings
+
+class ProjectWarning(UserWarning):
+    pass
+
+def test_project_warning():
+    warnings.warn("defined in the test module", ProjectWarning)
+
+def test_unpicklable_warning():
+    warnings.warn(UserWarning("Can't send a lock", threading.Lock()))
+"""
+
+
+@thread_unsafe
+def test_warnings_cross_process():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_warning_details.py"
+        testfile.write_text(warning_tests)
+
+        test_dict = {testfile: ["test_project_warning", "test_unpicklable_warning"]}
+        serial = dict(run_tests_serial(test_dict, stream=StringIO()))
+        parallel = dict(
+            run_tests_parallel(test_dict, stream=StringIO(), processes=1)
+        )
+
+    assert serial.keys() == parallel.keys()
+    for name, result in serial.items():
+        assert parallel[name].result_type == ResultType.SUCCESS
+        assert [warning.category for warning in result.warnings] == [
+            warning.category for warning in parallel[name].warnings
+        ]
+
+    (project,) = parallel["test_warning_details::test_project_warning"].warnings
+    assert project.category == "ProjectWarning"
+    assert project.message == "defined in the test module"
+    assert project.filename == str(testfile)
+
+    (unpicklable,) = parallel["test_warning_details::test_unpicklable_warning"].warnings
+    assert unpicklable.category == "UserWarning"
+    assert "<unlocked _thread.lock" in unpicklable.message
+
+
+filtered_warning_tests = """
+import warnings
+
+def test_deprecated():
+    warnings.warn("made an error by the caller", DeprecationWarning)
+
+def test_user_warning():
+    warnings.warn("recorded", UserWarning)
+"""
+
+
+@thread_unsafe
+def test_warnings_keep_filters():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_filtered_warnings.py"
+        testfile.write_text(filtered_warning_tests)
+
+        test_dict = {testfile: ["test_deprecated", "test_user_warning"]}
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            serial = dict(run_tests_serial(test_dict, stream=StringIO()))
+            threaded = dict(run_tests_threaded(test_dict, stream=StringIO(), threads=2))
+
+    for results in (serial, threaded):
+        deprecated = results["test_filtered_warnings::test_deprecated"]
+        assert deprecated.result_type == ResultType.ERROR
+        assert deprecated.exception.name == "DeprecationWarning"
+
+        user_warning = results["test_filtered_warnings::test_user_warning"]
+        assert user_warning.result_type == ResultType.SUCCESS
+        assert [warning.category for warning in user_warning.warnings] == ["UserWarning"]
+
+
+maxfail_tests = """
+def test_fail_1():
+    assert False
+
+def test_pass():
+    pass
+
+def test_fail_2():
+    assert False
+
+def test_fail_3():
+    assert False
+"""
+
+
+def test_run_tests_serial_maxfail():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_serial_maxfail.py"
+        testfile.write_text(maxfail_tests)
+
+        test_dict = {
+            testfile: ["test_fail_1", "test_pass", "test_fail_2", "test_fail_3"]
+        }
+        output = StringIO()
+        results = dict(run_tests_serial(test_dict, stream=output, maxfail=2))
+
+        assert list(results) == [
+            "test_serial_maxfail::test_fail_1",
+            "test_serial_maxfail::test_pass",
+            "test_serial_maxfail::test_fail_2",
+        ]
+        assert "Stopping after 2 failures, 3 of 4 tests run" in output.getvalue()
+
+
+maxfail_cases_tests = """
+from smalltest.tools import parametrize
+
+@parametrize("value", [1, 2, 3, 4, 5])
+def test_cases(value):
+    assert value < 3
+
+def test_after():
+    pass
+"""
+
+
+def test_run_tests_serial_maxfail_cases():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_maxfail_cases.py"
+        testfile.write_text(maxfail_cases_tests)
+
+        output = StringIO()
+        results = dict(run_tests_serial(
+            {testfile: ["test_cases", "test_after"]}, stream=output, maxfail=2
+        ))
+
+        assert list(results) == [
+            "test_maxfail_cases::test_cases[1]",
+            "test_maxfail_cases::test_cases[2]",
+            "test_maxfail_cases::test_cases[3]",
+            "test_maxfail_cases::test_cases[4]",
+        ]
+        assert (
+            "Stopping after 2 failures, 1 of 2 tests run (4 results)"
+            in output.getvalue()
+        )
+
+
+def test_run_tests_serial_progress_cases():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_progress_cases.py"
+        testfile.write_text(maxfail_cases_tests)
+
+        output = StringIO()
+        list(run_tests_serial({testfile: ["test_cases", "test_after"]}, stream=output))
+
+    # The cases of a parametrized test count once against the total
+    progress = [
+        line.split()[0]
+        for line in output.getvalue().splitlines()
+        if line.startswith("[")
+    ]
+    assert progress == ["[1/2]"] * 5 + ["[2/2]"]
+
+
+@thread_unsafe
+def test_run_tests_parallel_maxfail():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_parallel_maxfail.py"
+        testfile.write_text(maxfail_tests)
+
+        test_dict = {
+            testfile: ["test_fail_1", "test_pass", "test_fail_2", "test_fail_3"]
+        }
+        output = StringIO()
+        results = dict(run_tests_parallel(
+            test_dict, stream=output, processes=1, batch_size=1, maxfail=1
+        ))
+
+        assert list(results) == ["test_parallel_maxfail::test_fail_1"]
+        assert "Stopping after 1 failures" in output.getvalue()
+
+
+timeout_tests = """
+import os
+import time
+
+from smalltest.tools import timeout
+
+@timeout(0.5)
+def test_hangs():
+    time.sleep(60)
+
+def test_crashes():
+    os._exit(3)
+
+def test_after():
+    pass
+"""
+
+
+@thread_unsafe
+def test_run_tests_parallel_timeout():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_parallel_timeout.py"
+        testfile.write_text(timeout_tests)
+
+        test_dict = {testfile: ["test_hangs", "test_crashes", "test_after"]}
+        results = dict(run_tests_parallel(
+            test_dict, stream=StringIO(), processes=1
+        ))
+
+        hung = results["test_parallel_timeout::test_hangs"]
+        assert hung.result_type == ResultType.TIMEOUT
+        assert hung.exception.args == ("Test timed out after 0.5s",)
+
+        crashed = results["test_parallel_timeout::test_crashes"]
+        assert crashed.result_type == ResultType.ERROR
+        assert crashed.exception.args == (
+            "Worker process exited unexpectedly with code 3",
+        )
+
+        after = results["test_parallel_timeout::test_after"]
+        assert after.result_type == ResultType.SUCCESS
+
+
+@thread_unsafe
+def test_run_tests_parallel_default_timeout():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_parallel_default_timeout.py"
+        testfile.write_text(
+            "import time\n\n"
+            "def test_slow():\n    time.sleep(60)\n\n"
+            "def test_fast():\n    pass\n"
+        )
+
+        test_dict = {testfile: ["test_slow", "test_fast"]}
+        results = dict(run_tests_parallel(
+            test_dict, stream=StringIO(), processes=2, batch_size=1, timeout=0.5
+        ))
+
+        assert results["test_parallel_default_timeout::test_slow"].result_type == ResultType.TIMEOUT
+        assert results["test_parallel_default_timeout::test_fast"].result_type == ResultType.SUCCESS
+
+
+@thread_unsafe
+def test_run_tests_parallel_preload():
+    with TemporaryDirectory() as tmpfolder:
+        (Path(tmpfolder) / "preload_marker.py").write_text("")
+        testfile = Path(tmpfolder) / "test_parallel_preload.py"
+        testfile.write_text(
+            "import sys\n\n"
+            "preloaded = 'preload_marker' in sys.modules\n\n"
+            "def test_preloaded():\n    assert preloaded\n"
+        )
+
+        test_dict = {testfile: ["test_preloaded"]}
+        sys.path.insert(0, tmpfolder)
+        try:
+            for start_method in ["fork", "spawn"]:
+                results = dict(run_tests_parallel(
+                    test_dict,
+                    stream=StringIO(),
+                    processes=1,
+                    start_method=start_method,
+                    preload=["preload_marker"],
+                ))
+                result = results["test_parallel_preload::test_preloaded"]
+                assert result.result_type == ResultType.SUCCESS, start_method
+        finally:
+            sys.path.remove(tmpfolder)
+            sys.modules.pop("preload_marker", None)
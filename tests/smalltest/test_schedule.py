@@ -0,0 +1,81 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.run import ResultType, TestResult
+from smalltest.suite.schedule import DurationStore, plan_batches
+
+
+def make_result(wall_ms, import_ms=0):
+    return TestResult(
+        ResultType.SUCCESS, None, "", "", [],
+        wall_time_ns=wall_ms * 1_000_000,
+        import_time_ns=import_ms * 1_000_000,
+    )
+
+
+def test_duration_store_roundtrip():
+    with TemporaryDirectory() as tmpfolder:
+        path = Path(tmpfolder) / "durations.json"
+        durations = DurationStore(path)
+        results = [
+            ("test_a::test_1", make_result(10, import_ms=5)),
+            ("test_a::test_2", make_result(20)),
+            ("test_b::test_1", make_result(40)),
+        ]
+        assert list(durations.record(results)) == results
+        durations.save()
+
+        loaded = DurationStore(path)
+        assert loaded.test_estimate("test_a::test_2") == 20_000_000
+        assert loaded.import_estimate("test_a") == 5_000_000
+        # Unknown tests get the median of the known tests
+        assert loaded.test_estimate("test_c::test_new") == 20_000_000
+
+
+def test_plan_batches_longest_first():
+    durations = DurationStore()
+    durations.tests = {
+        "test_a::test_1": 10,
+        "test_b::test_1": 50,
+        "test_c::test_1": 30,
+    }
+    test_dict = {
+        Path("test_a.py"): ["test_1"],
+        Path("test_b.py"): ["test_1"],
+        Path("test_c.py"): ["test_1"],
+    }
+
+    batches, predicted = plan_batches(test_dict, durations, workers=2)
+
+    assert [module_path.stem for module_path, _ in batches] == [
+        "test_b", "test_c", "test_a"
+    ]
+    assert predicted == 50
+
+    batches, _ = plan_batches(
+        test_dict, durations, workers=2, run_first={"test_a::test_1"}
+    )
+    assert [module_path.stem for module_path, _ in batches] == [
+        "test_a", "test_b", "test_c"
+    ]
+
+
+def test_plan_batches_splits_long_modules():
+    durations = DurationStore()
+    durations.tests = {
+        "test_a::test_1": 40,
+        "test_a::test_2": 40,
+        "test_a::test_3": 40,
+        "test_b::test_1": 40,
+    }
+    test_dict = {
+        Path("test_a.py"): ["test_1", "test_2", "test_3"],
+        Path("test_b.py"): ["test_1"],
+    }
+
+    batches, predicted = plan_batches(test_dict, durations, workers=2)
+
+    assert sorted(test_names for _, test_names in batches) == [
+        ["test_1"], ["test_1", "test_2"], ["test_3"]
+    ]
+    assert predicted == 80
@@ -0,0 +1,64 @@
+"""
+Startup budget for the smalltest command line, short runs such as
+pre-commit hooks spend most of their time starting up.
+"""
+import subprocess
+import sys
+
+# Cumulative microseconds to import smalltest.main, as reported by
+# python -X importtime. About 40ms when this was set, eagerly importing
+# the runners and reporters took it to about 95ms.
+IMPORT_BUDGET_US = 75_000
+
+# Only imported once a run needs them
+LAZY_MODULES = [
+    "ast",
+    "asyncio",
+    "concurrent.futures",
+    "multiprocessing",
+    "statistics",
+    "tempfile",
+    "traceback",
+    "coverage",
+    "smalltest.suite.asyncrun",
+    "smalltest.suite.depgraph",
+    "smalltest.suite.report",
+    "smalltest.suite.run",
+    "smalltest.suite.workers",
+    "smalltest.internals",
+]
+
+
+def import_time_us(module_name: str) -> int:
+    """Cumulative import time of a module in a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    for line in output.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.strip() == module_name:
+            return int(cumulative)
+    raise ValueError(f"{module_name} not found in -X importtime output")
+
+
+def test_startup_import_budget():
+    # Best of a few runs to ignore a busy machine
+    best = min(import_time_us("smalltest.main") for _ in range(3))
+    assert best < IMPORT_BUDGET_US, f"Importing smalltest.main took {best}us"
+
+
+def test_startup_lazy_modules():
+    code = (
+        "import sys, smalltest.main; "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+    assert output == ""
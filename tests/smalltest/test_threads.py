@@ -0,0 +1,127 @@
+import sys
+import time
+
+from functools import partial
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.capture import CaptureOptions
+from smalltest.suite.run import ResultType, run_tests_serial, run_tests_threaded
+from smalltest.tools import thread_unsafe
+
+threaded_tests = """
+import sys
+import threading
+import time
+
+from functools import partial
+import warnings
+
+from smalltest.tools import parametrize, thread_unsafe
+
+@parametrize("n", range(8))
+def test_waits(n):
+    print(f"case {n}")
+    time.sleep(0.2)
+    warnings.warn(f"warning {n}")
+    print(f"case {n} done", file=sys.stderr)
+
+@thread_unsafe
+def test_alone():
+    assert threading.current_thread() is threading.main_thread()
+"""
+
+
+@thread_unsafe
+def test_run_tests_threaded():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_threaded_waits.py"
+        testfile.write_text(threaded_tests)
+        test_dict = {testfile: ["test_waits", "test_alone"]}
+
+        stdout = sys.stdout
+        start = time.perf_counter()
+        results = dict(run_tests_threaded(
+            test_dict,
+            stream=StringIO(),
+            threads=8,
+            capture=CaptureOptions(keep_passing=True),
+        ))
+        elapsed = time.perf_counter() - start
+
+    assert len(results) == 9
+    assert results["test_threaded_waits::test_alone"].result_type == ResultType.SUCCESS
+    for n in range(8):
+        result = results[f"test_threaded_waits::test_waits[{n}]"]
+        assert result.result_type == ResultType.SUCCESS
+        assert result.stdout == f"case {n}\n"
+        assert result.stderr == f"case {n} done\n"
+        assert [warning.message for warning in result.warnings] == [f"warning {n}"]
+
+    # Each case runs on its own thread
+    assert elapsed < 1.2
+    assert sys.stdout is stdout
+
+
+@thread_unsafe
+def test_run_tests_threaded_maxfail():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_threaded_maxfail.py"
+        testfile.write_text(
+            "import time\n"
+            "from smalltest.tools import parametrize\n\n"
+            "@parametrize('n', range(50))\n"
+            "def test_fails(n):\n"
+            "    time.sleep(0.01)\n"
+            "    assert False\n"
+        )
+        results = list(run_tests_threaded(
+            {testfile: ["test_fails"]}, stream=StringIO(), threads=2, maxfail=3
+        ))
+
+    assert len(results) == 3
+
+
+@thread_unsafe
+def test_run_tests_threaded_repeated_warning():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_threaded_repeated.py"
+        testfile.write_text(
+            "import warnings\n\n"
+            "def warn():\n"
+            "    warnings.warn('shown by every test')\n\n"
+            "def test_a():\n"
+            "    warn()\n\n"
+            "def test_b():\n"
+            "    warn()\n"
+        )
+        test_dict = {testfile: ["test_a", "test_b"]}
+        for runner in (run_tests_serial, partial(run_tests_threaded, threads=1)):
+            results = dict(runner(test_dict, stream=StringIO()))
+            for result in results.values():
+                assert [warning.message for warning in result.warnings] == [
+                    "shown by every test"
+                ]
+
+
+@thread_unsafe
+def test_run_tests_threaded_cpu_time():
+    with TemporaryDirectory() as tmpfolder:
+        testfile = Path(tmpfolder) / "test_threaded_cpu.py"
+        testfile.write_text(
+            "import time\n\n"
+            "def test_busy():\n"
+            "    end = time.perf_counter() + 0.3\n"
+            "    while time.perf_counter() < end:\n"
+            "        pass\n\n"
+            "def test_sleeps():\n"
+            "    time.sleep(0.3)\n"
+        )
+        results = dict(run_tests_threaded(
+            {testfile: ["test_busy", "test_sleeps"]}, stream=StringIO(), threads=2
+        ))
+
+    # Each test is only charged for the CPU of its own thread
+    assert results["test_threaded_cpu::test_busy"].cpu_time_ns > 0.1e9
+    assert results["test_threaded_cpu::test_sleeps"].cpu_time_ns < 0.05e9
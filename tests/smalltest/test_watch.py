@@ -0,0 +1,51 @@
+import os
+import sys
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from smalltest.suite.run import ResultType
+from smalltest.suite.watch import Watcher
+from smalltest.tools import thread_unsafe
+
+
+@thread_unsafe
+def test_watcher_reruns_affected_tests():
+    with TemporaryDirectory() as tmpfolder:
+        base = Path(tmpfolder)
+        source = base / "watched_value.py"
+        source.write_text("VALUE = 1\n")
+        (base / "test_watched_value.py").write_text(
+            "from watched_value import VALUE\n\n"
+            "def test_value():\n"
+            "    assert VALUE == 1\n"
+        )
+        (base / "test_watched_other.py").write_text(
+            "def test_other():\n"
+            "    pass\n"
+        )
+
+        sys.path.insert(0, tmpfolder)
+        try:
+            output = StringIO()
+            watcher = Watcher(base, stream=output, use_index=False)
+            report = watcher.run()
+            assert report[ResultType.SUCCESS] == 2
+            assert "watched_value" in sys.modules
+
+            assert watcher.changed_files() == set()
+            source.write_text("VALUE = 22\n")
+            stat = source.stat()
+            os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+            changed = watcher.changed_files()
+            assert changed == {source}
+
+            # Only the dependent test reruns and sees the new source
+            report = watcher.run(changed)
+            assert report[ResultType.FAILURE] == 1
+            assert sum(report.values()) == 1
+        finally:
+            sys.path.remove(tmpfolder)
+            for name in ["watched_value", "test_watched_value", "test_watched_other"]:
+                sys.modules.pop(name, None)